@@ -6,16 +6,25 @@ try:
     jinja2_autoescape_builtin = False
 except ImportError:
     jinja2_autoescape_builtin = True
+import hashlib
+import marshal
+import os
+
 import dulwich.web
 import flask
 import httpauth
 from dulwich.errors import NotGitRepository
 
-from klaus import utils, views
+from klaus import archive, utils, views
+from klaus.cache import DiskCache, MiB, ResultCache
+from klaus.compression import CompressionMiddleware
 from klaus.repo import FancyRepo, InvalidRepo
 
 KLAUS_VERSION = utils.guess_git_revision() or "3.0.1"
 
+# Stylesheets up to this size are included in pages if `inline_css` is set.
+INLINE_CSS_MAX_SIZE = 16 * 1024
+
 
 class Klaus(flask.Flask):
     jinja_options = {
@@ -23,11 +32,62 @@ class Klaus(flask.Flask):
         "undefined": jinja2.StrictUndefined,
     }
 
-    def __init__(self, repo_paths, site_name, use_smarthttp, ctags_policy="none"):
+    def __init__(
+        self,
+        repo_paths,
+        site_name,
+        use_smarthttp,
+        ctags_policy="none",
+        cache_dir=None,
+        diff_budget=None,
+        inline_css=False,
+    ):
         """(See `make_app` for parameter descriptions.)"""
         self.site_name = site_name
         self.use_smarthttp = use_smarthttp
         self.ctags_policy = ctags_policy
+        self.cache_dir = cache_dir
+        if diff_budget is None:
+            diff_budget = views.DEFAULT_DIFF_BUDGET
+        self.diff_budget = diff_budget
+        self.inline_css = inline_css
+
+        # Rendered responses of views whose output only depends on the URL and
+        # the commit it resolves to; see `BaseRepoView.dispatch_request`.
+        # May be replaced by any object with the same `get`/`set` interface.
+        # Values are `(status code, headers, body)` tuples.
+        self.page_cache = ResultCache(
+            64 * MiB,
+            compute_size=lambda page: len(page[2]) + 500,
+            disk_cache=(
+                DiskCache(os.path.join(cache_dir, "pages"), max_bytes=1024 * MiB)
+                if cache_dir
+                else None
+            ),
+            dumps=marshal.dumps,
+            loads=marshal.loads,
+        )
+
+        # Highlighted (or rendered markup) HTML of files, by blob SHA; see
+        # `highlighting.highlight_or_render`.  Values are str.
+        self.highlight_cache = ResultCache(
+            32 * MiB,
+            compute_size=len,
+            disk_cache=(
+                DiskCache(os.path.join(cache_dir, "highlight"), max_bytes=256 * MiB)
+                if cache_dir
+                else None
+            ),
+            dumps=lambda html: html.encode("utf-8"),
+            loads=lambda data: data.decode("utf-8"),
+        )
+
+        # Generated tarballs, see `DownloadView`.
+        self.archive_cache = (
+            DiskCache(os.path.join(cache_dir, "archives"), max_bytes=1024 * MiB)
+            if cache_dir
+            else None
+        )
 
         valid_repos, invalid_repos = self.load_repos(repo_paths)
         self.valid_repos = {repo.namespaced_name: repo for repo in valid_repos}
@@ -35,6 +95,9 @@ class Klaus(flask.Flask):
 
         flask.Flask.__init__(self, __name__)
 
+        self.static_fingerprints = self.fingerprint_static_files()
+        self.url_defaults(self.add_static_fingerprint)
+
         self.setup_routes()
 
     def create_jinja_environment(self):
@@ -53,9 +116,55 @@ class Klaus(flask.Flask):
         env.globals["KLAUS_VERSION"] = KLAUS_VERSION
         env.globals["USE_SMARTHTTP"] = self.use_smarthttp
         env.globals["SITE_NAME"] = self.site_name
+        env.globals["INLINE_CSS"] = self.get_inline_css() if self.inline_css else {}
+        env.globals["ARCHIVE_FORMATS"] = [
+            (format, views.ARCHIVE_ENDPOINTS[format])
+            for format in archive.get_available_formats()
+        ]
 
         return env
 
+    def fingerprint_static_files(self):
+        """Return a `{filename: content hash}` dict of all static files.  The
+        hash is added to static URLs, so they change whenever the file does.
+        """
+        fingerprints = {}
+        for dirpath, _, filenames in os.walk(self.static_folder):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                with open(path, "rb") as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()[:12]
+                name = os.path.relpath(path, self.static_folder).replace(os.sep, "/")
+                fingerprints[name] = digest
+        return fingerprints
+
+    def add_static_fingerprint(self, endpoint, values):
+        if endpoint == "static" and values.get("filename") in self.static_fingerprints:
+            values.setdefault("v", self.static_fingerprints[values["filename"]])
+
+    def send_static_file(self, filename):
+        response = super().send_static_file(filename)
+        fingerprint = self.static_fingerprints.get(filename)
+        if fingerprint is not None and flask.request.args.get("v") == fingerprint:
+            # The URL changes whenever the file does.
+            response.headers["Cache-Control"] = views.IMMUTABLE_CACHE_CONTROL
+        return response
+
+    def get_inline_css(self):
+        """Return a `{filename: contents}` dict of the small stylesheets,
+        which are included in pages rather than linked to.
+        """
+        inline_css = {}
+        for filename in os.listdir(self.static_folder):
+            path = os.path.join(self.static_folder, filename)
+            if (
+                filename.endswith(".css")
+                and os.path.getsize(path) <= INLINE_CSS_MAX_SIZE
+            ):
+                with open(path, encoding="utf-8") as f:
+                    inline_css[filename] = f.read()
+        return inline_css
+
     def setup_routes(self):
         # fmt: off
         for endpoint, rule in [
@@ -63,6 +172,7 @@ class Klaus(flask.Flask):
             ('robots_txt',  '/robots.txt/'),
             ('blob',        '/<repo>/blob/'),
             ('blob',        '/<repo>/blob/<rev>/<path:path>'),
+            ('file_lines',  '/<repo>/file-lines/<rev>/<path:path>'),
             ('blame',       '/<repo>/blame/'),
             ('blame',       '/<repo>/blame/<rev>/<path:path>'),
             ('raw',         '/<repo>/raw/<path:path>/'),
@@ -72,11 +182,18 @@ class Klaus(flask.Flask):
             ('commit',      '/<repo>/commit/<path:rev>/'),
             ('patch',       '/<repo>/commit/<path:rev>.diff'),
             ('patch',       '/<repo>/commit/<path:rev>.patch'),
+            ('file_diff',   '/<repo>/file-diff/<rev>/<path:path>'),
             ('index',       '/<repo>/'),
             ('index',       '/<repo>/<path:rev>'),
             ('history',     '/<repo>/tree/<rev>/'),
             ('history',     '/<repo>/tree/<rev>/<path:path>'),
+            ('tree_entries', '/<repo>/tree-entries/<rev>/'),
+            ('tree_entries', '/<repo>/tree-entries/<rev>/<path:path>'),
             ('download',    '/<repo>/tarball/<path:rev>/'),
+            ('download',    '/<repo>/archive/<path:rev>.tar.gz'),
+            ('download_zip', '/<repo>/archive/<path:rev>.zip'),
+            ('download_tar_xz', '/<repo>/archive/<path:rev>.tar.xz'),
+            ('download_tar_zst', '/<repo>/archive/<path:rev>.tar.zst'),
         ]:
             self.add_url_rule(rule, view_func=getattr(views, endpoint))
             if "<repo>" in rule:
@@ -101,7 +218,7 @@ class Klaus(flask.Flask):
         for namespace, paths in repo_paths.items():
             for path in paths:
                 try:
-                    valid_repos.append(FancyRepo(path, namespace))
+                    valid_repos.append(FancyRepo(path, namespace, self.cache_dir))
                 except NotGitRepository:
                     invalid_repos.append(InvalidRepo(path, namespace))
         return valid_repos, invalid_repos
@@ -116,6 +233,10 @@ def make_app(
     disable_push=False,
     unauthenticated_push=False,
     ctags_policy="none",
+    cache_dir=None,
+    diff_budget=None,
+    compress=False,
+    inline_css=False,
 ):
     """
     Returns a WSGI app with all the features (smarthttp, authentication)
@@ -145,6 +266,19 @@ def make_app(
         - 'tags-and-branches': use ctags for revisions that are the HEAD of
           a tag or branc
         - 'ALL': use ctags for all revisions, may result in high server load!
+    :param cache_dir: Directory to persist caches and indexes in, so that they
+        survive restarts and can be shared between worker processes. If not
+        set, caches are kept in memory only and some indexes are disabled.
+    :param diff_budget: Limits to the diffs shown on commit pages, as a dict with
+        any of the keys "files", "lines" (of diff output), and "bytes" (of the
+        changed files).  Diffs of further files are loaded on demand.  Defaults
+        to `klaus.views.DEFAULT_DIFF_BUDGET`.
+    :param compress: Compress responses with gzip (or brotli, if the `brotli`
+        module is installed) for clients that support it.  Static files are
+        compressed once, at startup.  Not needed if a proxy in front of klaus
+        compresses responses already.
+    :param inline_css: Include small stylesheets in pages instead of linking to
+        them, which saves a request on the first page view.
     """
     if unauthenticated_push:
         if not use_smarthttp:
@@ -168,7 +302,14 @@ def make_app(
         site_name,
         use_smarthttp,
         ctags_policy,
+        cache_dir,
+        diff_budget,
+        inline_css,
     )
+    if compress:
+        app.wsgi_app = CompressionMiddleware(
+            app.wsgi_app, app.static_folder, app.static_url_path
+        )
     app.wsgi_app = utils.ProxyFix(app.wsgi_app)
 
     if use_smarthttp:
@@ -0,0 +1,195 @@
+"""Generate archives (tarballs and zip files) of Git trees.
+
+Compressing a tarball is usually much more work than assembling it, so
+.tar.gz archives are compressed in parallel, like `pigz` does: The tarball is
+cut into blocks that are compressed in separate threads (zlib releases the GIL
+while compressing), each using the end of the previous block as its preset
+dictionary so that compression ratio hardly suffers.  The compressed blocks
+are then concatenated into a single standard gzip stream.
+
+.tar.xz needs the `lzma` module (normally included with Python), .tar.zst
+needs the `zstandard` module.
+"""
+import concurrent.futures
+import os
+import stat
+import struct
+import time
+import zipfile
+import zlib
+
+import dulwich.archive
+import dulwich.objects
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MIMETYPES = {
+    "tar.gz": "application/x-tgz",
+    "zip": "application/zip",
+    "tar.xz": "application/x-xz",
+    "tar.zst": "application/zstd",
+}
+
+# Size of the blocks compressed by each thread in `parallel_gzip`.  Smaller
+# blocks mean more parallelism for small archives but slightly worse
+# compression, as each block is flushed to a byte boundary.
+GZIP_BLOCK_SIZE = 128 * 1024
+
+# Deflate can refer back to at most this many bytes.
+_DEFLATE_WINDOW_SIZE = 32 * 1024
+
+
+def get_available_formats():
+    """Return the archive formats supported with the installed modules."""
+    return [
+        format
+        for format in MIMETYPES
+        if not (format == "tar.xz" and lzma is None)
+        and not (format == "tar.zst" and zstandard is None)
+    ]
+
+
+def archive_stream(repo, tree, mtime, prefix, format):
+    """Return an iterator over the pieces of an archive of `tree` in `format`
+    (see `MIMETYPES`).  All files are put below `prefix` (bytes), with
+    modification time `mtime`.
+    """
+    if format == "zip":
+        return zip_stream(repo, tree, mtime, prefix)
+    tar_stream = dulwich.archive.tar_stream(repo, tree, mtime, prefix=prefix)
+    if format == "tar.gz":
+        return parallel_gzip(tar_stream, mtime=mtime)
+    elif format == "tar.xz":
+        return _compress_stream(tar_stream, lzma.LZMACompressor(lzma.FORMAT_XZ))
+    elif format == "tar.zst":
+        compressor = zstandard.ZstdCompressor(threads=-1).compressobj()
+        return _compress_stream(tar_stream, compressor)
+    else:
+        raise ValueError("Unknown archive format %r" % format)
+
+
+def _compress_stream(chunks, compressor):
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def parallel_gzip(chunks, level=6, mtime=0, threads=None, block_size=GZIP_BLOCK_SIZE):
+    """Compress the concatenation of `chunks` (an iterable of bytes) to gzip,
+    yielding the compressed data in pieces.  Uses up to `threads` threads
+    (default: number of CPUs).
+
+    The output is deterministic, i.e. doesn't depend on the number of threads
+    or the sizes of `chunks`.
+    """
+    if threads is None:
+        threads = os.cpu_count() or 1
+    yield b"\x1f\x8b\x08\x00" + struct.pack("<L", mtime) + b"\x00\xff"
+    crc = 0
+    size = 0
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        # Limit the number of blocks in memory.
+        pending = []
+        previous_block = b""
+        for block in _iter_blocks(chunks, block_size):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            zdict = previous_block[-_DEFLATE_WINDOW_SIZE:]
+            pending.append(executor.submit(_deflate_block, block, zdict, level))
+            previous_block = block
+            if len(pending) >= 2 * threads:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+    # An empty final block, then the trailer.
+    yield zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+    yield struct.pack("<LL", crc, size & 0xFFFFFFFF)
+
+
+def _iter_blocks(chunks, block_size):
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= block_size:
+            yield bytes(buf[:block_size])
+            del buf[:block_size]
+    if buf:
+        yield bytes(buf)
+
+
+def _deflate_block(block, zdict, level):
+    args = (level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+    compressobj = zlib.compressobj(*args, zdict) if zdict else zlib.compressobj(*args)
+    return compressobj.compress(block) + compressobj.flush(zlib.Z_SYNC_FLUSH)
+
+
+class _ChunkWriter:
+    """A write-only file object that collects what's written to it."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(repo, tree, mtime, prefix):
+    """Yield a zip file with the contents of `tree` in pieces.  See
+    `archive_stream` for the arguments.
+    """
+    # Zip files can't represent dates before 1980.
+    date_time = max(time.gmtime(mtime)[:6], (1980, 1, 1, 0, 0, 0))
+    writer = _ChunkWriter()
+    with zipfile.ZipFile(writer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path, mode, sha in _walk_tree(repo, tree, prefix):
+            try:
+                blob = repo[sha]
+            except KeyError:
+                # Probably a submodule, like in `dulwich.archive.tar_stream`.
+                continue
+            info = zipfile.ZipInfo(path.decode("utf-8", "surrogateescape"), date_time)
+            if stat.S_ISLNK(mode):
+                info.external_attr = (stat.S_IFLNK | 0o777) << 16
+            else:
+                permissions = 0o755 if mode & 0o111 else 0o644
+                info.external_attr = (stat.S_IFREG | permissions) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with zf.open(info, "w") as f:
+                for chunk in blob.chunked:
+                    f.write(chunk)
+            yield writer.pop()
+    yield writer.pop()
+
+
+def _walk_tree(repo, tree, prefix):
+    """Yield `(path, mode, sha)` for all non-directory entries below `tree`."""
+    for entry in tree.iteritems():
+        if entry.path in (b"", b".", b"..", b".git") or b"/" in entry.path:
+            # Can't be checked out either.
+            continue
+        path = prefix + b"/" + entry.path if prefix else entry.path
+        if stat.S_ISDIR(entry.mode):
+            subtree = repo[entry.sha]
+            if isinstance(subtree, dulwich.objects.Tree):
+                yield from _walk_tree(repo, subtree, path)
+        else:
+            yield path, entry.mode, entry.sha
@@ -0,0 +1,436 @@
+"""Cache primitives used throughout klaus.
+
+`LRUCache` is a thread-safe in-memory cache, bounded by number of entries
+and/or total size, with optional time-to-live and hit/miss/eviction counters.
+
+`ResultCache` is meant for results that never change once computed, like the
+blame of a file at a given commit.  It combines an `LRUCache` with an optional
+`DiskCache` that persists entries across restarts and can be shared by
+multiple worker processes.
+"""
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+MiB = 1024 * 1024
+
+_MISSING = object()
+
+# How much `DiskCache.write_through` followers read at a time
+_FOLLOW_CHUNK_SIZE = 64 * 1024
+
+
+class LRUCache:
+    """A thread-safe least-recently-used cache.
+
+    :param max_entries: maximum number of entries, or None for no limit
+    :param max_bytes: maximum total size of all entries as computed by
+        `compute_size`, or None for no limit.  Values larger than `max_bytes`
+        aren't cached at all.
+    :param compute_size: function returning the size of a value
+    :param ttl: number of seconds after which entries expire, or None
+    :param on_evict: function called as `on_evict(key, value)` whenever an
+        entry is evicted, expires, is replaced, is removed by `clear`, or is
+        too large to be cached in the first place.  (Not called for `pop`,
+        which hands the value back to the caller instead.)
+
+    `stats` counts hits, misses, evictions and expirations.
+    """
+
+    def __init__(
+        self,
+        max_entries=None,
+        max_bytes=None,
+        compute_size=None,
+        ttl=None,
+        on_evict=None,
+    ):
+        if max_bytes is not None and compute_size is None:
+            raise ValueError("'max_bytes' requires 'compute_size'")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.compute_size = compute_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        # key -> (value, size, expiry time); least recently used first
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, _count=False) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None, _count=True):
+        evicted = []
+        try:
+            with self._lock:
+                try:
+                    value, _, expires = self._entries[key]
+                except KeyError:
+                    pass
+                else:
+                    if expires is None or expires > time.monotonic():
+                        self._entries.move_to_end(key)
+                        if _count:
+                            self.stats["hits"] += 1
+                        return value
+                    evicted.append(self._remove(key))
+                    self.stats["expirations"] += 1
+                if _count:
+                    self.stats["misses"] += 1
+                return default
+        finally:
+            self._run_on_evict(evicted)
+
+    def set(self, key, value):
+        size = self.compute_size(value) if self.compute_size else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            self._run_on_evict([(key, value)])
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                evicted.append(self._remove(key))
+            self._entries[key] = (value, size, expires)
+            self._total_bytes += size
+            while (
+                self.max_entries is not None and len(self._entries) > self.max_entries
+            ) or (self.max_bytes is not None and self._total_bytes > self.max_bytes):
+                evicted.append(self._remove(next(iter(self._entries))))
+                self.stats["evictions"] += 1
+        self._run_on_evict(evicted)
+
+    def get_or_compute(self, key, producer):
+        """Return the value for `key`, calling `producer()` to compute (and
+        cache) it if necessary.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = producer()
+            self.set(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key)[1]
+
+    def clear(self):
+        with self._lock:
+            evicted = [self._remove(key) for key in list(self._entries)]
+        self._run_on_evict(evicted)
+
+    def _remove(self, key):
+        value, size, _ = self._entries.pop(key)
+        self._total_bytes -= size
+        return key, value
+
+    def _run_on_evict(self, evicted):
+        if self.on_evict is not None:
+            for key, value in evicted:
+                self.on_evict(key, value)
+
+
+def _key_digest(key):
+    return hashlib.sha1(repr(key).encode("utf8")).hexdigest()
+
+
+class DiskCache:
+    """A size-bounded on-disk key-value store for bytes values.
+
+    Each entry is stored in its own file named after a hash of its key.
+    When the cache grows beyond `max_bytes`, the least recently used entries
+    (by file modification time, which is updated on each hit) are deleted.
+    Writes are atomic, so concurrent readers never see partial entries.
+
+    Large values can be written from an iterable while they're being
+    streamed, and read as files, see `write_through`.
+
+    :param directory: where to store the entries; created if necessary
+    :param max_bytes: maximum total size of all entries
+    """
+
+    def __init__(self, directory, max_bytes=256 * MiB):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        # key digest -> `_PendingEntry`; see `write_through`
+        self._writers = {}
+
+    def _filename(self, key):
+        digest = _key_digest(key)
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def get(self, key):
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def set(self, key, data):
+        for _ in self._write(key, [data]):
+            pass
+
+    def open(self, key):
+        """Return the entry for `key` as a file opened for reading, or None."""
+        filename = self._filename(key)
+        try:
+            f = open(filename, "rb")
+        except OSError:
+            return None
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return f
+
+    def write_through(self, key, producer):
+        """Return an iterator over the data returned by `producer()` (an
+        iterable of bytes), storing it as the entry for `key` on the way.
+
+        `producer` is run in a background thread that writes the entry, while
+        this (and any other thread asking for the same entry in the meantime)
+        reads the partially written file as it grows.  So the first bytes are
+        available right away, a slow client doesn't hold up the others, and
+        the entry is completed even if all clients go away.  Should writing
+        fail, readers fall back to calling `producer` themselves.
+        """
+        digest = _key_digest(key)
+        with self._lock:
+            pending = self._writers.get(digest)
+            if pending is None:
+                pending = self._writers[digest] = _PendingEntry()
+                thread = threading.Thread(
+                    target=self._write_pending, args=(key, producer, digest, pending)
+                )
+                thread.daemon = True
+                thread.start()
+        return self._follow(key, pending, producer)
+
+    def _write_pending(self, key, producer, digest, pending):
+        try:
+            for _ in self._write(key, producer(), pending):
+                if pending.state == "failed":
+                    # Nobody is going to read the rest.
+                    break
+        except Exception:
+            # Readers will get the error when calling `producer` themselves.
+            pass
+        finally:
+            with self._lock:
+                del self._writers[digest]
+            pending.finish(failed=True)
+
+    def _follow(self, key, pending, producer):
+        sent = 0
+        with pending.cond:
+            while pending.filename is None and pending.state is None:
+                pending.cond.wait()
+            filename = pending.filename
+        try:
+            f = open(filename, "rb") if filename else None
+        except OSError:
+            # Already renamed (or removed, if writing failed)
+            f = self.open(key)
+        if f is not None:
+            with f:
+                while True:
+                    with pending.cond:
+                        while pending.size <= sent and pending.state is None:
+                            pending.cond.wait()
+                        size, state = pending.size, pending.state
+                    while sent < size:
+                        data = f.read(min(size - sent, _FOLLOW_CHUNK_SIZE))
+                        if not data:
+                            break
+                        sent += len(data)
+                        yield data
+                    if state is not None:
+                        break
+            if state == "done" and sent == size:
+                return
+        # Writing failed; produce the rest ourselves.
+        for chunk in producer():
+            if sent >= len(chunk):
+                sent -= len(chunk)
+                continue
+            yield chunk[sent:]
+            sent = 0
+
+    def _write(self, key, chunks, pending=None):
+        """Store the concatenation of `chunks` for `key`, yielding each chunk
+        once it's written.  If the entry can't be written, the chunks are
+        still yielded.  `pending` (a `_PendingEntry`) is kept up to date for
+        threads following the write.
+        """
+        filename = self._filename(key)
+        f = tmp_filename = None
+        size = 0
+        try:
+            try:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename))
+                f = os.fdopen(fd, "wb")
+            except OSError:
+                # A cache that can't be written to is just a cache that always misses.
+                pass
+            if pending is not None:
+                pending.start(tmp_filename if f is not None else None)
+            for chunk in chunks:
+                if f is not None:
+                    try:
+                        f.write(chunk)
+                        f.flush()
+                    except OSError:
+                        f.close()
+                        f = None
+                        if pending is not None:
+                            pending.finish(failed=True)
+                size += len(chunk)
+                if f is not None and pending is not None:
+                    pending.advance(size)
+                yield chunk
+            if f is None:
+                return
+            try:
+                f.close()
+            except OSError:
+                return
+            if pending is not None:
+                # All data is there, even if the rename fails.
+                pending.finish(failed=False)
+            try:
+                os.replace(tmp_filename, filename)
+            except OSError:
+                return
+            tmp_filename = None
+        finally:
+            if f is not None:
+                f.close()
+            if tmp_filename is not None:
+                try:
+                    os.remove(tmp_filename)
+                except OSError:
+                    pass
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self._total_bytes += size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _evict(self):
+        """Delete the least recently used entries until the cache is at 80% of
+        its maximum size.  Rescans the directory to account for entries
+        written by other processes.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes * 0.8:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._total_bytes = total
+
+
+class _PendingEntry:
+    """A `DiskCache` entry that's being written by `DiskCache.write_through`."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.filename = None  # of the temporary file
+        self.size = 0  # number of bytes written to it so far
+        self.state = None  # "done" or "failed" once finished
+
+    def start(self, filename):
+        with self.cond:
+            self.filename = filename
+            if filename is None:
+                self.state = "failed"
+            self.cond.notify_all()
+
+    def advance(self, size):
+        with self.cond:
+            self.size = size
+            self.cond.notify_all()
+
+    def finish(self, failed):
+        with self.cond:
+            if self.state is None:
+                self.state = "failed" if failed else "done"
+            self.cond.notify_all()
+
+
+class ResultCache:
+    """A two-level cache: Size-bounded in memory, and optionally on disk.
+
+    :param max_bytes: maximum size of the in-memory cache
+    :param compute_size: function returning the (approximate) size of a value
+    :param disk_cache: optional `DiskCache` instance
+    :param dumps: function to serialize values to bytes for `disk_cache`
+    :param loads: inverse of `dumps`
+    """
+
+    def __init__(
+        self, max_bytes, compute_size, disk_cache=None, dumps=None, loads=None
+    ):
+        self.memory_cache = LRUCache(max_bytes=max_bytes, compute_size=compute_size)
+        self._disk = disk_cache
+        self._dumps = dumps
+        self._loads = loads
+
+    def get(self, key):
+        value = self.memory_cache.get(key)
+        if value is None and self._disk is not None:
+            data = self._disk.get(key)
+            if data is not None:
+                value = self._loads(data)
+                self.memory_cache.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.memory_cache.set(key, value)
+        if self._disk is not None:
+            self._disk.set(key, self._dumps(value))
+
+    def get_or_compute(self, key, producer):
+        """Return the value for `key`, calling `producer()` to compute (and
+        cache) it if necessary.
+        """
+        value = self.get(key)
+        if value is None:
+            value = producer()
+            self.set(key, value)
+        return value
@@ -0,0 +1,298 @@
+"""A pool of long-running `git cat-file --batch` processes.
+
+Spawning `git` for every object lookup is expensive: Each process has to be
+forked and exec'd, and has to open the repository's pack indexes.  Instead we
+keep a few `git cat-file --batch` (object contents) and `git cat-file
+--batch-check` (object type and size) processes around per repository and
+send them one object name per line.
+
+Large blobs are streamed by a separate `git cat-file blob` process instead,
+so a slow download neither ties up one of the pool's processes nor has to
+hold the whole blob in memory.
+
+The pool is bounded (callers wait for a process to become available when all
+of them are busy), reaps processes that have been idle for a while, and
+replaces processes that died or got out of sync with a fresh one.
+"""
+import atexit
+import os
+import subprocess
+import threading
+import time
+import weakref
+
+BATCH = "--batch"
+BATCH_CHECK = "--batch-check"
+
+# Size of the pieces in which `CatFilePool.iter_blob` yields blob contents.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_all_pools = weakref.WeakSet()  # type: ignore
+
+
+class CatFileError(Exception):
+    """A `git cat-file` process died or misbehaved."""
+
+
+class CatFileProcess:
+    """A single `git cat-file --batch` or `--batch-check` process."""
+
+    def __init__(self, repo_path, mode):
+        self.mode = mode
+        self.pid = os.getpid()
+        self.last_used = time.monotonic()
+        self._proc = subprocess.Popen(
+            ["git", "cat-file", mode],
+            cwd=repo_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def request(self, name):
+        """Ask for object `name`; return its `(sha, type name, size)`.
+
+        In `--batch` mode, the object's contents must be read using
+        `read_contents` before sending the next request.
+        """
+        try:
+            self._proc.stdin.write(name + b"\n")
+            self._proc.stdin.flush()
+            header = self._proc.stdout.readline()
+        except (OSError, ValueError) as e:
+            raise CatFileError(e)
+        parts = header.split()
+        if len(parts) == 2 and parts[1] in (b"missing", b"ambiguous"):
+            raise KeyError(name)
+        if len(parts) != 3:
+            raise CatFileError("Unexpected cat-file output %r" % header)
+        sha, type_name, size = parts
+        return sha, type_name, int(size)
+
+    def read_contents(self, size):
+        data = self._proc.stdout.read(size)
+        if len(data) != size or self._proc.stdout.read(1) != b"\n":
+            raise CatFileError("Truncated cat-file output")
+        return data
+
+    def is_alive(self):
+        return self.pid == os.getpid() and self._proc.poll() is None
+
+    def close(self):
+        if self.pid != os.getpid():
+            # Inherited from our parent process across a fork; leave it alone.
+            return
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self._proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc.stdout.close()
+
+
+class CatFilePool:
+    """A bounded pool of `git cat-file` processes for the repository at
+    `repo_path`.
+
+    :param max_processes: maximum number of processes per mode
+    :param idle_timeout: seconds after which unused processes are terminated
+    """
+
+    def __init__(self, repo_path, max_processes=4, idle_timeout=60):
+        self.repo_path = os.path.abspath(repo_path)
+        self.max_processes = max_processes
+        self.idle_timeout = idle_timeout
+        self._idle = {BATCH: [], BATCH_CHECK: []}
+        self._num_processes = {BATCH: 0, BATCH_CHECK: 0}
+        self._cond = threading.Condition()
+        self._reaper = None
+        _all_pools.add(self)
+
+    def read_object(self, name):
+        """Return `(type name, contents)` of object `name`.
+
+        Raises KeyError if there's no such object.
+        """
+        return self.read_objects([name])[0][1:]
+
+    def read_objects(self, names):
+        """Return a `(sha, type name, contents)` tuple for each of `names`."""
+
+        def read(proc):
+            results = []
+            for name in names:
+                sha, type_name, size = proc.request(name)
+                results.append((sha, type_name, proc.read_contents(size)))
+            return results
+
+        return self._run(BATCH, read)
+
+    def object_info(self, name):
+        """Return `(type name, size)` of object `name` without reading it.
+
+        Raises KeyError if there's no such object.
+        """
+        return self._run(BATCH_CHECK, lambda proc: proc.request(name)[1:])
+
+    def iter_blob(self, name, start=0, stop=None, chunk_size=STREAM_CHUNK_SIZE):
+        """Yield the contents of blob `name` from byte `start` up to (not
+        including) byte `stop` in pieces of at most `chunk_size` bytes.
+
+        The blob is read from a dedicated process which is started when the
+        first piece is requested and killed when the generator is closed.
+        Raises CatFileError if the blob is missing or shorter than `stop`.
+        """
+        proc = subprocess.Popen(
+            ["git", "cat-file", "blob", os.fsdecode(name)],
+            cwd=self.repo_path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            pos = 0
+            while stop is None or pos < stop:
+                size = chunk_size if stop is None else min(chunk_size, stop - pos)
+                chunk = proc.stdout.read(size)
+                if not chunk:
+                    break
+                if pos + len(chunk) > start:
+                    yield chunk[max(start - pos, 0) :]
+                pos += len(chunk)
+            if stop is not None and pos < stop:
+                raise CatFileError("Truncated cat-file output")
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+
+    def _run(self, mode, func):
+        # Retry once with a fresh process if the process crashed.
+        for attempt in range(2):
+            proc = self._acquire(mode)
+            try:
+                result = func(proc)
+            except KeyError:
+                self._release(proc)
+                raise
+            except CatFileError:
+                self._discard(proc)
+                if attempt:
+                    raise
+            except BaseException:
+                # We don't know where in the protocol we were interrupted.
+                self._discard(proc)
+                raise
+            else:
+                self._release(proc)
+                return result
+
+    def _acquire(self, mode):
+        # Closing a process may block for a while, so it's done only after
+        # releasing the lock.
+        to_close = []
+        try:
+            with self._cond:
+                while True:
+                    to_close += self._reap_idle()
+                    idle = self._idle[mode]
+                    while idle:
+                        proc = idle.pop()
+                        if proc.is_alive():
+                            return proc
+                        self._num_processes[mode] -= 1
+                        to_close.append(proc)
+                    if self._num_processes[mode] < self.max_processes:
+                        self._num_processes[mode] += 1
+                        break
+                    self._cond.wait()
+        finally:
+            _close_processes(to_close)
+        try:
+            proc = CatFileProcess(self.repo_path, mode)
+        except BaseException:
+            with self._cond:
+                self._num_processes[mode] -= 1
+                self._cond.notify()
+            raise
+        self._start_reaper()
+        return proc
+
+    def _release(self, proc):
+        proc.last_used = time.monotonic()
+        with self._cond:
+            self._idle[proc.mode].append(proc)
+            self._cond.notify()
+
+    def _discard(self, proc):
+        proc.close()
+        with self._cond:
+            self._num_processes[proc.mode] -= 1
+            self._cond.notify()
+
+    def _reap_idle(self):
+        """Remove processes that have been idle for longer than `idle_timeout`
+        from the pool and return them, to be closed by the caller.
+        Must be called with `self._cond` held.
+        """
+        reaped = []
+        deadline = time.monotonic() - self.idle_timeout
+        for mode, idle in self._idle.items():
+            # Most recently used processes are at the end of the list.
+            while idle and idle[0].last_used < deadline:
+                self._num_processes[mode] -= 1
+                reaped.append(idle.pop(0))
+        return reaped
+
+    def _start_reaper(self):
+        with self._cond:
+            if self._reaper is not None and self._reaper.is_alive():
+                return
+            self._reaper = threading.Thread(
+                target=_reap_periodically, args=(weakref.ref(self),)
+            )
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def close(self):
+        """Terminate all idle processes."""
+        to_close = []
+        with self._cond:
+            for mode, idle in self._idle.items():
+                while idle:
+                    self._num_processes[mode] -= 1
+                    to_close.append(idle.pop())
+        _close_processes(to_close)
+
+
+def _reap_periodically(pool_ref):
+    while True:
+        pool = pool_ref()
+        if pool is None:
+            return
+        interval = max(pool.idle_timeout / 2, 0.1)
+        with pool._cond:
+            reaped = pool._reap_idle()
+            done = not any(pool._num_processes.values())
+            if done:
+                pool._reaper = None
+        _close_processes(reaped)
+        if done:
+            return
+        del pool
+        time.sleep(interval)
+
+
+def _close_processes(procs):
+    for proc in procs:
+        proc.close()
+
+
+@atexit.register
+def _close_all_pools():
+    for pool in list(_all_pools):
+        pool.close()
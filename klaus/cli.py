@@ -6,7 +6,7 @@ import webbrowser
 from dulwich.errors import NotGitRepository
 from dulwich.repo import Repo
 
-from klaus import KLAUS_VERSION, make_app
+from klaus import KLAUS_VERSION, make_app, server
 from klaus.utils import force_unicode
 
 
@@ -50,6 +50,16 @@ def make_parser():
         choices=["none", "tags-and-branches", "ALL"],
         default="none",
     )
+    parser.add_argument(
+        "--cache-dir",
+        help="persist caches and indexes in DIR. default: don't persist",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--compress",
+        help="compress responses with gzip (or brotli, if installed)",
+        action="store_true",
+    )
 
     parser.add_argument(
         "repos",
@@ -70,9 +80,50 @@ def make_parser():
         type=argparse.FileType("r"),
     )
 
+    grp = parser.add_argument_group("Server")
+    grp.add_argument(
+        "--processes",
+        help="number of worker processes. default: 1",
+        metavar="N",
+        default=1,
+        type=int,
+    )
+    grp.add_argument(
+        "--threads",
+        help="number of threads per process. default: 8",
+        metavar="N",
+        default=8,
+        type=int,
+    )
+    grp.add_argument(
+        "--queue-size",
+        help="maximum number of requests waiting for a thread; "
+        "further requests are rejected. default: 64",
+        metavar="N",
+        default=64,
+        type=int,
+    )
+    grp.add_argument(
+        "--max-requests",
+        help="restart worker processes after about N requests. default: never",
+        metavar="N",
+        default=0,
+        type=int,
+    )
+    grp.add_argument(
+        "--keepalive",
+        help="close idle keep-alive connections after SECONDS. default: 5",
+        metavar="SECONDS",
+        default=5,
+        type=float,
+    )
+
     grp = parser.add_argument_group("Development flags", "DO NOT USE IN PRODUCTION!")
     grp.add_argument(
-        "--debug", help="Enable Werkzeug debugger and reloader", action="store_true"
+        "--debug",
+        help="Enable Werkzeug debugger and reloader (uses Werkzeug's development "
+        "server instead of the one configured above)",
+        action="store_true",
     )
 
     return parser
@@ -92,6 +143,13 @@ def main():
         )
         return 1
 
+    if min(args.processes, args.threads, args.queue_size) < 1:
+        print(
+            "ERROR: --processes, --threads and --queue-size must be at least 1",
+            file=sys.stderr,
+        )
+        return 1
+
     if not args.repos:
         print(
             "WARNING: No repositories supplied -- syntax is 'klaus dir1 dir2...'.",
@@ -121,12 +179,26 @@ def main():
         args.smarthttp,
         args.htdigest,
         ctags_policy=args.ctags,
+        cache_dir=args.cache_dir,
+        compress=args.compress,
     )
 
     if args.browser:
         _open_browser(args)
 
-    app.run(args.host, args.port, args.debug)
+    if args.debug:
+        app.run(args.host, args.port, args.debug)
+    else:
+        server.serve(
+            app,
+            args.host,
+            args.port,
+            processes=args.processes,
+            threads=args.threads,
+            queue_size=args.queue_size,
+            max_requests=args.max_requests,
+            keepalive_timeout=args.keepalive,
+        )
 
 
 def _open_browser(args):
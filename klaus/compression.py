@@ -0,0 +1,208 @@
+"""WSGI middleware that compresses responses with gzip (or brotli).
+
+Responses are compressed on the fly, piece by piece, so streamed pages stay
+streamed.  Responses that are already compressed (tarballs, images) or whose
+content type isn't known to compress well (like raw files, which are served
+without a content type) are passed through unchanged, as are partial and
+`no-transform` responses.
+
+Static files are compressed only once, when the middleware is created, with
+the highest compression level.
+"""
+import mimetypes
+import os
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+}
+
+# Responses smaller than this aren't worth compressing.
+MIN_SIZE = 256
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def is_compressible(mimetype):
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_MIMETYPES
+
+
+class GzipCompressor:
+    def __init__(self, level=GZIP_LEVEL):
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        # Flush after every piece so that streamed responses aren't held back.
+        return self._compressobj.compress(data) + self._compressobj.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+
+    def finish(self):
+        return self._compressobj.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, quality=BROTLI_QUALITY):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def compress(data, encoding, best=False):
+    """Compress `data` in one go using `encoding` ('gzip' or 'br')."""
+    if encoding == "br":
+        compressor = BrotliCompressor(11 if best else BROTLI_QUALITY)
+    else:
+        compressor = GzipCompressor(9 if best else GZIP_LEVEL)
+    return compressor.compress(data) + compressor.finish()
+
+
+class CompressionMiddleware:
+    """Compress the responses of `app` if the client accepts it.
+
+    :param static_folder: directory of static files to precompress
+    :param static_url_path: URL path under which `static_folder` is served
+    """
+
+    def __init__(self, app, static_folder=None, static_url_path="/static"):
+        self.app = app
+        self.encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+        # URL path -> (file path, file stat, {encoding: compressed data})
+        self.static_files = {}
+        if static_folder is not None:
+            self._precompress_static_files(static_folder, static_url_path)
+
+    def _precompress_static_files(self, static_folder, static_url_path):
+        for dirpath, _, filenames in os.walk(static_folder):
+            for filename in filenames:
+                mimetype, encoding = mimetypes.guess_type(filename)
+                if encoding is not None or not is_compressible(mimetype or ""):
+                    continue
+                path = os.path.join(dirpath, filename)
+                with open(path, "rb") as f:
+                    data = f.read()
+                variants = {}
+                for encoding in self.encodings:
+                    compressed = compress(data, encoding, best=True)
+                    if len(compressed) < len(data):
+                        variants[encoding] = compressed
+                url_path = "/".join(
+                    [static_url_path, os.path.relpath(path, static_folder)]
+                ).replace(os.sep, "/")
+                self.static_files[url_path] = (path, _stat_key(path), variants)
+
+    def __call__(self, environ, start_response):
+        state = {"compressor": None, "body": None}
+
+        def compressing_start_response(status, headers, exc_info=None):
+            headers = self._prepare(environ, status, headers, state)
+            write = start_response(status, headers, exc_info)
+            if state["compressor"] is None:
+                return write
+            return lambda data: write(state["compressor"].compress(data))
+
+        app_iter = self.app(environ, compressing_start_response)
+        if "started" in state and state["compressor"] is state["body"] is None:
+            return app_iter
+        return self._iter_compressed(app_iter, state)
+
+    def _prepare(self, environ, status, headers, state):
+        """Decide how to encode the response; return the headers to send."""
+        state["started"] = True
+        if not status.startswith("200 "):
+            return headers
+        headers = Headers(headers)
+        mimetype = headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if (
+            "Content-Encoding" in headers
+            or "Content-Range" in headers
+            or "no-transform" in headers.get("Cache-Control", "")
+            or not is_compressible(mimetype)
+        ):
+            return headers.to_wsgi_list()
+
+        vary = headers.get("Vary")
+        headers["Vary"] = vary + ", Accept-Encoding" if vary else "Accept-Encoding"
+        content_length = headers.get("Content-Length", type=int)
+        encoding = self._choose_encoding(environ)
+        if encoding is None or (content_length or MIN_SIZE) < MIN_SIZE:
+            return headers.to_wsgi_list()
+
+        headers["Content-Encoding"] = encoding
+        etag = headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            # The compressed response isn't byte-for-byte the same.
+            headers["ETag"] = "W/" + etag
+        body = self._get_precompressed(environ.get("PATH_INFO"), encoding)
+        if body is not None:
+            headers["Content-Length"] = str(len(body))
+        else:
+            headers.pop("Content-Length", None)
+        if environ["REQUEST_METHOD"] != "HEAD":
+            if body is not None:
+                state["body"] = body
+            else:
+                state["compressor"] = (
+                    BrotliCompressor() if encoding == "br" else GzipCompressor()
+                )
+        return headers.to_wsgi_list()
+
+    def _choose_encoding(self, environ):
+        accept = parse_accept_header(environ.get("HTTP_ACCEPT_ENCODING"))
+        qualities = [
+            (accept.quality(encoding), encoding) for encoding in self.encodings
+        ]
+        quality, encoding = max(qualities, key=lambda q_and_enc: q_and_enc[0])
+        return encoding if quality > 0 else None
+
+    def _get_precompressed(self, url_path, encoding):
+        if url_path not in self.static_files:
+            return None
+        path, stat_key, variants = self.static_files[url_path]
+        try:
+            if _stat_key(path) != stat_key:
+                # Changed since startup (during development, say).
+                return None
+        except OSError:
+            return None
+        return variants.get(encoding)
+
+    def _iter_compressed(self, app_iter, state):
+        try:
+            for data in app_iter:
+                if state["body"] is not None:
+                    break
+                if state["compressor"] is None:
+                    yield data
+                else:
+                    data = state["compressor"].compress(data)
+                    if data:
+                        yield data
+            if state["body"] is not None:
+                yield state["body"]
+            elif state["compressor"] is not None:
+                yield state["compressor"].finish()
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
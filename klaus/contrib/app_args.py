@@ -27,5 +27,8 @@ def get_args_from_env():
             os.environ.get("KLAUS_UNAUTHENTICATED_PUSH", "0")
         ),
         ctags_policy=os.environ.get("KLAUS_CTAGS_POLICY", "none"),
+        cache_dir=os.environ.get("KLAUS_CACHE_DIR"),
+        compress=strtobool(os.environ.get("KLAUS_COMPRESS", "0")),
+        inline_css=strtobool(os.environ.get("KLAUS_INLINE_CSS", "0")),
     )
     return args, kwargs
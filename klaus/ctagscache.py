@@ -33,8 +33,7 @@ import shutil
 import tempfile
 import threading
 
-from dulwich.lru_cache import LRUSizeCache
-
+from klaus.cache import LRUCache, MiB
 from klaus.ctagsutils import create_tagsfile, delete_tagsfile
 
 # Good compression while taking only 10% more time than level 1
@@ -65,9 +64,6 @@ def uncompress_tagsfile(compressed_tagsfile_path):
     return uncompressed_tagsfile_path
 
 
-MiB = 1024 * 1024
-
-
 class CTagsCache:
     """A ctags cache. Both uncompressed and compressed entries are kept in
     temporary files created by `tempfile.mkstemp` which are deleted from disk
@@ -90,13 +86,15 @@ class CTagsCache:
     def __init__(self, uncompressed_max_bytes=30 * MiB, compressed_max_bytes=20 * MiB):
         self.uncompressed_max_bytes = uncompressed_max_bytes
         self.compressed_max_bytes = compressed_max_bytes
-        # Note: We use dulwich's LRU cache to store the tagsfile paths here,
-        # but we could easily replace it by any other (LRU) cache implementation.
-        self._uncompressed_cache = LRUSizeCache(
-            uncompressed_max_bytes, compute_size=os.path.getsize
+        self._uncompressed_cache = LRUCache(
+            max_bytes=uncompressed_max_bytes,
+            compute_size=os.path.getsize,
+            on_evict=self._clear_uncompressed_entry,
         )
-        self._compressed_cache = LRUSizeCache(
-            compressed_max_bytes, compute_size=os.path.getsize
+        self._compressed_cache = LRUCache(
+            max_bytes=compressed_max_bytes,
+            compute_size=os.path.getsize,
+            on_evict=self._clear_compressed_entry,
         )
         self._clearing = False
         self._lock = threading.Lock()
@@ -130,27 +128,24 @@ class CTagsCache:
 
         # Avoiding race conditions, The Sledgehammer Way
         with self._lock:
-            if git_rev in self._uncompressed_cache:
-                return self._uncompressed_cache[git_rev]
+            uncompressed_tagsfile_path = self._uncompressed_cache.get(git_rev)
+            if uncompressed_tagsfile_path is not None:
+                return uncompressed_tagsfile_path
 
-            if git_rev in self._compressed_cache:
-                compressed_tagsfile_path = self._compressed_cache[git_rev]
+            compressed_tagsfile_path = self._compressed_cache.pop(git_rev)
+            if compressed_tagsfile_path is not None:
                 uncompressed_tagsfile_path = uncompress_tagsfile(
                     compressed_tagsfile_path
                 )
-                self._compressed_cache._remove_node(
-                    self._compressed_cache._cache[git_rev]
-                )
+                delete_tagsfile(compressed_tagsfile_path)
             else:
                 # Not in cache.
                 uncompressed_tagsfile_path = create_tagsfile(git_repo_path, git_rev)
-            self._uncompressed_cache.add(
-                git_rev, uncompressed_tagsfile_path, self._clear_uncompressed_entry
-            )
+            self._uncompressed_cache.set(git_rev, uncompressed_tagsfile_path)
             return uncompressed_tagsfile_path
 
     def _clear_uncompressed_entry(self, git_rev, uncompressed_tagsfile_path):
-        """Called by LRUSizeCache whenever an entry is to be evicted from
+        """Called by LRUCache whenever an entry is to be evicted from
         uncompressed cache.
 
         Most of the times this happens when space is needed
@@ -161,15 +156,13 @@ class CTagsCache:
         if not self._clearing:
             # If we're clearing the whole cache, don't waste time moving tagsfiles
             # from uncompressed to compressed cache, but remove them directly instead.
-            self._compressed_cache.add(
-                git_rev,
-                compress_tagsfile(uncompressed_tagsfile_path),
-                self._clear_compressed_entry,
+            self._compressed_cache.set(
+                git_rev, compress_tagsfile(uncompressed_tagsfile_path)
             )
         delete_tagsfile(uncompressed_tagsfile_path)
 
     def _clear_compressed_entry(self, git_rev, compressed_tagsfile_path):
-        """Called by LRUSizeCache whenever an entry to be evicted from
+        """Called by LRUCache whenever an entry to be evicted from
         compressed cache.
 
         This happens when space is needed for new compressed
@@ -8,10 +8,14 @@
     :license: BSD
 """
 
+import marshal
 from difflib import SequenceMatcher
 
 from klaus.utils import escape_html as e
 
+# Version 4 shares repeated interned strings like the line actions.
+MARSHAL_VERSION = 4
+
 
 def highlight_line(old_line, new_line):
     """Highlight inline changes in both lines."""
@@ -86,3 +90,96 @@ def render_diff(a, b, n=3):
                 raise AssertionError("unknown tag %s" % tag)
 
     return actions.count("add"), actions.count("del"), chunks
+
+
+def compact_file_change(change):
+    """Convert a file change as returned by `FancyRepo.commit_diff` to the
+    compact form used by `dump_compact_diff`.
+    """
+    if change.get("is_deferred"):
+        return (change["old_filename"], change["new_filename"])
+    chunks = change["chunks"]
+    if chunks is not None:
+        chunks = [
+            [
+                (line["old_lineno"], line["new_lineno"], line["action"], line["line"])
+                for line in chunk
+            ]
+            for chunk in chunks
+        ]
+    return (
+        change["old_filename"],
+        change["new_filename"],
+        change.get("additions"),
+        change.get("deletions"),
+        chunks,
+    )
+
+
+def dump_compact_diff(summary, compact_file_changes):
+    """Serialize the output of `FancyRepo.commit_diff`, with file changes
+    converted using `compact_file_change`, to a compact bytestring.
+    """
+    compact_summary = (
+        summary["nfiles"],
+        summary["nadditions"],
+        summary["ndeletions"],
+        summary.get("ndeferred", 0),
+    )
+    return marshal.dumps((compact_summary, compact_file_changes), MARSHAL_VERSION)
+
+
+def load_diff(data):
+    """Inverse of `dump_compact_diff`."""
+    compact_summary, compact_file_changes = marshal.loads(data)
+    # Entries written before deferred diffs were cached lack "ndeferred"
+    nfiles, nadditions, ndeletions, ndeferred = (tuple(compact_summary) + (0,))[:4]
+    summary = {
+        "nfiles": nfiles,
+        "nadditions": nadditions,
+        "ndeletions": ndeletions,
+        "ndeferred": ndeferred,
+    }
+    file_changes = []
+    for compact_change in compact_file_changes:
+        if len(compact_change) == 2:
+            old_filename, new_filename = compact_change
+            file_changes.append(
+                {
+                    "is_binary": False,
+                    "is_deferred": True,
+                    "old_filename": old_filename,
+                    "new_filename": new_filename,
+                    "chunks": None,
+                }
+            )
+            continue
+        old_filename, new_filename, additions, deletions, chunks = compact_change
+        change = {
+            "is_binary": chunks is None,
+            "old_filename": old_filename,
+            "new_filename": new_filename,
+            "chunks": None,
+        }
+        if chunks is not None:
+            change.update(
+                {
+                    "chunks": [
+                        [
+                            {
+                                "old_lineno": old_lineno,
+                                "new_lineno": new_lineno,
+                                "action": action,
+                                "line": line,
+                                "no_newline": not line.endswith(b"\n"),
+                            }
+                            for old_lineno, new_lineno, action, line in chunk
+                        ]
+                        for chunk in chunks
+                    ],
+                    "additions": additions,
+                    "deletions": deletions,
+                }
+            )
+        file_changes.append(change)
+    return summary, file_changes
@@ -1,14 +1,44 @@
+import itertools
+import os
+import re
+import time
+
+import pygments
 from pygments import highlight
 from pygments.formatters import HtmlFormatter
 from pygments.lexers import (
     ClassNotFound,
     TextLexer,
+    find_lexer_class,
     get_lexer_by_name,
     get_lexer_for_filename,
     guess_lexer,
 )
+from pygments.modeline import get_filetype_from_line
+from pygments.token import Text
 
 from klaus import markup
+from klaus.cache import LRUCache
+
+# Lexer detection only looks at this many characters at the start of a file
+# (and modelines at its end).
+LEXER_GUESS_SAMPLE_SIZE = 8 * 1024
+
+# `highlight_blocks` highlights this many lines at a time...
+HIGHLIGHT_BLOCK_LINES = 1000
+# ...and lexes about this many characters at a time.
+HIGHLIGHT_PIECE_SIZE = 256 * 1024
+
+# `_limit_time` checks the time after lexing about this many characters.
+_TIME_CHECK_INTERVAL = 64
+
+# Maps `(file name, blob SHA, language)` to lexer classes; see `get_lexer`.
+_lexer_cache = LRUCache(max_entries=10000)
+
+_SHEBANG_RE = re.compile(r"#!\s*(\S+)(.*)")
+_EMACS_MODELINE_RE = re.compile(
+    r"-\*-\s*(?:.*;\s*)?(?:mode:\s*)?([\w+-]+)\s*(?:;.*)?-\*-"
+)
 
 CTAGS_SUPPORTED_LANGUAGES = (
     "Asm Awk Basic C C# C++ Cobol DosBatch Eiffel Erlang Fortran HTML Java "
@@ -22,7 +52,7 @@ PYGMENTS_CTAGS_LANGUAGE_MAP = dict(
 
 
 class KlausDefaultFormatter(HtmlFormatter):
-    def __init__(self, language, ctags, **kwargs):
+    def __init__(self, language, ctags, table_rows_only=False, **kwargs):
         HtmlFormatter.__init__(
             self,
             linenos="table",
@@ -32,6 +62,7 @@ class KlausDefaultFormatter(HtmlFormatter):
             **kwargs,
         )
         self.language = language
+        self.table_rows_only = table_rows_only
         if ctags:
             # Use Pygments' ctags system but provide our own CTags instance
             self.tagsfile = True  # some trueish object
@@ -44,6 +75,20 @@ class KlausDefaultFormatter(HtmlFormatter):
                 line = "<span class=line>%s</span>" % line
             yield tag, line
 
+    def _wrap_tablelinenos(self, inner):
+        table_tag = '<table class="%stable">' % self.cssclass
+        for tag, piece in HtmlFormatter._wrap_tablelinenos(self, inner):
+            if tag == 0 and self.table_rows_only:
+                # Leave out the table (and the div around it, see `_wrap_div`)
+                # so that the rows of several pieces can go into one table.
+                piece = piece.replace(table_tag, "").replace("</table>", "")
+            yield tag, piece
+
+    def _wrap_div(self, inner):
+        if self.table_rows_only:
+            return inner
+        return HtmlFormatter._wrap_div(self, inner)
+
     def _lookup_ctag(self, token):
         matches = list(self._get_all_ctags_matches(token))
         best_matches = list(self.get_best_ctags_matches(matches))
@@ -91,7 +136,15 @@ class KlausPythonFormatter(KlausDefaultFormatter):
 
 
 def highlight_or_render(
-    code, filename, render_markup=True, ctags=None, ctags_baseurl=None
+    code,
+    filename,
+    render_markup=True,
+    ctags=None,
+    ctags_baseurl=None,
+    cache=None,
+    blob_sha=None,
+    ctags_rev=None,
+    language=None,
 ):
     """Render code using Pygments, markup (markdown, rst, ...) using the
     corresponding renderer, if available.
@@ -101,29 +154,346 @@ def highlight_or_render(
     :param render_markup: whether to render markup if possible, bool
     :param ctags: tagsfile obj used for source code hyperlinks, ``ctags.CTags``
     :param ctags_baseurl: base url used for source code hyperlinks, str
+    :param cache: cache for the rendered HTML, e.g. a ``ResultCache``; only
+        used if `blob_sha` is given
+    :param blob_sha: SHA of the blob that `code` was taken from
+    :param ctags_rev: revision of the tagsfile `ctags`
+    :param language: name of the language of the code (e.g. from a
+        `linguist-language` Git attribute) to use if Pygments knows it
     """
+    _, ext = os.path.splitext(filename)
     if render_markup and markup.can_render(filename):
-        return markup.render(filename, code)
-
-    try:
-        lexer = get_lexer_for_filename(filename, code)
-    except ClassNotFound:
-        try:
-            lexer = guess_lexer(code)
-        except ClassNotFound:
-            lexer = TextLexer()
+        return _cached(
+            cache,
+            ("markup", blob_sha, ext),
+            lambda: markup.render(filename, code),
+        )
 
-    formatter_cls = {
-        "Python": KlausPythonFormatter,
-    }.get(lexer.name, KlausDefaultFormatter)
+    lexer = get_lexer(code, filename, blob_sha, language)
+    formatter_cls = _get_formatter_class(lexer)
     if ctags:
         ctags_urlscheme = ctags_baseurl + "%(path)s%(fname)s%(fext)s"
     else:
         ctags_urlscheme = None
-    formatter = formatter_cls(
+        ctags_rev = None
+    ctags_language = PYGMENTS_CTAGS_LANGUAGE_MAP.get(lexer.name)
+
+    def render():
+        formatter = formatter_cls(
+            language=ctags_language,
+            ctags=ctags,
+            tagurlformat=ctags_urlscheme,
+        )
+        return highlight(code, lexer, formatter)
+
+    key = (
+        "highlight",
+        blob_sha,
+        ext,
+        lexer.name,
+        formatter_cls.__name__,
+        ctags_language,
+        ctags_urlscheme,
+        ctags_rev,
+        pygments.__version__,
+    )
+    return _cached(cache, key, render)
+
+
+def highlight_blocks(
+    chunks,
+    filename,
+    blob_sha=None,
+    language=None,
+    time_limit=None,
+    block_lines=HIGHLIGHT_BLOCK_LINES,
+    piece_size=HIGHLIGHT_PIECE_SIZE,
+):
+    """Like `highlight_or_render` (without markup and ctags), but for code
+    given as an iterable of strings `chunks`, and yield the HTML in pieces of
+    `block_lines` lines each, so that huge files can be rendered without
+    keeping all of the code or HTML in memory.  The pieces make up a single
+    table, like Pygments' `linenos="table"` output, with one row per piece.
+
+    Pygments lexers need all of their input at once, so the code is lexed in
+    pieces of about `piece_size` characters, which end at blank lines where
+    possible.  Constructs spanning two of them (say, a long string containing
+    blank lines) may be highlighted wrongly.  The lexer is chosen by looking at
+    the first one.
+
+    If highlighting takes longer than `time_limit` seconds of CPU time, the
+    rest of the code is output without highlighting.
+    """
+    pieces = _split_pieces(chunks, piece_size)
+    first_piece = next(pieces, "")
+    lexer = _get_block_lexer(first_piece, filename, blob_sha, language)
+    deadline = _get_deadline(time_limit)
+    tokens = itertools.chain.from_iterable(
+        _get_tokens(lexer, piece, deadline)
+        for piece in itertools.chain([first_piece], pieces)
+    )
+    yield '<div class="highlight"><table class="highlighttable">'
+    lineno = 1
+    for block in _split_lines(tokens, itertools.repeat(block_lines)):
+        yield _format_block(block, lexer, lineno)
+        lineno += block_lines
+    yield "</table></div>"
+
+
+def highlight_lines(
+    code, filename, start, stop, blob_sha=None, language=None, time_limit=None
+):
+    """Highlight lines `start` to `stop` (1-based, inclusive) of `code` only.
+    Return them as table rows like the pieces of `highlight_blocks`, or ''
+    if `code` has fewer than `start` lines.
+
+    Pygments lexers can't start in the middle of a file in general, so the
+    lines before `start` are lexed too, but not formatted.  Lexing stops
+    after `stop`.  (Plain text is lexed from `start`.)
+    """
+    text = _normalize_newlines(code)
+    lexer = _get_block_lexer(code, filename, blob_sha, language)
+    skip_lines = start - 1
+    if isinstance(lexer, TextLexer):
+        position = 0
+        for _ in range(skip_lines):
+            position = text.find("\n", position) + 1
+            if not position:
+                return ""
+        text = text[position:]
+        skip_lines = 0
+    tokens = _get_tokens(lexer, text, _get_deadline(time_limit))
+    sizes = [skip_lines, stop - start + 1] if skip_lines else [stop - start + 1]
+    blocks = list(_split_lines(tokens, sizes))
+    if len(blocks) < len(sizes):
+        return ""
+    return _format_block(blocks[-1], lexer, start)
+
+
+def count_lines(code):
+    """Return the number of lines that `highlight_blocks` shows for `code`."""
+    text = _normalize_newlines(code)
+    return text.count("\n")
+
+
+def _normalize_newlines(code):
+    text = code.replace("\r\n", "\n").replace("\r", "\n")
+    if text and not text.endswith("\n"):
+        text += "\n"
+    return text
+
+
+def _split_pieces(chunks, size):
+    """Join `chunks` (strings), normalize newlines like `_normalize_newlines`
+    and split the result into pieces of whole lines of at least `size`
+    characters.  Pieces end at the first blank line after `size` characters
+    (where lexers are most likely to be back in their initial state), or after
+    `2 * size` characters.
+    """
+    piece = []
+    length = 0
+    for line in _iter_lines(chunks):
+        piece.append(line)
+        length += len(line)
+        if length >= 2 * size or (length >= size and line.isspace()):
+            yield "".join(piece)
+            piece = []
+            length = 0
+    if piece:
+        yield "".join(piece)
+
+
+def _iter_lines(chunks):
+    """Yield the lines of the concatenation of `chunks`, normalized like
+    `_normalize_newlines`.
+    """
+    rest = ""
+    for chunk in chunks:
+        text = rest + chunk
+        # Keep a trailing "\r", it may be the start of a "\r\n".
+        end = len(text) - 1 if text.endswith("\r") else len(text)
+        lines = text[:end].replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        rest = lines.pop() + text[end:]
+        for line in lines:
+            yield line + "\n"
+    if rest:
+        yield from _normalize_newlines(rest).splitlines(keepends=True)
+
+
+def _get_block_lexer(code, filename, blob_sha, language):
+    # Let the lexer keep leading and trailing newlines so that the tokens
+    # add up to the text -- see `_limit_time` -- and line numbers match.
+    return get_lexer(code, filename, blob_sha, language, stripnl=False, ensurenl=False)
+
+
+def _get_deadline(time_limit):
+    if time_limit is None:
+        return None
+    return time.thread_time() + time_limit
+
+
+def _get_tokens(lexer, text, deadline):
+    tokens = lexer.get_tokens(text)
+    if deadline is not None:
+        tokens = _limit_time(tokens, text, deadline)
+    return tokens
+
+
+def _format_block(tokens, lexer, lineno):
+    formatter = _get_formatter_class(lexer)(
         language=PYGMENTS_CTAGS_LANGUAGE_MAP.get(lexer.name),
-        ctags=ctags,
-        tagurlformat=ctags_urlscheme,
+        ctags=None,
+        table_rows_only=True,
+        linenostart=lineno,
+    )
+    return pygments.format(tokens, formatter)
+
+
+def _limit_time(tokens, text, deadline):
+    """Pass on `tokens` (which make up `text`) until the thread's CPU time
+    (see `time.thread_time`) reaches `deadline`, then the rest of `text` as a
+    single token.
+
+    The limit is best-effort: the time is checked between tokens only, so a
+    single token that's slow to lex can overrun it.
+    """
+    position = next_check = 0
+    for ttype, value in tokens:
+        if position >= next_check:
+            if time.thread_time() > deadline:
+                yield Text, text[position:]
+                return
+            next_check = position + _TIME_CHECK_INTERVAL
+        position += len(value)
+        yield ttype, value
+
+
+def _split_lines(tokens, sizes):
+    """Group `tokens` into lists of tokens that make up as many lines as given
+    by `sizes` (an iterable of positive numbers), splitting tokens that span
+    multiple lines as necessary.  Stops consuming `tokens` after the last
+    size.  The last list may be incomplete if `tokens` end early.
+    """
+    sizes = iter(sizes)
+    size = next(sizes, None)
+    block = []
+    num_lines = 0
+    for ttype, value in tokens:
+        while size is not None and value.count("\n") >= size - num_lines:
+            end = -1
+            for _ in range(size - num_lines):
+                end = value.index("\n", end + 1)
+            block.append((ttype, value[: end + 1]))
+            yield block
+            block = []
+            num_lines = 0
+            value = value[end + 1 :]
+            size = next(sizes, None)
+        if size is None:
+            return
+        if value:
+            block.append((ttype, value))
+            num_lines += value.count("\n")
+    if block:
+        yield block
+
+
+def _get_formatter_class(lexer):
+    return {
+        "Python": KlausPythonFormatter,
+    }.get(lexer.name, KlausDefaultFormatter)
+
+
+def get_lexer(code, filename, blob_sha=None, language=None, **options):
+    """Return a Pygments lexer for `code`, looking only at a bounded sample of
+    it.  Tries, in that order: `language`, the file name, a shebang line,
+    Vim or Emacs modelines and Pygments' content-based guessing.
+
+    The choice is cached if `blob_sha` is given.  `options` are passed to the
+    lexer.
+    """
+    if blob_sha is None:
+        return _find_lexer_class(code, filename, language)(**options)
+    key = (os.path.basename(filename), blob_sha, language)
+    lexer_cls = _lexer_cache.get_or_compute(
+        key, lambda: _find_lexer_class(code, filename, language)
     )
+    return lexer_cls(**options)
+
+
+def _find_lexer_class(code, filename, language):
+    sample = code[:LEXER_GUESS_SAMPLE_SIZE]
+    if language:
+        lexer_cls = _find_lexer_class_by_name(language)
+        if lexer_cls is not None:
+            return lexer_cls
+    try:
+        return type(get_lexer_for_filename(filename, sample))
+    except ClassNotFound:
+        pass
+    interpreter = _get_interpreter(sample)
+    if interpreter is not None:
+        # Try 'python3' for 'python3.11'.
+        names = [interpreter, interpreter.rstrip("0123456789.")]
+    else:
+        names = []
+    for name in names + [_get_modeline_filetype(code)]:
+        lexer_cls = _find_lexer_class_by_name(name) if name else None
+        if lexer_cls is not None:
+            return lexer_cls
+    try:
+        return type(guess_lexer(sample))
+    except ClassNotFound:
+        return TextLexer
+
+
+def _find_lexer_class_by_name(name):
+    """Find a lexer by alias ('python3', 'c++') or name ('Emacs Lisp')."""
+    for alias in [name.lower(), name.lower().replace(" ", "-")]:
+        try:
+            return type(get_lexer_by_name(alias))
+        except ClassNotFound:
+            pass
+    return find_lexer_class(name)
+
+
+def _get_interpreter(sample):
+    """Return the interpreter named in the shebang line, like 'python3' for
+    "#!/usr/bin/env python3", or None.
+    """
+    match = _SHEBANG_RE.match(sample)
+    if match is None:
+        return None
+    interpreter = os.path.basename(match.group(1))
+    if interpreter == "env":
+        args = [arg for arg in match.group(2).split() if arg[0] != "-"]
+        args = [arg for arg in args if "=" not in arg]
+        if not args:
+            return None
+        interpreter = os.path.basename(args[0])
+    return interpreter
+
+
+def _get_modeline_filetype(code):
+    """Return the file type from a modeline in the first or last lines."""
+    head = code[:LEXER_GUESS_SAMPLE_SIZE].splitlines()[:5]
+    tail = code[-LEXER_GUESS_SAMPLE_SIZE:].splitlines()[-5:]
+    for line in head[:2]:
+        match = _EMACS_MODELINE_RE.search(line)
+        if match is not None:
+            return match.group(1)
+    for line in head + tail:
+        filetype = get_filetype_from_line(line)
+        if filetype:
+            return filetype
+    return None
+
 
-    return highlight(code, lexer, formatter)
+def _cached(cache, key, render):
+    if cache is None or key[1] is None:
+        return render()
+    html = cache.get(key)
+    if html is None:
+        html = render()
+        cache.set(key, html)
+    return html
@@ -0,0 +1,434 @@
+"""An on-disk index that speeds up path-filtered history queries.
+
+`git log <commit> -- <path>` has to walk the whole commit graph and diff every
+commit against its parent to find the commits that touched `path`.  For a
+rarely touched path in a large repository, that means hundreds of thousands of
+tree diffs per history page.
+
+Similar to Git's commit-graph file, we keep a compact record for every commit:
+
+- its tree SHA, commit time and parents, so that walking the graph doesn't
+  require loading any commit objects, and
+- a Bloom filter of all paths (and their leading directories) changed relative
+  to its first parent.
+
+When walking the history of a path, the Bloom filter tells us for almost every
+commit that it didn't touch the path, without looking at any tree.  Only for
+the few commits that (probably) did, we compare the path's tree entries.
+Still, finding the last few commits of a rarely touched path requires walking
+all of the history.  To make paging through it cheap, walks are kept in memory
+and resumed where the previous page ended.
+
+The index is built in a background thread when it's first used and extended
+incrementally whenever a commit that isn't indexed yet (e.g. a new branch tip)
+is requested.  Until it covers the requested commit, `history` returns None
+and the caller is expected to fall back to `git log`.  The same goes for
+repositories with missing commits (shallow clones), which can't be indexed.
+
+Records are appended to the index file in topological order (parents first),
+which makes the file its own journal: a process that crashes in the middle of
+writing leaves a truncated last record that is ignored on the next load.
+Multiple processes sharing a cache directory coordinate using `flock`.
+"""
+import hashlib
+import heapq
+import os
+import struct
+import threading
+import warnings
+
+from dulwich.diff_tree import tree_changes
+from dulwich.errors import NotTreeError
+from dulwich.object_store import tree_lookup_path
+
+from klaus.cache import LRUCache, MiB
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+MAGIC = b"KLHI\x02"
+
+# Commits that change more paths than this don't get a Bloom filter and are
+# always treated as "may have changed the path" (Git uses 512 too).
+MAX_CHANGED_PATHS = 512
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_NUM_HASHES = 7
+
+# sha, tree, commit time, number of parents, Bloom filter size
+_RECORD_HEADER = struct.Struct(">20s20sqHH")
+_PARENT = struct.Struct(">I")
+_NO_BLOOM = 0xFFFF
+
+
+def _bloom_hashes(path, nbits):
+    digest = hashlib.blake2b(path, digest_size=8).digest()
+    h1, h2 = struct.unpack(">II", digest)
+    return [(h1 + i * h2) % nbits for i in range(BLOOM_NUM_HASHES)]
+
+
+def make_bloom_filter(paths):
+    """Return a Bloom filter (as bytes) containing all of `paths`."""
+    nbytes = max(8, (len(paths) * BLOOM_BITS_PER_ENTRY + 7) // 8)
+    bits = bytearray(nbytes)
+    for path in paths:
+        for bit in _bloom_hashes(path, nbytes * 8):
+            bits[bit // 8] |= 1 << (bit % 8)
+    return bytes(bits)
+
+
+def bloom_filter_may_contain(bloom, path):
+    if bloom is None:
+        return True
+    return all(
+        bloom[bit // 8] & (1 << (bit % 8))
+        for bit in _bloom_hashes(path, len(bloom) * 8)
+    )
+
+
+def _with_leading_directories(path):
+    parts = path.split(b"/")
+    for i in range(1, len(parts) + 1):
+        yield b"/".join(parts[:i])
+
+
+class HistoryIndex:
+    """Changed-paths index of a single repository.
+
+    :param store: object store to read commits and trees from
+        (anything with a thread-safe ``__getitem__``)
+    :param filename: where to persist the index.  If None, the index is kept
+        in memory only.
+    """
+
+    def __init__(self, store, filename=None):
+        self.store = store
+        self.filename = filename
+        # (commit id, path) -> `_HistoryWalk`
+        self._walks = LRUCache(max_bytes=32 * MiB, compute_size=_HistoryWalk.size)
+        self._reset()
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._updating = False
+        # Set if the history can't be indexed, e.g. because parent commits
+        # are missing from a shallow clone.
+        self.disabled = False
+        if filename is not None:
+            self._load()
+
+    def __contains__(self, sha):
+        return sha in self._positions
+
+    def __len__(self):
+        return len(self._shas)
+
+    def _reset(self):
+        # `history` may run concurrently, so start over with new lists rather
+        # than clearing the ones that walks in progress are using.
+        self._positions = {}  # sha -> position in the lists below
+        self._shas = []
+        self._trees = []
+        self._commit_times = []
+        self._parents = []
+        self._blooms = []
+        self._file_offset = len(MAGIC)
+        self._file_valid = False
+        self._walks.clear()
+
+    def history(self, commit_id, path, max_commits=None, skip=0):
+        """Return the ids of the commits that changed `path` (bytes), like
+        `git log --skip=<skip> --max-count=<max_commits> <commit_id> -- <path>`.
+
+        Returns None if the index doesn't cover `commit_id` yet, in which case
+        an update is started in the background, or if it is `disabled`.
+        """
+        if self.disabled:
+            return None
+        if commit_id not in self._positions:
+            self.update_in_background(commit_id)
+            return None
+
+        key = (commit_id, path)
+        walk = self._walks.get(key)
+        if walk is None:
+            walk = _HistoryWalk(self, commit_id, path)
+        results = walk.get(skip, max_commits and skip + max_commits)
+        # Re-add to update the walk's size
+        self._walks.set(key, walk)
+        return results
+
+    def update_in_background(self, commit_id):
+        with self._lock:
+            if self._updating:
+                return
+            self._updating = True
+        thread = threading.Thread(target=self._update_and_reset, args=(commit_id,))
+        thread.daemon = True
+        thread.start()
+
+    def _update_and_reset(self, commit_id):
+        try:
+            self.update(commit_id)
+        except KeyError as e:
+            # Don't try again on every request.
+            self.disabled = True
+            warnings.warn("Can't index history, object %s is missing" % e)
+        finally:
+            self._updating = False
+
+    def update(self, commit_id):
+        """Index `commit_id` and all of its ancestors that aren't indexed yet."""
+        with self._update_lock, self._file_lock():
+            self._load()
+            new_records = []
+            for sha in self._unindexed_ancestors(commit_id):
+                new_records.append(self._add(sha))
+            self._save(new_records)
+
+    def _unindexed_ancestors(self, commit_id):
+        """Yield all unindexed ancestors of `commit_id`, parents first."""
+        stack = [(commit_id, False)]
+        visited = set()
+        while stack:
+            sha, parents_done = stack.pop()
+            if parents_done:
+                yield sha
+                continue
+            if sha in visited or sha in self._positions:
+                continue
+            visited.add(sha)
+            stack.append((sha, True))
+            for parent in reversed(self.store[sha].parents):
+                if parent not in visited and parent not in self._positions:
+                    stack.append((parent, False))
+
+    def _add(self, sha):
+        commit = self.store[sha]
+        parents = tuple(self._positions[parent] for parent in commit.parents)
+        parent_tree = self._trees[parents[0]] if parents else None
+        bloom = self._compute_bloom_filter(parent_tree, commit.tree)
+        record = (sha, commit.tree, commit.commit_time, parents, bloom)
+        self._append(*record)
+        return record
+
+    def _compute_bloom_filter(self, parent_tree, tree):
+        changed_paths = set()
+        for change in tree_changes(self.store, parent_tree, tree):
+            for entry in (change.old, change.new):
+                if entry is not None and entry.path is not None:
+                    changed_paths.update(_with_leading_directories(entry.path))
+            if len(changed_paths) > MAX_CHANGED_PATHS:
+                return None
+        return make_bloom_filter(changed_paths)
+
+    def _append(self, sha, tree, commit_time, parents, bloom):
+        # `history` may run concurrently, so make the commit visible only after
+        # its record is complete.
+        self._shas.append(sha)
+        self._trees.append(tree)
+        self._commit_times.append(commit_time)
+        self._parents.append(parents)
+        self._blooms.append(bloom)
+        self._positions[sha] = len(self._shas) - 1
+
+    def _records(self):
+        return zip(
+            self._shas,
+            self._trees,
+            self._commit_times,
+            self._parents,
+            self._blooms,
+        )
+
+    # Persistence
+
+    def _file_lock(self):
+        return _FileLock(None if self.filename is None else self.filename + ".lock")
+
+    def _load(self):
+        """Read records that have been appended to the index file (possibly by
+        other processes) since we last read it.
+        """
+        if self.filename is None:
+            return
+        try:
+            with open(self.filename, "rb") as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    self._file_valid = False
+                    return
+                self._file_valid = True
+                f.seek(self._file_offset)
+                data = f.read()
+        except OSError:
+            return
+        offset = 0
+        while True:
+            record = _decode_record(data, offset)
+            if record is None:
+                break
+            offset, (sha, *rest) = record
+            if sha in self._positions:
+                # Parents are referred to by position, so the records that
+                # follow can't be trusted either.  Rebuild the index.
+                warnings.warn("Duplicate commit in %s, rebuilding" % self.filename)
+                self._reset()
+                return
+            self._append(sha, *rest)
+        self._file_offset += offset
+
+    def _save(self, records):
+        if self.filename is None or not records:
+            return
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename, "ab") as f:
+            if not self._file_valid:
+                # Missing, empty or incompatible file: (Re)write it from scratch.
+                f.truncate(0)
+                f.write(MAGIC)
+                self._file_offset = len(MAGIC)
+                self._file_valid = True
+                records = self._records()
+            elif f.tell() != self._file_offset:
+                # Drop a truncated record left by a crashed writer.
+                f.truncate(self._file_offset)
+            data = b"".join(_encode_record(*record) for record in records)
+            f.write(data)
+        self._file_offset += len(data)
+
+
+def _encode_record(sha, tree, commit_time, parents, bloom):
+    return b"".join(
+        [
+            _RECORD_HEADER.pack(
+                bytes.fromhex(sha.decode("ascii")),
+                bytes.fromhex(tree.decode("ascii")),
+                commit_time,
+                len(parents),
+                _NO_BLOOM if bloom is None else len(bloom),
+            ),
+            b"".join(_PARENT.pack(parent) for parent in parents),
+            bloom or b"",
+        ]
+    )
+
+
+def _decode_record(data, offset):
+    if len(data) < offset + _RECORD_HEADER.size:
+        return None
+    sha, tree, commit_time, nparents, bloom_size = _RECORD_HEADER.unpack_from(
+        data, offset
+    )
+    offset += _RECORD_HEADER.size
+    parents_size = nparents * _PARENT.size
+    bloom_bytes = 0 if bloom_size == _NO_BLOOM else bloom_size
+    if len(data) < offset + parents_size + bloom_bytes:
+        return None
+    parents = tuple(
+        _PARENT.unpack_from(data, offset + i * _PARENT.size)[0] for i in range(nparents)
+    )
+    offset += parents_size
+    bloom = None if bloom_size == _NO_BLOOM else data[offset : offset + bloom_bytes]
+    offset += bloom_bytes
+    return offset, (
+        sha.hex().encode("ascii"),
+        tree.hex().encode("ascii"),
+        commit_time,
+        parents,
+        bloom,
+    )
+
+
+class _HistoryWalk:
+    """A resumable walk over the history of `path`, see `HistoryIndex.history`.
+
+    Keeps its own references to the index's lists, so it's unaffected by
+    `HistoryIndex._reset`.
+    """
+
+    def __init__(self, index, commit_id, path):
+        self.store = index.store
+        self.path = path
+        self._shas = index._shas
+        self._trees = index._trees
+        self._commit_times = index._commit_times
+        self._parents = index._parents
+        self._blooms = index._blooms
+        start = index._positions[commit_id]
+        self._results = []  # positions of the commits shown so far
+        self._counter = 0
+        self._queue = [(-self._commit_times[start], self._counter, start)]
+        # Records are in topological order, so all ancestors come before `start`.
+        self._seen = bytearray(start + 1)
+        self._seen[start] = 1
+        self._lock = threading.Lock()
+
+    def size(self):
+        return len(self._seen) + 50 * (len(self._queue) + len(self._results))
+
+    def get(self, start, stop=None):
+        """Return the ids of the shown commits ``[start:stop]``, walking
+        further as needed.
+        """
+        with self._lock:
+            while self._queue and (stop is None or len(self._results) < stop):
+                _, _, pos = heapq.heappop(self._queue)
+                shown, parents = self._simplify(pos)
+                if shown:
+                    self._results.append(pos)
+                for parent in parents:
+                    if not self._seen[parent]:
+                        self._seen[parent] = 1
+                        self._counter += 1
+                        heapq.heappush(
+                            self._queue,
+                            (-self._commit_times[parent], self._counter, parent),
+                        )
+            return [self._shas[pos] for pos in self._results[start:stop]]
+
+    def _simplify(self, pos):
+        """Git's default history simplification: Return whether the commit at
+        `pos` is to be shown, and which of its parents to follow.
+
+        A commit that is TREESAME (has the same `path` contents) as one of its
+        parents is hidden and only that parent is followed.  Root commits are
+        shown if they contain `path`.
+        """
+        parents = self._parents[pos]
+        if not parents:
+            return self._lookup(self._trees[pos]) is not None, ()
+        entry = NOT_LOOKED_UP = object()
+        for i, parent in enumerate(parents):
+            if i == 0 and not bloom_filter_may_contain(self._blooms[pos], self.path):
+                return False, (parent,)
+            if entry is NOT_LOOKED_UP:
+                entry = self._lookup(self._trees[pos])
+            if entry == self._lookup(self._trees[parent]):
+                return False, (parent,)
+        return True, parents
+
+    def _lookup(self, tree_id):
+        try:
+            return tuple(tree_lookup_path(self.store.__getitem__, tree_id, self.path))
+        except (KeyError, NotTreeError):
+            return None
+
+
+class _FileLock:
+    """Exclusive inter-process lock on `filename` (no-op if None or on Windows)."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+
+    def __enter__(self):
+        if self.filename is not None and fcntl is not None:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            self._file = open(self.filename, "a")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
@@ -1,6 +1,8 @@
-import functools
+import contextlib
+import hashlib
 import io
 import os
+import re
 import stat
 import subprocess
 import threading
@@ -8,8 +10,7 @@ import threading
 import dulwich
 import dulwich.patch
 from dulwich.errors import NotTreeError
-from dulwich.object_store import tree_lookup_path
-from dulwich.objects import S_ISGITLINK, Blob
+from dulwich.objects import S_ISGITLINK, Blob, ShaFile, object_class
 
 try:
     from dulwich.refs import SymrefLoop
@@ -19,7 +20,15 @@ else:
     InaccessibleRef = (SymrefLoop, KeyError)  # type: ignore
 
 
-from klaus.diff import render_diff
+from klaus.cache import DiskCache, LRUCache, MiB, ResultCache
+from klaus.catfile import CatFilePool
+from klaus.diff import (
+    compact_file_change,
+    dump_compact_diff,
+    load_diff,
+    render_diff,
+)
+from klaus.historyindex import HistoryIndex
 from klaus.utils import (
     decode_from_git,
     encode_for_git,
@@ -30,38 +39,189 @@ from klaus.utils import (
 
 NOT_SET = "__not_set__"
 
+# When looking for a cached blame of an unchanged file, give up after
+# looking at this many ancestors.
+MAX_BLAME_CACHE_LOOKBEHIND = 20
+
+# Diffs that are larger than this (roughly, in bytes) aren't cached, so that
+# computing them doesn't need memory proportional to their size.
+MAX_CACHED_DIFF_SIZE = 8 * MiB
+
+SHA1_RE = re.compile("^[0-9a-f]{40}$")
+
+# Names of refs that live directly in the Git directory, like "ORIG_HEAD".
+PSEUDO_REF_RE = re.compile("^[A-Z]+(_[A-Z]+)*$")
+
+# Commit times never change, so this can be shared by all repositories.
+_commit_time_cache = LRUCache(max_entries=100000)
+
+# Parsed trees and path lookups, shared by all repositories as trees never
+# change.  Only entries reachable from commits of a repository are ever looked
+# up through that repository, so sharing them doesn't leak objects.
+_tree_cache = LRUCache(
+    max_bytes=64 * MiB, compute_size=lambda tree: 100 * len(tree) + 100
+)
+# Maps `(root tree SHA, path)` to `(mode, SHA)`
+_path_cache = LRUCache(max_entries=100000)
+
+# Maps tree SHAs to `(dirs, submodules, files)`, each a sorted tuple of names
+_listing_cache = LRUCache(
+    max_bytes=32 * MiB,
+    compute_size=lambda listing: sum(
+        50 + len(name) for names in listing for name in names
+    ),
+)
+
+# Maps ref target SHAs to `(peeled SHA, commit or tag time)`.  Like commit
+# times, these never change, so rebuilding a `RefSnapshot` after a single ref
+# was updated only needs to load the objects of the refs that changed.
+_ref_target_cache = LRUCache(max_entries=100000)
 
-def cached_call(key, validator, producer, _cache={}):
-    data, old_validator = _cache.get(key, (None, NOT_SET))
-    if old_validator != validator:
-        data = producer()
-    _cache[key] = (data, validator)
-    return data
+# Maps `.gitattributes` blob SHAs to their parsed rules, see `_parse_gitattributes`.
+_gitattributes_cache = LRUCache(max_entries=10000)
 
 
-def synchronized(func, lock=threading.RLock()):
-    @functools.wraps(func)
-    def synchronized_func(*args, **kwargs):
-        with lock:
-            return func(*args, **kwargs)
+# Dulwich's object store is not thread-safe: pack files are read through a
+# shared file object, and the pack list is refreshed in place on cache misses.
+# Rather than serializing object reads, every `FancyRepo` keeps a pool of
+# Dulwich repositories and lends one to each concurrent reader, see
+# `FancyRepo._dulwich_repo`.  Everything else (refs, config files, `git`
+# subprocesses) is safe to use concurrently anyway.
 
-    return synchronized_func
+
+class RefSnapshot:
+    """An immutable view of the refs of a repository at some point in time.
+
+    :attr refs: dict mapping full ref names to the SHAs they point at
+    :attr peeled: dict mapping full ref names to the SHAs they point at,
+        with annotated tags resolved to their target objects
+    :attr names: full ref names, most recently committed/tagged first
+    :attr revs: dict mapping each name a ref can be referred to by in URLs
+        (as in `FancyRepo.get_commit`) to the SHAs of the refs of that name,
+        in lookup order: "x" may be "refs/heads/x", "refs/tags/x" or "x".
+    :attr token: string that changes whenever any of the refs changes
+    """
+
+    def __init__(self, refs, targets, signature):
+        self.refs = refs
+        self.peeled = {name: peeled for name, (peeled, _) in targets.items()}
+        self.names = sorted(refs, key=lambda name: (-targets[name][1], name))
+        self.token = hashlib.sha1(repr(sorted(refs.items())).encode()).hexdigest()
+        self.signature = signature
+
+        self.revs = {}
+        for prefix in [b"refs/heads/", b"refs/tags/", b""]:
+            for name, sha in refs.items():
+                if name.startswith(prefix):
+                    rev = decode_from_git(name[len(prefix) :])
+                    self.revs.setdefault(rev, []).append(sha)
+        # Trie of `revs` by path segment.  Each node is a dict mapping path
+        # segments to child nodes; nodes for complete rev names have the
+        # rev name stored under the `None` key.
+        self._trie = {}
+        for rev in self.revs:
+            node = self._trie
+            for segment in rev.split("/"):
+                node = node.setdefault(segment, {})
+            node[None] = rev
+
+    def match_revs(self, rev_and_path):
+        """Return the rev names in `revs` that `rev_and_path` starts with (at
+        path segment boundaries), longest first.
+        """
+        matches = []
+        node = self._trie
+        for segment in rev_and_path.split("/"):
+            node = node.get(segment)
+            if node is None:
+                break
+            if None in node:
+                matches.append(node[None])
+        return matches[::-1]
+
+    def get_names(self, prefix, exclude=None):
+        """Return the names of the refs below `prefix` (without `prefix`),
+        most recently committed/tagged first, except for `exclude`.
+        """
+        prefix = encode_for_git(prefix.rstrip("/") + "/")
+        names = [
+            decode_from_git(name[len(prefix) :])
+            for name in self.names
+            if name.startswith(prefix)
+        ]
+        if exclude is not None:
+            names = [name for name in names if name != exclude]
+        return names
 
 
 class FancyRepo:
-    """A wrapper around Dulwich's Repo that adds some helper methods."""
+    """A wrapper around Dulwich's Repo that adds some helper methods.
 
-    def __init__(self, path, namespace):
+    :param cache_dir: directory to persist caches and indexes of all
+        repositories in, or None to not persist anything
+    """
+
+    def __init__(self, path, namespace, cache_dir=None):
         self.dulwich_repo = dulwich.repo.Repo(path)
+        # Idle Dulwich repositories for reading objects, one for each thread
+        # that read objects concurrently so far.
+        self._dulwich_repos = [dulwich.repo.Repo(path)]
+        self._ref_snapshot_lock = threading.Lock()
         self.namespace = namespace
+        self._cat_file = CatFilePool(path)
+        if cache_dir is None:
+            self.cache_dir = None
+            self._history_index = None
+            blame_disk_cache = None
+            diff_disk_cache = None
+        else:
+            path_hash = hashlib.sha1(encode_for_git(os.path.abspath(path)))
+            self.cache_dir = os.path.join(
+                cache_dir, f"{self.name}-{path_hash.hexdigest()}"
+            )
+            self._history_index = HistoryIndex(
+                self, os.path.join(self.cache_dir, "history-index")
+            )
+            blame_disk_cache = DiskCache(os.path.join(self.cache_dir, "blame"))
+            diff_disk_cache = DiskCache(os.path.join(self.cache_dir, "diff"))
+        self._blame_cache = ResultCache(
+            16 * MiB,
+            compute_size=lambda line_commits: 50 * len(line_commits),
+            disk_cache=blame_disk_cache,
+            dumps=lambda line_commits: "\n".join(line_commits).encode("ascii"),
+            loads=lambda data: data.decode("ascii").split("\n") if data else [],
+        )
+        # Values are `dump_compact_diff` output, which is much more compact than the
+        # dicts returned by `commit_diff`.
+        self._diff_cache = ResultCache(
+            32 * MiB,
+            compute_size=len,
+            disk_cache=diff_disk_cache,
+            dumps=bytes,
+            loads=bytes,
+        )
+        # Keyed by the description file's mtime, so changes invalidate it.
+        self._description_cache = LRUCache(max_entries=1)
+        self._ref_snapshot = None
 
-    @synchronized
     def __getattr__(self, attr):
         return getattr(self.dulwich_repo, attr)
 
-    @synchronized
     def __getitem__(self, key):
-        return self.dulwich_repo[key]
+        with self._dulwich_repo() as repo:
+            return repo[key]
+
+    @contextlib.contextmanager
+    def _dulwich_repo(self):
+        """Lend a Dulwich repository for reading objects to the calling thread."""
+        try:
+            repo = self._dulwich_repos.pop()
+        except IndexError:
+            repo = dulwich.repo.Repo(self.dulwich_repo.path)
+        try:
+            yield repo
+        finally:
+            self._dulwich_repos.append(repo)
 
     @property
     def name(self):
@@ -75,7 +235,6 @@ class FancyRepo:
             return self.name
 
     # TODO: factor out stuff into dulwich
-    @synchronized
     def get_last_updated_at(self):
         """Get datetime of last commit to this repository.
 
@@ -85,17 +244,19 @@ class FancyRepo:
         """
 
         def _get_commit_time_cached(ref_id):
-            return cached_call(
-                key=(ref_id, "_get_commit_time"),
-                validator=None,
-                producer=lambda: _get_commit_time(ref_id),
-            )
+            try:
+                return _commit_time_cache.get_or_compute(
+                    ref_id, lambda: _get_commit_time(ref_id)
+                )
+            except KeyError:
+                # Missing object.  Not cached: other repositories may have it.
+                return None
 
         def _get_commit_time(ref_id):
             try:
                 return self[ref_id].commit_time
-            except (KeyError, AttributeError):
-                # Missing or non-commit object
+            except AttributeError:
+                # Non-commit object
                 return None
 
         max_refs = 1000
@@ -122,7 +283,6 @@ class FancyRepo:
             return None
 
     @property
-    @synchronized
     def cloneurl(self):
         """Retrieve the gitweb notion of the public clone URL of this repo."""
         f = self.dulwich_repo.get_named_file("cloneurl")
@@ -134,7 +294,6 @@ class FancyRepo:
         except KeyError:
             return None
 
-    @synchronized
     def get_description(self):
         """Like Dulwich's `get_description`, but returns None if the file
         contains Git's default text "Unnamed repository[...]".
@@ -147,10 +306,8 @@ class FancyRepo:
         except OSError:
             description_mtime = None
 
-        return cached_call(
-            key=(id(self), "get_description"),
-            validator=description_mtime,
-            producer=self._get_description,
+        return self._description_cache.get_or_compute(
+            description_mtime, self._get_description
         )
 
     def _get_description(self):
@@ -160,13 +317,25 @@ class FancyRepo:
             if not description.startswith("Unnamed repository;"):
                 return force_unicode(description)
 
-    @synchronized
     def get_commit(self, rev):
         """Get commit object identified by `rev` (SHA or branch or tag name)."""
-        for prefix in ["refs/heads/", "refs/tags/", ""]:
-            key = prefix + rev
+        snapshot = self.get_ref_snapshot()
+        if rev in snapshot.revs or SHA1_RE.match(rev):
+            candidates = snapshot.revs.get(rev, [])
+            if SHA1_RE.match(rev):
+                candidates = candidates + [encode_for_git(rev)]
+        else:
+            # Not a ref we know of, like "FETCH_HEAD"
+            candidates = [
+                encode_for_git(prefix + rev)
+                for prefix in ["refs/heads/", "refs/tags/", ""]
+            ]
+            sha = self._read_pseudo_ref(rev)
+            if sha is not None:
+                candidates.append(sha)
+        for key in candidates:
             try:
-                obj = self[encode_for_git(key)]
+                obj = self[key]
                 if isinstance(obj, dulwich.objects.Tag):
                     obj = self[obj.object[1]]
                 return obj
@@ -174,7 +343,42 @@ class FancyRepo:
                 pass
         raise KeyError(rev)
 
-    @synchronized
+    def _read_pseudo_ref(self, name):
+        """Return the SHA that pseudo-ref `name` (like "FETCH_HEAD", which
+        Dulwich doesn't read) points to, or None.
+        """
+        if not PSEUDO_REF_RE.match(name):
+            return None
+        try:
+            with open(os.path.join(self.dulwich_repo.controldir(), name), "rb") as f:
+                # FETCH_HEAD has more information after the first SHA.
+                sha = f.read(40)
+        except OSError:
+            return None
+        return sha if SHA1_RE.match(sha.decode("ascii", "replace")) else None
+
+    def split_rev_and_path(self, rev_and_path):
+        """Split `rev_and_path`, like "master/some/file", into the longest
+        prefix that's a valid rev and the rest.
+
+        Returns a `(rev, path, commit)` tuple; raises KeyError if no prefix
+        of `rev_and_path` is a valid rev.  Besides the names of refs, only the
+        first path segment is tried, as a SHA or a name that isn't below
+        `refs/` like "FETCH_HEAD".
+        """
+        candidates = self.get_ref_snapshot().match_revs(rev_and_path)
+        first_segment = rev_and_path.split("/", 1)[0]
+        if first_segment not in candidates:
+            candidates.append(first_segment)
+        for rev in candidates:
+            try:
+                commit = self.get_commit(rev)
+            except (OSError, KeyError):
+                # Ref pointing to a non-existing object; try a shorter prefix.
+                continue
+            return rev, rev_and_path[len(rev) :].strip("/"), commit
+        raise KeyError(rev_and_path)
+
     def get_default_branch(self):
         """Tries to guess the default repo branch name."""
         for candidate in ["master", "main", "trunk", "default", "gh-pages"]:
@@ -185,49 +389,104 @@ class FancyRepo:
                 pass
         return None
 
-    @synchronized
-    def get_ref_names_ordered_by_last_commit(self, prefix, exclude=None):
-        """Return a list of ref names that begin with `prefix`, ordered by the
-        time they have been committed to last.
-        """
+    def get_ref_snapshot(self):
+        """Return a `RefSnapshot` of the current refs.
 
-        def get_commit_time(refname):
+        Snapshots are cached until `HEAD`, `packed-refs` or any of the
+        directories below `refs/` change.  Git updates loose refs by renaming
+        lock files, which changes the modification time of the directory the
+        ref lives in, so checking whether the snapshot is up to date takes a
+        few `stat` calls, independent of the number of refs.
+        """
+        snapshot = self._ref_snapshot
+        if snapshot is not None and snapshot.signature == self._get_refs_signature(
+            snapshot.signature
+        ):
+            return snapshot
+        return self._build_ref_snapshot()
+
+    def _get_refs_signature(self, previous=None):
+        """Return the `(path, stat result)` pairs of all files and directories
+        whose modification indicates a change to refs.  If `previous` is
+        given, reuse its list of directories instead of walking `refs/`.
+        """
+        if previous is None:
+            refs_dir = os.path.join(self.dulwich_repo.commondir(), "refs")
+            paths = [dirpath for dirpath, _, _ in os.walk(refs_dir)]
+            paths.append(os.path.join(self.dulwich_repo.commondir(), "packed-refs"))
+            paths.append(os.path.join(self.dulwich_repo.controldir(), "HEAD"))
+        else:
+            paths = [path for path, _ in previous]
+        signature = []
+        for path in paths:
             try:
-                obj = self[refs[refname]]
-            except InaccessibleRef:
-                # Default to 0, i.e. sorting refs that point at non-existant
-                # objects last.
-                return 0
+                st = os.stat(path)
+                signature.append((path, (st.st_ino, st.st_size, st.st_mtime_ns)))
+            except OSError:
+                signature.append((path, None))
+        return tuple(signature)
+
+    def _build_ref_snapshot(self):
+        with self._ref_snapshot_lock:
+            # Take the signature *before* reading refs, so that concurrent
+            # modifications lead to a rebuild on the next call.
+            signature = self._get_refs_signature()
+            # Another thread may have built the snapshot while we were waiting.
+            snapshot = self._ref_snapshot
+            if snapshot is not None and snapshot.signature == signature:
+                return snapshot
+            refs = self.dulwich_repo.refs.as_dict()
+            targets = {name: self._get_ref_target(sha) for name, sha in refs.items()}
+            self._ref_snapshot = RefSnapshot(refs, targets, signature)
+            return self._ref_snapshot
+
+    def _get_ref_target(self, sha):
+        """Return `(peeled SHA, commit or tag time)` for a ref pointing to
+        `sha`.  Refs that point at non-existant objects get a time of 0,
+        sorting them last.
+        """
+        target = _ref_target_cache.get(sha)
+        if target is not None:
+            return target
+        try:
+            obj = self[sha]
             if isinstance(obj, dulwich.objects.Tag):
-                return obj.tag_time
-            return obj.commit_time
+                timestamp = obj.tag_time
+                while isinstance(obj, dulwich.objects.Tag):
+                    obj = self[obj.object[1]]
+            else:
+                timestamp = getattr(obj, "commit_time", 0)
+        except InaccessibleRef:
+            # Not cached: other repositories may have the object.
+            return sha, 0
+        _ref_target_cache.set(sha, (obj.id, timestamp))
+        return obj.id, timestamp
 
-        refs = self.dulwich_repo.refs.as_dict(encode_for_git(prefix))
-        if exclude:
-            refs.pop(prefix + exclude, None)
-        sorted_names = sorted(refs.keys(), key=get_commit_time, reverse=True)
-        return [decode_from_git(ref) for ref in sorted_names]
+    def get_ref_names_ordered_by_last_commit(self, prefix, exclude=None):
+        """Return a list of ref names that begin with `prefix`, ordered by the
+        time they have been committed to last.
+        """
+        return self.get_ref_snapshot().get_names(prefix, exclude)
 
-    @synchronized
     def get_branch_names(self, exclude=None):
         """Return a list of branch names of this repo, ordered by the time they
         have been committed to last.
         """
         return self.get_ref_names_ordered_by_last_commit("refs/heads", exclude)
 
-    @synchronized
     def get_tag_names(self):
         """Return a list of tag names of this repo, ordered by creation time."""
         return self.get_ref_names_ordered_by_last_commit("refs/tags")
 
-    @synchronized
     def get_tag_and_branch_shas(self):
         """Return a list of SHAs of all tags and branches."""
-        tag_shas = self.dulwich_repo.refs.as_dict(b"refs/tags/").values()
-        branch_shas = self.dulwich_repo.refs.as_dict(b"refs/heads/").values()
-        return set(tag_shas) | set(branch_shas)
+        refs = self.get_ref_snapshot().refs
+        return {
+            sha
+            for name, sha in refs.items()
+            if name.startswith((b"refs/tags/", b"refs/heads/"))
+        }
 
-    @synchronized
     def history(self, commit, path=None, max_commits=None, skip=0):
         """Return a list of all commits that affected `path`, starting at branch
         or commit `commit`. `skip` can be used for pagination, `max_commits`
@@ -241,6 +500,16 @@ class FancyRepo:
         #     about 0.15s on my machine whereas the history() method needs 5s.
         #     Therefore we use `git log` here until dulwich gets faster.
         #     For the pure-Python implementation, see the 'purepy-hist' branch.
+        #
+        #     For path-filtered history, the changed-paths index (if enabled,
+        #     see `klaus.historyindex`) beats `git log` on large repositories.
+        if path and self._history_index is not None:
+            sha1_sums = self._history_index.history(
+                commit.id, encode_for_git(path), max_commits, skip
+            )
+            if sha1_sums is not None:
+                return self.get_objects(sha1_sums)
+            # Else: not indexed yet; the index is being updated in the background.
 
         cmd = ["git", "log", "--format=%H"]
         if skip:
@@ -251,144 +520,445 @@ class FancyRepo:
         if path:
             cmd.extend(["--", path])
 
-        output = subprocess.check_output(cmd, cwd=os.path.abspath(self.path))
-        sha1_sums = output.strip().split(b"\n")
-        return [self[sha1] for sha1 in sha1_sums]
+        output = self._run_git(cmd)
+        return self.get_objects(output.split())
 
-    @synchronized
     def blame(self, commit, path):
         """Return a 'git blame' list for the file at `path`: For each line in
         the file, the list contains the commit that last changed that line.
+
+        Results are cached.  If the file is unchanged from an ancestor whose
+        blame is cached, that blame is reused without running `git blame`.
+        """
+        line_commits = self._blame_cache.get((commit.id, path))
+        if line_commits is None:
+            line_commits = self._get_cached_ancestor_blame(commit, path)
+            if line_commits is None:
+                line_commits = self._run_blame(commit, path)
+            self._blame_cache.set((commit.id, path), line_commits)
+        # Callers may modify the list
+        return list(line_commits)
+
+    def _get_cached_ancestor_blame(self, commit, path):
+        """Follow the first-parent chain as long as the file's blob is unchanged
+        and return the first cached blame found.  (Git passes the whole blame to
+        the first parent if the blob is identical, so the blame is the same.)
         """
+        try:
+            blob = self.lookup_path(commit.tree, path)
+        except KeyError:
+            return None
+        for _ in range(MAX_BLAME_CACHE_LOOKBEHIND):
+            if not commit.parents:
+                return None
+            parent = self[commit.parents[0]]
+            try:
+                parent_blob = self.lookup_path(parent.tree, path)
+            except KeyError:
+                return None
+            if parent_blob != blob:
+                return None
+            line_commits = self._blame_cache.get((parent.id, path))
+            if line_commits is not None:
+                return line_commits
+            commit = parent
+        return None
+
+    def _run_blame(self, commit, path):
         # XXX see comment in `.history()`
         cmd = ["git", "blame", "-ls", "--root", decode_from_git(commit.id), "--", path]
-        output = subprocess.check_output(cmd, cwd=os.path.abspath(self.path))
-        sha1_sums = [line[:40] for line in output.strip().split(b"\n") if line]
+        output = self._run_git(cmd)
         return [
-            None if self[sha1] is None else decode_from_git(self[sha1].id)
-            for sha1 in sha1_sums
+            decode_from_git(line[:40]) for line in output.strip().split(b"\n") if line
         ]
 
-    @synchronized
+    def get_objects(self, shas):
+        """Return the objects for `shas`, read in one go by a `git cat-file`
+        process from the pool.
+        """
+        return [
+            ShaFile.from_raw_string(object_class(type_name).type_num, data, sha)
+            for sha, type_name, data in self._cat_file.read_objects(shas)
+        ]
+
+    def get_object_info(self, sha):
+        """Return `(type name, size)` of the object `sha` without reading it."""
+        return self._cat_file.object_info(sha)
+
+    def iter_blob(self, sha, start=0, stop=None):
+        """Yield the contents of blob `sha` (or the bytes `start` to `stop`
+        of it) in pieces, without reading the whole blob into memory.
+        """
+        return self._cat_file.iter_blob(sha, start, stop)
+
+    def _run_git(self, cmd):
+        """Run a `git` command in this repository and return its output."""
+        return subprocess.check_output(cmd, cwd=os.path.abspath(self.path))
+
     def get_blob_or_tree(self, commit, path):
         """Return the Git tree or blob object for `path` at `commit`."""
-        try:
-            (mode, oid) = tree_lookup_path(
-                self.dulwich_repo.__getitem__, commit.tree, encode_for_git(path)
-            )
-        except NotTreeError:
-            # Some part of the path was a file where a folder was expected.
-            # Example: path="/path/to/foo.txt" but "to" is a file in "/path".
-            raise KeyError
+        mode, oid = self.lookup_path(commit.tree, path)
+        if stat.S_ISDIR(mode):
+            return self.get_tree(oid)
         return self[oid]
 
-    @synchronized
-    def listdir(self, commit, path):
+    def get_attributes(self, commit, path):
+        """Return the Git attributes of `path` at `commit` as a dict, as set by
+        the `.gitattributes` files in the commit: `True` for set attributes,
+        `False` for unset ones, or the value (str).
+
+        Attribute macros aren't supported.
+        """
+        if isinstance(path, str):
+            path = encode_for_git(path)
+        parts = [part for part in path.split(b"/") if part]
+        attributes = {}
+        for depth in range(len(parts)):
+            entry = self._lookup_file(
+                commit.tree, b"/".join(parts[:depth] + [b".gitattributes"])
+            )
+            if entry is None:
+                continue
+            rules = _gitattributes_cache.get(entry[1])
+            if rules is None:
+                rules = _parse_gitattributes(self._get_blob(entry[1]).data)
+                _gitattributes_cache.set(entry[1], rules)
+            relpath = decode_from_git(b"/".join(parts[depth:]))
+            basename = relpath.rpartition("/")[2]
+            for regex, anchored, rule_attributes in rules:
+                if regex.match(relpath if anchored else basename):
+                    for name, value in rule_attributes:
+                        if value is None:
+                            attributes.pop(name, None)
+                        else:
+                            attributes[name] = value
+        return attributes
+
+    def get_tree(self, sha):
+        """Return the (cached) tree object `sha`.  Must not be modified.
+
+        Raises NotTreeError if `sha` is not a tree.
+        """
+        tree = _tree_cache.get(sha)
+        if tree is None:
+            tree = self[sha]
+            if not isinstance(tree, dulwich.objects.Tree):
+                raise NotTreeError(sha)
+            _tree_cache.set(sha, tree)
+        return tree
+
+    def lookup_path(self, tree_sha, path):
+        """Return the `(mode, SHA)` of the entry at `path` in tree `tree_sha`,
+        like dulwich's `tree_lookup_path`.
+
+        Lookups are cached, as are the lookups of all parent directories, so
+        looking up other entries of the same directory later only needs to
+        look at that directory.  Raises KeyError if there's no such entry.
+        """
+        if isinstance(path, str):
+            path = encode_for_git(path)
+        path = b"/".join(part for part in path.split(b"/") if part)
+        if not path:
+            return stat.S_IFDIR, tree_sha
+        key = (tree_sha, path)
+        entry = _path_cache.get(key)
+        if entry is None:
+            parent, _, name = path.rpartition(b"/")
+            _, parent_sha = self.lookup_path(tree_sha, parent)
+            try:
+                entry = self.get_tree(parent_sha)[name]
+            except NotTreeError:
+                # Some part of the path was a file where a folder was expected.
+                # Example: path="/path/to/foo.txt" but "to" is a file in "/path".
+                raise KeyError(path)
+            _path_cache.set(key, entry)
+        return entry
+
+    def listdir(self, commit, path, offset=0, limit=None, around=None):
         """Return a list of submodules, directories and files in given
         directory: Lists of (link name, target path) tuples.
+
+        If `limit` is given, at most `limit` entries starting at `offset` are
+        returned, counting directories first, then submodules, then files.
+        If `around` is given instead of `offset`, the window of `limit`
+        entries that contains the entry named `around` is returned.  The
+        result contains the window's "offset", the "total" number of entries,
+        and the "next_offset" of the following window (or None).
         """
+        tree_sha = self.lookup_path(commit.tree, path)[1]
+        listing = _listing_cache.get(tree_sha)
+        if listing is None:
+            listing = self._list_tree(tree_sha)
+            _listing_cache.set(tree_sha, listing)
+        total = sum(map(len, listing))
+
+        if limit is None:
+            offset, limit = 0, total
+        elif around is not None:
+            start = 0
+            for names in listing:
+                if around in names:
+                    offset = (start + names.index(around)) // limit * limit
+                    break
+                start += len(names)
+        offset = max(0, min(offset, total))
+        end = min(offset + limit, total)
+
+        result = {"dirs": [], "submodules": [], "files": []}
+        start = 0
+        for kind, names in zip(["dirs", "submodules", "files"], listing):
+            for name in names[max(offset - start, 0) : max(end - start, 0)]:
+                result[kind].append((name, path + "/" + name if path else name))
+            start += len(names)
+
+        if path and offset == 0:
+            result["dirs"].insert(0, ("..", parent_directory(path)))
+
+        result.update(
+            offset=offset,
+            limit=limit,
+            total=total,
+            next_offset=end if end < total else None,
+        )
+        return result
+
+    def _list_tree(self, tree_sha):
         submodules, dirs, files = [], [], []
-        for entry_rel in self.get_blob_or_tree(commit, path).items():
-            # entry_rel: Entry('foo.txt', ...)
-            # entry_abs: Entry('spam/eggs/foo.txt', ...)
-            entry_abs = entry_rel.in_path(encode_for_git(path))
-            path_str = decode_from_git(entry_abs.path)
-            item = (os.path.basename(path_str), path_str)
-            if S_ISGITLINK(entry_abs.mode):
-                submodules.append(item)
-            elif stat.S_ISDIR(entry_abs.mode):
-                dirs.append(item)
+        for entry in self.get_tree(tree_sha).items():
+            name = decode_from_git(entry.path)
+            if S_ISGITLINK(entry.mode):
+                submodules.append(name)
+            elif stat.S_ISDIR(entry.mode):
+                dirs.append(name)
             else:
-                files.append(item)
+                files.append(name)
+        return tuple(
+            tuple(sorted(names, key=str.lower)) for names in (dirs, submodules, files)
+        )
 
-        def keyfunc(tpl):
-            return tpl[0].lower()
+    def commit_diff(self, commit):
+        """Return the list of changes introduced by `commit`.
 
-        submodules.sort(key=keyfunc)
-        files.sort(key=keyfunc)
-        dirs.sort(key=keyfunc)
+        Diffs are cached by the trees they compare.
+        """
+        cached = self.get_cached_commit_diff(commit)
+        if cached is not None:
+            return cached
+        summary, file_changes = self.iter_commit_diff(commit)
+        return summary, list(file_changes)
+
+    def get_cached_commit_diff(self, commit, budget=None):
+        """Return the cached `commit_diff` output for `commit`, or None.
+
+        With a `budget` (see `iter_commit_diff`), a complete diff is only
+        returned if it is within the budget's "files" and "lines" limits;
+        otherwise, the diff cached by `iter_commit_diff` with the same
+        budget, with some files deferred, is returned if there is one.
+        """
+        key = self._get_diff_key(commit)
+        data = self._diff_cache.get(key)
+        if data is not None:
+            diff = load_diff(data)
+            if budget is None or (
+                diff[0]["nfiles"] <= budget.get("files", float("inf"))
+                and diff[0]["nadditions"] + diff[0]["ndeletions"]
+                <= budget.get("lines", float("inf"))
+            ):
+                return diff
+        if budget is None:
+            return None
+        data = self._diff_cache.get(self._get_budgeted_diff_key(key, budget))
+        if data is None:
+            return None
+        return load_diff(data)
+
+    def iter_commit_diff(self, commit, budget=None):
+        """Like `commit_diff`, but return an iterator of file changes instead of
+        a list.  Each file's diff is only computed when the iterator gets to it,
+        and the summary is only complete once the iterator is exhausted.
+
+        `budget` may be a dict that limits the number of "files", diff "lines"
+        and blob "bytes" to diff.  Once it is exhausted, the diffs of all
+        further files are deferred: They are yielded with "is_deferred" set and
+        without chunks, are counted in the summary's "ndeferred" only, and may
+        be computed separately using `file_diff`.
+
+        The diff is put into the cache once the iterator is exhausted, unless
+        it is larger than `MAX_CACHED_DIFF_SIZE`.  Diffs with deferred files
+        are cached for the `budget` only.
+        """
+        summary = {"nfiles": 0, "nadditions": 0, "ndeletions": 0, "ndeferred": 0}
+        key = self._get_diff_key(commit)
+
+        def iter_and_cache():
+            compact_file_changes = []
+            size = 0
+            for change in self._iter_diff(key[0], key[1], summary, budget):
+                yield change
+                if compact_file_changes is None:
+                    continue
+                compact_file_changes.append(compact_file_change(change))
+                for chunk in change["chunks"] or []:
+                    size += sum(50 + len(line["line"]) for line in chunk)
+                if size > MAX_CACHED_DIFF_SIZE:
+                    # Don't keep all of a huge diff in memory
+                    compact_file_changes = None
+            if compact_file_changes is not None:
+                self._diff_cache.set(
+                    (
+                        self._get_budgeted_diff_key(key, budget)
+                        if summary["ndeferred"]
+                        else key
+                    ),
+                    dump_compact_diff(summary, compact_file_changes),
+                )
 
-        if path:
-            dirs.insert(0, ("..", parent_directory(path)))
+        return summary, iter_and_cache()
 
-        return {"submodules": submodules, "dirs": dirs, "files": files}
+    def file_diff(self, commit, path):
+        """Return the change to the file at `path` introduced by `commit`, in
+        the format of the entries of `commit_diff`.
 
-    @synchronized
-    def commit_diff(self, commit):
-        """Return the list of changes introduced by `commit`."""
-        from klaus.utils import guess_is_binary
+        Raises KeyError if the file wasn't changed.
+        """
+        path = encode_for_git(path)
+        old_entry, new_entry = (
+            self._lookup_file(tree_sha, path) if tree_sha else None
+            for tree_sha in self._get_diff_key(commit)
+        )
+        if old_entry == new_entry:
+            raise KeyError(path)
+        return self._diff_blobs(
+            path if old_entry else None,
+            path if new_entry else None,
+            old_entry and old_entry[1],
+            new_entry and new_entry[1],
+        )
 
+    def _lookup_file(self, tree_sha, path):
+        try:
+            entry = self.lookup_path(tree_sha, path)
+        except KeyError:
+            return None
+        if stat.S_ISDIR(entry[0]):
+            return None
+        return entry
+
+    def _get_diff_key(self, commit):
         if commit.parents:
             parent_tree = self[commit.parents[0]].tree
         else:
             parent_tree = None
+        return (parent_tree, commit.tree)
 
-        summary = {"nfiles": 0, "nadditions": 0, "ndeletions": 0}
-        file_changes = []  # the changes in detail
+    @staticmethod
+    def _get_budgeted_diff_key(key, budget):
+        return key + (tuple(sorted(budget.items())),)
 
-        dulwich_changes = self.dulwich_repo.object_store.tree_changes(
-            parent_tree, commit.tree
-        )
-        for (oldpath, newpath), (oldmode, newmode), (oldsha, newsha) in dulwich_changes:
+    def _get_tree_changes(self, parent_tree, tree):
+        with self._dulwich_repo() as repo:
+            return list(repo.object_store.tree_changes(parent_tree, tree))
+
+    def _get_blob(self, sha):
+        if not sha:
+            return Blob.from_string(b"")
+        try:
+            return self.get_objects([sha])[0]
+        except KeyError:
+            # probably related to submodules; Dulwich will handle that.
+            return Blob.from_string(b"")
+
+    def _get_blob_size(self, sha):
+        if not sha:
+            return 0
+        try:
+            return self.get_object_info(sha)[1]
+        except KeyError:
+            return 0
+
+    def _iter_diff(self, parent_tree, tree, summary, budget=None):
+        """Yield the changes between `parent_tree` and `tree`, computing each
+        file's diff as it's needed, and update the counts in `summary`.
+        See `iter_commit_diff` for `budget`.
+
+        Blobs are read through the `git cat-file` pool.
+        """
+        if budget is not None:
+            files_left = budget.get("files", float("inf"))
+            lines_left = budget.get("lines", float("inf"))
+            bytes_left = budget.get("bytes", float("inf"))
+
+        changes = self._get_tree_changes(parent_tree, tree)
+        for (oldpath, newpath), (oldmode, newmode), (oldsha, newsha) in changes:
             summary["nfiles"] += 1
-            try:
-                oldblob = (
-                    self.dulwich_repo.object_store[oldsha]
-                    if oldsha
-                    else Blob.from_string(b"")
-                )
-            except KeyError:
-                # probably related to submodules; Dulwich will handle that.
-                oldblob = Blob.from_string(b"")
-            try:
-                newblob = (
-                    self.dulwich_repo.object_store[newsha]
-                    if newsha
-                    else Blob.from_string(b"")
-                )
-            except KeyError:
-                # probably related to submodules; Dulwich will handle that.
-                newblob = Blob.from_string(b"")
-
-            # Check for binary files -- can't show diffs for these
-            if guess_is_binary(newblob) or guess_is_binary(oldblob):
-                file_changes.append(
-                    {
-                        "is_binary": True,
+            if budget is not None:
+                exhausted = files_left <= 0 or lines_left <= 0
+                if not exhausted:
+                    # Only look up sizes while the budget lasts; each lookup
+                    # is a round trip to `git cat-file`.
+                    nbytes = self._get_blob_size(oldsha) + self._get_blob_size(newsha)
+                    exhausted = nbytes > bytes_left
+                if exhausted:
+                    # Once exhausted, don't use up the remaining budget on
+                    # smaller files that follow; defer all of them.
+                    files_left = lines_left = bytes_left = 0
+                    summary["ndeferred"] += 1
+                    yield {
+                        "is_binary": False,
+                        "is_deferred": True,
                         "old_filename": oldpath or "/dev/null",
                         "new_filename": newpath or "/dev/null",
                         "chunks": None,
                     }
-                )
-                continue
+                    continue
+                files_left -= 1
+                bytes_left -= nbytes
+
+            change = self._diff_blobs(oldpath, newpath, oldsha, newsha)
+            if not change["is_binary"]:
+                summary["nadditions"] += change["additions"]
+                summary["ndeletions"] += change["deletions"]
+                if budget is not None:
+                    lines_left -= sum(map(len, change["chunks"]))
+            yield change
+
+    def _diff_blobs(self, oldpath, newpath, oldsha, newsha):
+        from klaus.utils import guess_is_binary
 
-            additions, deletions, chunks = render_diff(
-                oldblob.splitlines(), newblob.splitlines()
-            )
-            change = {
-                "is_binary": False,
+        oldblob = self._get_blob(oldsha)
+        newblob = self._get_blob(newsha)
+
+        # Check for binary files -- can't show diffs for these
+        if guess_is_binary(newblob) or guess_is_binary(oldblob):
+            return {
+                "is_binary": True,
                 "old_filename": oldpath or "/dev/null",
                 "new_filename": newpath or "/dev/null",
-                "chunks": chunks,
-                "additions": additions,
-                "deletions": deletions,
+                "chunks": None,
             }
-            summary["nadditions"] += additions
-            summary["ndeletions"] += deletions
-            file_changes.append(change)
 
-        return summary, file_changes
+        additions, deletions, chunks = render_diff(
+            oldblob.splitlines(), newblob.splitlines()
+        )
+        return {
+            "is_binary": False,
+            "old_filename": oldpath or "/dev/null",
+            "new_filename": newpath or "/dev/null",
+            "chunks": chunks,
+            "additions": additions,
+            "deletions": deletions,
+        }
 
-    @synchronized
     def raw_commit_diff(self, commit):
         if commit.parents:
             parent_tree = self[commit.parents[0]].tree
         else:
             parent_tree = None
         bytesio = io.BytesIO()
-        dulwich.patch.write_tree_diff(
-            bytesio, self.dulwich_repo.object_store, parent_tree, commit.tree
-        )
+        with self._dulwich_repo() as repo:
+            dulwich.patch.write_tree_diff(
+                bytesio, repo.object_store, parent_tree, commit.tree
+            )
         return bytesio.getvalue()
 
     def freeze(self):
@@ -435,3 +1005,60 @@ class InvalidRepo:
             return f"~{self.namespace}/{self.name}"
         else:
             return self.name
+
+
+def _parse_gitattributes(data):
+    """Parse a `.gitattributes` file into a list of `(regex, anchored,
+    attributes)` rules.  If `anchored` is false, `regex` is to be matched
+    against the file name only, otherwise against the path relative to the
+    directory of the `.gitattributes` file.  `attributes` is a list of
+    `(name, value)` pairs, where a value of None means "unspecified".
+    """
+    rules = []
+    for line in decode_from_git(data).splitlines():
+        fields = line.split()
+        if not fields or fields[0].startswith(("#", "[attr]")):
+            continue
+        pattern, attributes = fields[0], []
+        for field in fields[1:]:
+            if field.startswith("-"):
+                attributes.append((field[1:], False))
+            elif field.startswith("!"):
+                attributes.append((field[1:], None))
+            elif "=" in field:
+                attributes.append(tuple(field.split("=", 1)))
+            else:
+                attributes.append((field, True))
+        anchored = "/" in pattern
+        rules.append((_glob_to_regex(pattern.lstrip("/")), anchored, attributes))
+    return rules
+
+
+def _glob_to_regex(pattern):
+    """Translate a `.gitattributes` pattern to a compiled regex."""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            regex += "/.*"
+            i += 3
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2 :]:
+            end = pattern.index("]", i + 2)
+            chars = pattern[i + 1 : end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex += "[" + chars.replace("\\", "\\\\") + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + r"\Z")
@@ -0,0 +1,488 @@
+"""A multi-threaded, optionally pre-forking WSGI server for the `klaus` command.
+
+Connections are handled by a fixed pool of threads.  Connections that arrive
+while all threads are busy wait in a bounded queue; once that is full, they
+are answered with "503 Service Unavailable" right away rather than piling up.
+Threads only handle connections that have a request waiting: new and idle
+HTTP/1.1 keep-alive connections are watched by the main thread, and closed
+after a few idle seconds.
+
+With more than one process (or with `max_requests`), a master process forks
+worker processes that share the listening socket, replaces workers that exit,
+and stops them gracefully on SIGTERM or SIGINT.  SIGHUP replaces all workers.
+Workers exit after serving about `max_requests` requests, which bounds the
+memory used by caches and leaks.
+
+Built on the standard library's `http.server` and `wsgiref`: Werkzeug's
+development server closes the connection after every request.
+"""
+import os
+import queue
+import random
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+# Socket timeout while reading a request or sending a response.
+REQUEST_TIMEOUT = 60
+
+# Request bodies that the application didn't read are skipped to keep the
+# connection open, unless more than this many bytes are left.
+MAX_DRAIN_SIZE = 64 * 1024
+
+# Workers that die sooner than this after they were started aren't restarted
+# right away, to not spin if they can't start at all.
+MIN_WORKER_LIFETIME = 1
+
+_REJECT_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Length: 0\r\n"
+    b"Connection: close\r\n"
+    b"Retry-After: 1\r\n"
+    b"\r\n"
+)
+
+
+class RequestHandler(WSGIRequestHandler):
+    """Handle the requests on a connection that are ready to be read.
+
+    Rather than waiting for the next request on a keep-alive connection, the
+    handler is handed back to the server, which resumes it once the client
+    sends something; see `PooledWSGIServer`.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, request, client_address, server):
+        # Unlike `BaseRequestHandler`, don't handle the connection right away.
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def setup(self):
+        self.timeout = REQUEST_TIMEOUT
+        super().setup()
+
+    def handle(self):
+        """Handle requests until the connection is to be closed (return False)
+        or no request is waiting on it (return True).
+        """
+        while True:
+            self.handle_one_request()
+            if self.close_connection:
+                return False
+            if not self._has_buffered_request():
+                return True
+
+    def _has_buffered_request(self):
+        # Pipelined requests may have been read into the buffer already.
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(REQUEST_TIMEOUT)
+
+    def handle_one_request(self):
+        self.close_connection = True
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, ConnectionError):
+            return
+        if not self.raw_requestline:
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = self.request_version = self.command = ""
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        # Counted before responding, so that a worker that stops after this
+        # request doesn't accept the client's next connection.
+        self.server.count_request()
+        # Don't bother with HTTP/1.0-style keep-alive.
+        self.close_connection = (
+            self.request_version != "HTTP/1.1"
+            or self.headers.get("Connection", "").lower() == "close"
+            # Chunked request bodies can't be skipped easily.
+            or "Transfer-Encoding" in self.headers
+            or self.server.stopping.is_set()
+        )
+        body = _RequestBody(self.rfile, int(self.headers.get("Content-Length") or 0))
+        handler = _ServerHandler(
+            body,
+            self.wfile,
+            self.get_stderr(),
+            self.get_environ(),
+            multithread=True,
+            multiprocess=self.server.multiprocess,
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if not self.close_connection and not body.skip_rest():
+            self.close_connection = True
+
+    def get_environ(self):
+        environ = super().get_environ()
+        environ["REMOTE_PORT"] = str(self.client_address[1])
+        return environ
+
+
+class _ServerHandler(ServerHandler):
+    http_version = "1.1"
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        request_handler = self.request_handler
+        if (
+            "Content-Length" not in self.headers
+            and self.environ["REQUEST_METHOD"] != "HEAD"
+            and self.status[:3] not in ("204", "304")
+        ):
+            # The end of the response is marked by closing the connection.
+            request_handler.close_connection = True
+        if request_handler.server.stopping.is_set():
+            request_handler.close_connection = True
+        if request_handler.close_connection:
+            self.headers["Connection"] = "close"
+
+
+class _RequestBody:
+    """The body of a request, i.e. the first `length` bytes of `rfile`."""
+
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self._remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._rfile.read(size) if size else b""
+        self._remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._rfile.readline(size) if size else b""
+        self._remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def skip_rest(self):
+        """Skip what the application didn't read.  Return whether the
+        connection can be used for another request.
+        """
+        if self._remaining > MAX_DRAIN_SIZE:
+            return False
+        try:
+            while self._remaining:
+                if not self.read(self._remaining):
+                    return False
+        except OSError:
+            return False
+        return True
+
+
+class PooledWSGIServer(WSGIServer):
+    """A WSGI server that handles connections in a pool of `threads` threads.
+
+    Connections are only handed to a thread once a request arrives on them.
+    Until then (and between the requests of keep-alive connections), the
+    thread running `serve_forever` waits for them using a selector.
+
+    :param queue_size: maximum number of connections with a request waiting
+        for a thread
+    :param max_requests: stop after this many requests (0: never)
+    :param keepalive_timeout: seconds to wait for another request on a
+        keep-alive connection
+    """
+
+    multiprocess = False
+
+    def __init__(
+        self,
+        host,
+        port,
+        app,
+        threads=8,
+        queue_size=64,
+        max_requests=0,
+        keepalive_timeout=5,
+    ):
+        if ":" in host:
+            self.address_family = socket.AF_INET6
+        super().__init__((host, port), RequestHandler)
+        self.set_app(app)
+        self.threads = threads
+        self.max_requests = max_requests
+        self.keepalive_timeout = keepalive_timeout
+        self.stopping = threading.Event()
+        self._queue = queue.Queue(queue_size)
+        self._num_requests = 0
+        self._lock = threading.Lock()
+        # `(handler, timeout)` of connections to wait for, see `_park`; None
+        # once `serve_forever` has stopped.
+        self._parking = []
+        # Written to wake up `serve_forever`; created there, as worker
+        # processes need their own.
+        self._wakeup_recv = self._wakeup_send = None
+
+    def serve_forever(self, poll_interval=0.5):
+        """Serve until `stop` is called, then finish all requests in progress
+        or waiting in the queue.
+        """
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_send.setblocking(False)
+        with self._lock:
+            self._parking = []
+        workers = [threading.Thread(target=self._work) for _ in range(self.threads)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            with selectors.DefaultSelector() as selector:
+                self._select_loop(selector, poll_interval)
+        finally:
+            self.stopping.set()
+            for _ in workers:
+                self._queue.put(None)
+            for worker in workers:
+                worker.join()
+            # Workers may have parked connections in the meantime.
+            with self._lock:
+                parking, self._parking = self._parking, None
+            for handler, _ in parking:
+                self._close(handler)
+            self._wakeup_recv.close()
+            self._wakeup_send.close()
+
+    def _select_loop(self, selector, poll_interval):
+        selector.register(self, selectors.EVENT_READ)
+        selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        deadlines = {}  # parked handler -> time at which it's closed
+        try:
+            while not self.stopping.is_set():
+                for key, _ in selector.select(poll_interval):
+                    if key.fileobj is self:
+                        self._handle_request_noblock()
+                    elif key.fileobj is self._wakeup_recv:
+                        self._wakeup_recv.recv(4096)
+                    else:
+                        selector.unregister(key.fileobj)
+                        del deadlines[key.data]
+                        self._dispatch(key.data)
+                now = time.monotonic()
+                with self._lock:
+                    parking, self._parking = self._parking, []
+                for handler, timeout in parking:
+                    selector.register(handler.connection, selectors.EVENT_READ, handler)
+                    deadlines[handler] = now + timeout
+                for handler, deadline in list(deadlines.items()):
+                    if deadline < now:
+                        selector.unregister(handler.connection)
+                        del deadlines[handler]
+                        self._close(handler)
+        finally:
+            for handler in deadlines:
+                self._close(handler)
+
+    def stop(self):
+        """Stop serving.  May be called from any thread or a signal handler."""
+        self.stopping.set()
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b"\0")
+        except (AttributeError, OSError):
+            # Not serving, or full, so a wakeup is pending anyway.
+            pass
+
+    def count_request(self):
+        with self._lock:
+            self._num_requests += 1
+            if self._num_requests != self.max_requests:
+                return
+        self.stop()
+
+    def get_request(self):
+        if self.stopping.is_set():
+            # Leave new connections to the other workers.
+            raise OSError("Server is stopping")
+        return super().get_request()
+
+    def process_request(self, request, client_address):
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        self._park(handler, REQUEST_TIMEOUT)
+
+    def _park(self, handler, timeout):
+        """Wait (at most `timeout` seconds) for a request on the connection of
+        `handler`, then let a thread handle it.
+        """
+        with self._lock:
+            if self._parking is not None:
+                self._parking.append((handler, timeout))
+                handler = None
+        if handler is None:
+            self._wakeup()
+        else:
+            self._close(handler)
+
+    def _dispatch(self, handler):
+        try:
+            self._queue.put_nowait(handler)
+        except queue.Full:
+            try:
+                handler.connection.sendall(_REJECT_RESPONSE)
+            except OSError:
+                pass
+            self._close(handler)
+
+    def _work(self):
+        while True:
+            handler = self._queue.get()
+            if handler is None:
+                return
+            try:
+                idle = handler.handle()
+            except Exception:
+                self.handle_error(handler.request, handler.client_address)
+                idle = False
+            if idle and not self.stopping.is_set():
+                self._park(handler, self.keepalive_timeout)
+            else:
+                self._close(handler)
+
+    def _close(self, handler):
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(handler.request)
+
+
+def serve(
+    app,
+    host,
+    port,
+    processes=1,
+    threads=8,
+    queue_size=64,
+    max_requests=0,
+    keepalive_timeout=5,
+    graceful_timeout=30,
+):
+    """Serve `app` until SIGTERM or SIGINT.  See `PooledWSGIServer` for the
+    arguments; `graceful_timeout` is the number of seconds that worker
+    processes get to finish their requests when stopped.
+    """
+    server = PooledWSGIServer(
+        host, port, app, threads, queue_size, max_requests, keepalive_timeout
+    )
+    print(
+        " * Serving on http://%s:%d with %d process(es) of %d thread(s)"
+        % (host, server.server_port, processes, threads),
+        file=sys.stderr,
+    )
+    if processes == 1 and not max_requests:
+        signal.signal(signal.SIGTERM, lambda *_: server.stop())
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+    if not hasattr(os, "fork"):
+        raise RuntimeError("Worker processes aren't supported on this platform")
+    server.multiprocess = True
+    # Workers race for new connections; the losers must not block in accept().
+    server.socket.setblocking(False)
+    try:
+        _Master(server, processes, graceful_timeout).run()
+    finally:
+        server.server_close()
+
+
+class _Master:
+    def __init__(self, server, processes, graceful_timeout):
+        self.server = server
+        self.processes = processes
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}  # pid -> start time
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._restart_workers)
+        deadline = None
+        while self.workers or not self.stopping:
+            if not self.stopping:
+                while len(self.workers) < self.processes:
+                    self._spawn()
+            elif deadline is None:
+                deadline = time.monotonic() + self.graceful_timeout
+            elif time.monotonic() > deadline:
+                self._signal_workers(signal.SIGKILL)
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid in self.workers:
+                started = self.workers.pop(pid)
+                if status and time.monotonic() - started < MIN_WORKER_LIFETIME:
+                    time.sleep(MIN_WORKER_LIFETIME)
+            elif not pid:
+                time.sleep(0.1)
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return
+        try:
+            server = self.server
+            if server.max_requests:
+                # Don't recycle all workers at the same time.
+                server.max_requests += random.randint(0, server.max_requests // 10)
+            signal.signal(signal.SIGTERM, lambda *_: server.stop())
+            signal.signal(signal.SIGINT, lambda *_: server.stop())
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            server.serve_forever()
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+
+    def _stop(self, *args):
+        self.stopping = True
+        self._signal_workers(signal.SIGTERM)
+
+    def _restart_workers(self, *args):
+        self._signal_workers(signal.SIGTERM)
+
+    def _signal_workers(self, signum):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
@@ -5,10 +5,78 @@ var forEach = function(collection, func) {
 }
 
 
+/* Fetch an HTML fragment and replace `elem` by it */
+var replaceWithFragment = function(elem, url, onerror) {
+  var request = new XMLHttpRequest();
+  request.open('GET', url);
+  request.onload = function() {
+    if (request.status == 200) {
+      elem.insertAdjacentHTML('afterend', request.responseText);
+      elem.parentNode.removeChild(elem);
+      updateTimesince();
+    } else if (onerror) {
+      onerror();
+    }
+  };
+  request.send();
+};
+
+
+/* Relative times ("3 days ago"), rendered on the server like `timesince`
+ * (humanize's `naturaltime`) and updated here, as pages may be served from
+ * caches long after they were rendered. */
+var naturalDelta = function(seconds) {
+  var plural = function(n, unit) { return n + ' ' + unit + (n == 1 ? '' : 's'); },
+      days = Math.floor(seconds / 86400),
+      years = Math.floor(days / 365),
+      months;
+  seconds = Math.floor(seconds % 86400);
+  days %= 365;
+  months = Math.round(days / 30.5);
+  if (years == 0 && days < 1) {
+    if (seconds == 0) return 'a moment';
+    if (seconds == 1) return 'a second';
+    if (seconds < 60) return plural(seconds, 'second');
+    if (seconds < 3600) {
+      var minutes = Math.round(seconds / 60);
+      return minutes == 1 ? 'a minute' : minutes == 60 ? 'an hour' : plural(minutes, 'minute');
+    }
+    var hours = Math.round(seconds / 3600);
+    return hours == 1 ? 'an hour' : hours == 24 ? 'a day' : plural(hours, 'hour');
+  }
+  if (years == 0) {
+    if (days == 1) return 'a day';
+    if (months == 0) return plural(days, 'day');
+    if (months == 1) return 'a month';
+    if (months == 12) return 'a year';
+    return plural(months, 'month');
+  }
+  if (years == 1) {
+    if (months == 0 && days == 0) return 'a year';
+    if (months == 0) return '1 year, ' + plural(days, 'day');
+    if (months == 12) return '2 years';
+    return '1 year, ' + plural(months, 'month');
+  }
+  return plural(years, 'year');
+};
+
+var updateTimesince = function() {
+  var now = Date.now() / 1000;
+  forEach(document.querySelectorAll('[data-timestamp]'), function(elem) {
+    var seconds = now - elem.getAttribute('data-timestamp'),
+        delta = naturalDelta(Math.abs(seconds));
+    elem.textContent = delta == 'a moment' ? 'now' : delta + (seconds < 0 ? ' from now' : ' ago');
+  });
+};
+
+document.addEventListener('DOMContentLoaded', updateTimesince);
+
+
 /* General collapse/expand/toggle framework. Used for hiding diffs in commits */
 var toggler = {
   expand: function(elem) {
     elem.className = elem.className.replace("collapsed", "");
+    forEach(elem.querySelectorAll('.deferred-diff[data-src]'), loadDeferredDiff);
   },
   collapse: function(elem) {
     if (!/collapsed/.test(elem.className)) {
@@ -19,11 +87,25 @@ var toggler = {
     forEach(document.querySelectorAll(selector), toggler.collapse);
   },
   expandAll: function(selector) {
-    forEach(document.querySelectorAll(selector), toggler.expand);
+    // Doesn't load deferred diffs, which might be thousands.
+    forEach(document.querySelectorAll(selector), function(elem) {
+      elem.className = elem.className.replace("collapsed", "");
+    });
   }
 };
 
 
+/* Diffs of large commits that weren't rendered with the commit page */
+var loadDeferredDiff = function(elem) {
+  var url = elem.getAttribute('data-src');
+  elem.removeAttribute('data-src');
+  elem.textContent = 'Loading diff...';
+  replaceWithFragment(elem, url, function() {
+    elem.textContent = 'Failed to load diff';
+  });
+};
+
+
 /* Line highlighting logic for diffs */
 var highlight_linenos = function(opts) {
   var links = document.querySelectorAll(opts.linksSelector),
@@ -68,3 +150,45 @@ var highlight_linenos = function(opts) {
     }
   };
 }
+
+
+/* Loading more entries into the sidebar of large directories */
+document.addEventListener('click', function(e) {
+  var link = e.target;
+  if (link.tagName != 'A' || !/more-entries/.test(link.parentNode.className)) {
+    return;
+  }
+  e.preventDefault();
+  replaceWithFragment(link.parentNode, link.getAttribute('data-src'));
+});
+
+
+/* Loading neighbouring windows of lines (`?lines=a-b`) of files */
+var loadMoreLines = function(link) {
+  var row = link.parentNode.parentNode,
+      url = link.getAttribute('data-src');
+  link.removeAttribute('data-src');
+  link.textContent = 'Loading lines...';
+  replaceWithFragment(row, url, function() {
+    link.textContent = 'Failed to load lines';
+  });
+};
+
+document.addEventListener('click', function(e) {
+  var link = e.target;
+  if (link.tagName != 'A' || !link.hasAttribute('data-src') ||
+      !/more-lines/.test(link.parentNode.parentNode.className)) {
+    return;
+  }
+  e.preventDefault();
+  loadMoreLines(link);
+});
+
+// The following lines are loaded when scrolled into view.
+window.addEventListener('scroll', function() {
+  forEach(document.querySelectorAll('.more-lines a[data-src*="direction=next"]'), function(link) {
+    if (link.getBoundingClientRect().top < window.innerHeight + 500) {
+      loadMoreLines(link);
+    }
+  });
+});
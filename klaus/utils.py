@@ -1,4 +1,5 @@
 import binascii
+import codecs
 import datetime
 import locale
 import mimetypes
@@ -161,6 +162,47 @@ def force_unicode(s: Union[str, bytes]) -> str:
     return s.decode("latin1", "replace")
 
 
+def iter_unicode(chunks, sample_size=64 * 1024):
+    """Like `force_unicode`, but for the concatenation of `chunks` (an iterable
+    of bytes), which is decoded piece by piece.  The encoding is guessed from
+    the first `sample_size` bytes; undecodable bytes after those are replaced.
+    """
+    chunks = iter(chunks)
+    sample = b""
+    for chunk in chunks:
+        sample += chunk
+        if len(sample) >= sample_size:
+            break
+    decoder = codecs.getincrementaldecoder(_guess_encoding(sample))("replace")
+    yield decoder.decode(sample)
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def _guess_encoding(sample):
+    """Return the encoding `force_unicode` would use for `sample`, which may
+    end in the middle of a character.
+    """
+    for encoding in ["utf-8", locale.getpreferredencoding()]:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample)
+            return encoding
+        except (UnicodeDecodeError, LookupError):
+            pass
+
+    if chardet is not None:
+        encoding = chardet.detect(sample)["encoding"]
+        if encoding is not None:
+            try:
+                codecs.lookup(encoding)
+                return encoding
+            except LookupError:
+                pass
+
+    return "latin1"
+
+
 def extract_author_name(email):
     """Extract the name from an email address --
     >>> extract_author_name("John <john@example.com>")
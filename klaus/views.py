@@ -1,15 +1,25 @@
+import hashlib
 import os
+import re
+import stat
 import sys
 from io import BytesIO
 
-import dulwich.archive
 import dulwich.config
 import dulwich.objects
-from dulwich.object_store import tree_lookup_path
-from flask import current_app, render_template, request, url_for
+from flask import (
+    current_app,
+    make_response,
+    render_template,
+    request,
+    stream_with_context,
+    url_for,
+)
 from flask.views import View
+from werkzeug.datastructures import ContentRange
 from werkzeug.exceptions import NotFound
 from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
 
 try:
     from dulwich.refs import SymrefLoop
@@ -28,13 +38,20 @@ else:
 
     CTAGS_CACHE = ctagscache.CTagsCache()
 
-from klaus import markup
-from klaus.highlighting import highlight_or_render
+from klaus import archive, markup
+from klaus.highlighting import (
+    count_lines,
+    highlight_blocks,
+    highlight_lines,
+    highlight_or_render,
+)
+from klaus.repo import SHA1_RE
 from klaus.utils import (
     encode_for_git,
     force_unicode,
     guess_is_binary,
     guess_is_image,
+    iter_unicode,
     parent_directory,
     replace_dupes,
     sanitize_branch_name,
@@ -50,6 +67,69 @@ README_FILENAMES = [
     b"README.rst",
 ]
 
+# Cache lifetimes for responses to URLs that contain a full commit SHA.  Raw
+# files and patches never change; other pages may show a list of branches
+# and tags which becomes outdated over time.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+SHA_PINNED_CACHE_CONTROL = "public, max-age=86400"
+
+# Limits to the diffs computed for the commit page.  Diffs of files beyond
+# the limits are loaded on demand, see `FileDiffView`.
+DEFAULT_DIFF_BUDGET = {"files": 200, "lines": 20000, "bytes": 10 * 1024 * 1024}
+
+# Endpoints of `DownloadView` for each archive format.
+ARCHIVE_ENDPOINTS = {
+    "tar.gz": "download",
+    "zip": "download_zip",
+    "tar.xz": "download_tar_xz",
+    "tar.zst": "download_tar_zst",
+}
+
+# Raw files larger than this are streamed from a `git cat-file` process in
+# pieces rather than read into memory at once.
+RAW_STREAM_THRESHOLD = 1024 * 1024
+
+# Files larger than this are highlighted while the page is streamed, and
+# can't be blamed.  Files larger than `MAX_STREAMED_HIGHLIGHT_SIZE` aren't
+# shown at all; highlighting stops after `STREAMED_HIGHLIGHT_TIME_LIMIT`
+# seconds of CPU time, the rest of the file is shown without highlighting.
+MAX_HIGHLIGHT_SIZE = 100 * 1024
+MAX_STREAMED_HIGHLIGHT_SIZE = 10 * 1024 * 1024
+STREAMED_HIGHLIGHT_TIME_LIMIT = 5
+
+# Maximum number of lines shown with the `lines=a-b` argument of the file and
+# blame views; see `BaseFileView.get_line_range`.
+MAX_LINE_WINDOW = 2000
+
+# Streamed pages are sent in pieces of at least this many characters.
+STREAM_BUFFER_SIZE = 16 * 1024
+
+# Number of directory entries shown in the sidebar at once.  More entries
+# can be loaded on demand, see `TreeEntriesView`.
+SIDEBAR_ENTRIES = 500
+
+
+def stream_template(template_name, **context):
+    """Like Flask's `render_template`, but return an iterator that renders the
+    template piece by piece as it is consumed.  Can be used as response body.
+    """
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+
+    def generate():
+        buf = []
+        size = 0
+        for piece in template.generate(context):
+            buf.append(piece)
+            size += len(piece)
+            if size >= STREAM_BUFFER_SIZE:
+                yield "".join(buf)
+                buf = []
+                size = 0
+        yield "".join(buf)
+
+    return stream_with_context(generate())
+
 
 def repo_list():
     """Show a list of all repos. Can be sorted by last update and repo names can be searched."""
@@ -117,20 +197,12 @@ def _get_repo_and_rev(repo, namespace=None, rev=None, path=None):
             except KeyError:
                 raise NotFound("No commits yet")
 
-    i = len(rev)
-    while i > 0:
-        try:
-            commit = repo.get_commit(rev[:i])
-            path = rev[i:].strip("/")
-            rev = rev[:i]
-        except (OSError, KeyError):
-            i = rev.rfind("/", 0, i)
-        except SymrefLoop as e:
-            raise NotFound("symref loop for %s at depth %d" % (e.ref, e.depth))
-        else:
-            break
-    else:
+    try:
+        rev, path, commit = repo.split_rev_and_path(rev)
+    except KeyError:
         raise NotFound("No such commit %r" % rev)
+    except SymrefLoop as e:
+        raise NotFound("symref loop for %s at depth %d" % (e.ref, e.depth))
 
     return repo, rev, path, commit
 
@@ -160,9 +232,18 @@ class BaseRepoView(View):
     `rev` is "master", the history of the "master" branch is displayed.
     """
 
+    #: Whether the response contains information derived from refs (like the
+    #: list of branches and tags), as opposed to only from the commit.
+    depends_on_refs = True
+
+    #: Whether responses may be kept in the application's `page_cache`.  Only
+    #: worthwhile for views that do a lot of work, like syntax highlighting.
+    cache_responses = False
+
     def __init__(self, view_name):
         self.view_name = view_name
         self.context = {}
+        self._resolved = None
 
     def dispatch_request(self, repo, namespace=None, rev=None, path=""):
         """Dispatch repository, revision (if any) and path (if any). To retain
@@ -175,19 +256,102 @@ class BaseRepoView(View):
         later split into rev and path again, but revision now may contain
         slashes.
 
+        Responses carry an ETag; if the client (or a proxy) already has the
+        current version, we answer with 304 before doing any rendering work.
+        Otherwise, if `cache_responses` is set, responses are served from (and
+        put into) the application's page cache, using the ETag as key.
+
         [1] https://github.com/jonashaag/klaus/issues/36#issuecomment-23990266
         """
-        self.make_template_context(repo, namespace, rev, path.strip("/"))
-        return self.get_response()
+        path = path.strip("/")
+        etag = self.get_etag(*self.resolve(repo, namespace, rev, path))
+        if etag is not None and request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        elif etag is not None and self.cache_responses:
+            response = self.get_cached_response(etag, repo, namespace, rev, path)
+        else:
+            self.make_template_context(repo, namespace, rev, path)
+            response = make_response(self.get_response())
+        if etag is not None:
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = self.get_cache_control()
+        return response
+
+    def get_cached_response(self, etag, *args):
+        # The page also depends on some of the application's settings, which
+        # may change between restarts if the cache is persisted.
+        key = (
+            etag,
+            current_app.site_name,
+            current_app.use_smarthttp,
+            current_app.ctags_policy,
+            tuple(sorted(current_app.diff_budget.items())),
+            current_app.inline_css,
+            tuple(sorted(current_app.static_fingerprints.items())),
+        )
+        page = current_app.page_cache.get(key)
+        if page is not None:
+            status, headers, body = page
+            return Response(body, status=status, headers=headers)
+        self.make_template_context(*args)
+        response = make_response(self.get_response())
+        if response.status_code == 200 and not response.is_streamed:
+            page = (
+                response.status_code,
+                [tuple(header) for header in response.headers.to_wsgi_list()],
+                response.get_data(),
+            )
+            current_app.page_cache.set(key, page)
+        return response
+
+    def resolve(self, repo, namespace, rev, path):
+        """Return `(repo, rev, path, commit)` as returned by `_get_repo_and_rev`.
+        The result is computed only once per request.
+        """
+        if self._resolved is None:
+            self._resolved = _get_repo_and_rev(repo, namespace, rev, path)
+        return self._resolved
+
+    def get_etag(self, repo, rev, path, commit):
+        """Return the ETag for the response, or None to not send one.
+
+        The response is completely determined by the commit, the rev name and
+        path (which are used in links), the query arguments, and the refs (see
+        `depends_on_refs`).  Links also contain the URL prefix (`SubUri`) and
+        sometimes the host, so the page cache key, which includes the ETag,
+        must differ between those as well.
+        """
+        key = [
+            current_app.jinja_env.globals["KLAUS_VERSION"],
+            request.url_root,
+            self.view_name,
+            repo.namespaced_name,
+            commit.id,
+            rev,
+            path,
+            sorted(request.args.items(multi=True)),
+        ]
+        if self.depends_on_refs:
+            key.append(repo.get_ref_snapshot().token)
+        return hashlib.sha1(repr(key).encode("utf8")).hexdigest()
+
+    def get_cache_control(self):
+        repo, rev, path, commit = self._resolved
+        if not (SHA1_RE.match(rev) and commit.id == encode_for_git(rev)):
+            # Might change any time; always check whether the ETag is current.
+            return "no-cache"
+        if self.depends_on_refs:
+            return SHA_PINNED_CACHE_CONTROL
+        return IMMUTABLE_CACHE_CONTROL
 
     def get_response(self):
         return render_template(self.template_name, **self.context)
 
     def make_template_context(self, repo, namespace, rev, path):
-        repo, rev, path, commit = _get_repo_and_rev(repo, namespace, rev, path)
+        repo, rev, path, commit = self.resolve(repo, namespace, rev, path)
 
         try:
-            blob_or_tree = repo.get_blob_or_tree(commit, path)
+            blob_or_tree = self.get_blob_or_tree(repo, commit, path)
         except KeyError:
             raise NotFound("File not found")
 
@@ -205,12 +369,70 @@ class BaseRepoView(View):
             "base_href": None,
         }
 
+    def get_blob_or_tree(self, repo, commit, path):
+        return repo.get_blob_or_tree(commit, path)
+
 
 class CommitView(BaseRepoView):
+    """Show a commit and its diff.
+
+    Unless the diff is cached, the page is streamed: Each file's diff is
+    computed right before it's sent, so neither the time to first byte nor
+    memory use depend on the size of the commit.
+    """
+
     template_name = "view_commit.html"
+    cache_responses = True
+
+    def make_template_context(self, *args):
+        super().make_template_context(*args)
+        repo, commit = self.context["repo"], self.context["commit"]
+        budget = current_app.diff_budget
+        diff = repo.get_cached_commit_diff(commit, budget)
+        self.context["streaming"] = diff is None
+        if diff is None:
+            diff = repo.iter_commit_diff(commit, budget)
+        self.context["summary"], self.context["file_changes"] = diff
+
+    def get_response(self):
+        if self.context["streaming"]:
+            return Response(
+                stream_template(self.template_name, **self.context),
+                mimetype="text/html",
+            )
+        return super().get_response()
+
+
+class FileDiffView(BaseRepoView):
+    """Render the diff of a single file of a commit, for loading the diffs
+    that were left out of the commit page on demand.
+    """
+
+    template_name = "file_diff.inc.html"
+    depends_on_refs = False
+
+    def make_template_context(self, repo, namespace, rev, path):
+        repo, rev, path, commit = self.resolve(repo, namespace, rev, path)
+        try:
+            file = repo.file_diff(commit, path)
+        except KeyError:
+            raise NotFound("File not changed in this commit")
+        self.context = {
+            "view": self.view_name,
+            "repo": repo,
+            "namespace": namespace,
+            "rev": rev,
+            "commit": commit,
+            "path": path,
+            "file": file,
+            # For the line anchors; the file's position in the commit page
+            "fileno": request.args.get("fileno", 0, type=int),
+        }
 
 
 class PatchView(BaseRepoView):
+    depends_on_refs = False
+
     def get_response(self):
         return Response(
             self.context["repo"].raw_commit_diff(self.context["commit"]),
@@ -223,21 +445,65 @@ class TreeViewMixin:
 
     def make_template_context(self, *args):
         super().make_template_context(*args)
+        self.context["root_directory"] = self.get_root_directory()
         self.context["root_tree"] = self.listdir()
+        self.context["direction"] = None
 
     def listdir(self):
-        """Return a list of directories and files in the current path of the selected commit."""
-        root_directory = self.get_root_directory()
-        return self.context["repo"].listdir(self.context["commit"], root_directory)
+        """Return a list of directories and files in the current path of the
+        selected commit.  For large directories, only a window of
+        `SIDEBAR_ENTRIES` entries is returned: The one given by the
+        "tree_offset" query parameter, or the one containing the current file.
+        """
+        offset = request.args.get("tree_offset", type=int)
+        around = None
+        if offset is None and is_blob(self.context["blob_or_tree"]):
+            around = os.path.basename(self.context["path"])
+        return self.context["repo"].listdir(
+            self.context["commit"],
+            self.get_root_directory(),
+            offset=offset or 0,
+            limit=SIDEBAR_ENTRIES,
+            around=around,
+        )
 
     def get_root_directory(self):
         root_directory = self.context["path"]
-        if isinstance(self.context["blob_or_tree"], dulwich.objects.Blob):
+        if is_blob(self.context["blob_or_tree"]):
             # 'path' is a file (not folder) name
             root_directory = parent_directory(root_directory)
         return root_directory
 
 
+class TreeEntriesView(TreeViewMixin, BaseRepoView):
+    """Render a window of sidebar entries, for loading them on demand.
+
+    The "direction" query parameter tells which of the links to further
+    entries should be rendered: "previous", "next" or both (the default).
+    """
+
+    template_name = "tree_entries.inc.html"
+    depends_on_refs = False
+
+    def make_template_context(self, *args):
+        super().make_template_context(*args)
+        self.context["direction"] = request.args.get("direction")
+
+    def listdir(self):
+        return self.context["repo"].listdir(
+            self.context["commit"],
+            self.get_root_directory(),
+            offset=request.args.get("offset", 0, type=int),
+            limit=max(
+                1,
+                min(
+                    request.args.get("limit", SIDEBAR_ENTRIES, type=int),
+                    SIDEBAR_ENTRIES,
+                ),
+            ),
+        )
+
+
 class ReadmeMixin:
     """The logic required for finding and displaying README files."""
 
@@ -248,19 +514,24 @@ class ReadmeMixin:
         if not isinstance(tree, dulwich.objects.Tree):
             raise KeyError
 
+        # One pass over the tree; candidates are matched case-insensitively,
+        # in the order of README_FILENAMES.
+        candidates = {}
+        for entry in tree.iteritems():
+            candidates.setdefault(entry.path.lower(), entry)
         for name in README_FILENAMES:
-            if name.lower() in [t.lower() for t in tree]:
-                obj = self.context["repo"][tree[name][1]]
-                if obj.type_name == b"blob":
-                    readme_data = obj.data
-                    readme_filename = name
-                    return (readme_filename, readme_data)
-        else:
-            raise KeyError
+            entry = candidates.get(name.lower())
+            if (
+                entry is not None
+                and not stat.S_ISDIR(entry.mode)
+                and not dulwich.objects.S_ISGITLINK(entry.mode)
+            ):
+                return (entry.path, entry.sha)
+        raise KeyError
 
     def get_readme_context(self):
         try:
-            (readme_filename, readme_data) = self._get_readme()
+            readme_filename, readme_sha = self._get_readme()
         except KeyError:
             return {
                 "is_markup": None,
@@ -268,10 +539,17 @@ class ReadmeMixin:
             }
         else:
             readme_filename = force_unicode(readme_filename)
-            readme_data = force_unicode(readme_data)
+
+            def render():
+                # Only read the blob if the README isn't cached yet.
+                readme_data = self.context["repo"].get_objects([readme_sha])[0].data
+                return highlight_or_render(force_unicode(readme_data), readme_filename)
+
             return {
                 "is_markup": markup.can_render(readme_filename),
-                "rendered_code": highlight_or_render(readme_data, readme_filename),
+                "rendered_code": current_app.highlight_cache.get_or_compute(
+                    ("readme", readme_sha, readme_filename), render
+                ),
             }
 
 
@@ -281,6 +559,7 @@ class HistoryView(TreeViewMixin, ReadmeMixin, BaseRepoView):
     Also, README, if available."""
 
     template_name = "history.html"
+    cache_responses = True
 
     def make_template_context(self, *args):
         super().make_template_context(*args)
@@ -331,6 +610,7 @@ class IndexView(TreeViewMixin, ReadmeMixin, BaseRepoView):
     Also, README, if available."""
 
     template_name = "index.html"
+    cache_responses = True
 
     def make_template_context(self, *args):
         super().make_template_context(*args)
@@ -368,10 +648,29 @@ class IndexView(TreeViewMixin, ReadmeMixin, BaseRepoView):
         self.context.update(self.get_readme_context())
 
 
+class LargeBlob:
+    """Stands in for a blob that's too large to be read into memory at once,
+    see `BaseFileView.get_blob_or_tree`.
+    """
+
+    def __init__(self, repo, id, size):
+        self.repo = repo
+        self.id = id
+        self.size = size
+
+    def iter_data(self, start=0, stop=None):
+        """Yield the blob's contents in pieces, see `FancyRepo.iter_blob`."""
+        return self.repo.iter_blob(self.id, start, stop)
+
+
+def is_blob(obj):
+    return isinstance(obj, (dulwich.objects.Blob, LargeBlob))
+
+
 class BaseBlobView(BaseRepoView):
     def make_template_context(self, *args):
         super().make_template_context(*args)
-        if not isinstance(self.context["blob_or_tree"], dulwich.objects.Blob):
+        if not is_blob(self.context["blob_or_tree"]):
             raise NotFound("Not a blob")
         self.context["filename"] = os.path.basename(self.context["path"])
 
@@ -382,12 +681,10 @@ class SubmoduleView(BaseRepoView):
     template_name = "submodule.html"
 
     def make_template_context(self, repo, namespace, rev, path):
-        repo, rev, path, commit = _get_repo_and_rev(repo, namespace, rev, path)
+        repo, rev, path, commit = self.resolve(repo, namespace, rev, path)
 
         try:
-            submodule_rev = tree_lookup_path(
-                repo.__getitem__, commit.tree, encode_for_git(path)
-            )[1]
+            submodule_rev = repo.lookup_path(commit.tree, path)[1]
         except KeyError:
             raise NotFound("Parent path for submodule missing")
 
@@ -420,7 +717,30 @@ class SubmoduleView(BaseRepoView):
 
 
 class BaseFileView(TreeViewMixin, BaseBlobView):
-    """Base for FileView and BlameView."""
+    """Base for FileView and BlameView.
+
+    With a `lines=a-b` query argument, only lines `a` to `b` are rendered.
+    """
+
+    cache_responses = True
+
+    #: Whether files larger than `MAX_HIGHLIGHT_SIZE` are rendered in a
+    #: streamed page (up to `MAX_STREAMED_HIGHLIGHT_SIZE`).
+    streams_large_files = False
+
+    def get_blob_or_tree(self, repo, commit, path):
+        """Like `BaseRepoView.get_blob_or_tree`, but return a `LargeBlob` for
+        files that are only ever streamed (or not shown at all), rather than
+        reading them into memory.
+        """
+        mode, sha = repo.lookup_path(commit.tree, path)
+        if not stat.S_ISDIR(mode) and (
+            self.get_line_range() is None or not self.streams_large_files
+        ):
+            type_name, size = repo.get_object_info(sha)
+            if type_name == b"blob" and size > MAX_HIGHLIGHT_SIZE:
+                return LargeBlob(repo, sha, size)
+        return super().get_blob_or_tree(repo, commit, path)
 
     def render_code(self, render_markup):
         should_use_ctags = current_app.should_use_ctags(
@@ -443,6 +763,7 @@ class BaseFileView(TreeViewMixin, BaseBlobView):
                     ctags_tagsfile.encode(sys.getfilesystemencoding())
                 ),
                 "ctags_baseurl": ctags_base_url,
+                "ctags_rev": self.context["commit"].id,
             }
         else:
             ctags_args = {}
@@ -451,9 +772,65 @@ class BaseFileView(TreeViewMixin, BaseBlobView):
             force_unicode(self.context["blob_or_tree"].data),
             self.context["filename"],
             render_markup,
+            cache=current_app.highlight_cache,
+            blob_sha=self.context["blob_or_tree"].id,
+            language=self.get_language(),
             **ctags_args,
         )
 
+    def render_lines(self):
+        """Render only the lines given by `get_line_range`."""
+        code = force_unicode(self.context["blob_or_tree"].data)
+        total_lines = count_lines(code)
+        start, stop = self.context["line_range"]
+        start = min(start, max(1, total_lines))
+        stop = min(stop, total_lines)
+        window = stop - start + 1
+        self.context.update(
+            {
+                "direction": None,
+                "line_range": (start, stop),
+                "previous_lines": (
+                    (max(1, start - window), start - 1) if start > 1 else None
+                ),
+                "next_lines": (
+                    (stop + 1, min(stop + window, total_lines))
+                    if stop < total_lines
+                    else None
+                ),
+                "rendered_code": highlight_lines(
+                    code,
+                    self.context["filename"],
+                    start,
+                    stop,
+                    blob_sha=self.context["blob_or_tree"].id,
+                    language=self.get_language(),
+                    time_limit=STREAMED_HIGHLIGHT_TIME_LIMIT,
+                ),
+            }
+        )
+
+    def get_line_range(self):
+        """Return the range of lines `(start, stop)` (1-based, inclusive) given
+        by the `lines` query argument ("a-b" or "a"), or None.
+        """
+        match = re.match(r"(\d+)(?:-(\d+))?$", request.args.get("lines", ""))
+        if match is None:
+            return None
+        start = max(1, int(match.group(1)))
+        stop = int(match.group(2) or start)
+        if stop < start:
+            return None
+        return start, min(stop, start + MAX_LINE_WINDOW - 1)
+
+    def get_language(self):
+        """Return the file's `linguist-language` Git attribute, if any."""
+        attributes = self.context["repo"].get_attributes(
+            self.context["commit"], self.context["path"]
+        )
+        language = attributes.get("linguist-language")
+        return language if isinstance(language, str) else None
+
     def make_template_context(self, *args):
         super().make_template_context(*args)
         self.context.update(
@@ -461,12 +838,24 @@ class BaseFileView(TreeViewMixin, BaseBlobView):
                 "can_render": True,
                 "is_binary": False,
                 "too_large": False,
+                "streamed": False,
                 "is_markup": False,
+                "line_range": self.get_line_range(),
             }
         )
 
-        binary = guess_is_binary(self.context["blob_or_tree"])
-        too_large = sum(map(len, self.context["blob_or_tree"].chunked)) > 100 * 1024
+        blob = self.context["blob_or_tree"]
+        if isinstance(blob, LargeBlob):
+            # Like Git, only look for NUL bytes at the start of large files.
+            binary = b"\0" in b"".join(blob.iter_data(0, 8000))
+            size = blob.size
+        else:
+            binary = guess_is_binary(blob)
+            size = sum(map(len, blob.chunked))
+        if self.streams_large_files:
+            too_large = size > MAX_STREAMED_HIGHLIGHT_SIZE
+        else:
+            too_large = size > MAX_HIGHLIGHT_SIZE
         if binary:
             self.context.update(
                 {
@@ -482,16 +871,38 @@ class BaseFileView(TreeViewMixin, BaseBlobView):
                     "too_large": True,
                 }
             )
+        elif size > MAX_HIGHLIGHT_SIZE and self.context["line_range"] is None:
+            self.context["streamed"] = True
 
 
 class FileView(BaseFileView):
-    """Shows a file rendered using ``pygmentize``."""
+    """Shows a file rendered using ``pygmentize``.
+
+    Large files are highlighted piece by piece while the page is streamed.
+    """
 
     template_name = "view_blob.html"
+    streams_large_files = True
 
     def make_template_context(self, *args):
         super().make_template_context(*args)
-        if self.context["can_render"]:
+        if self.context["streamed"]:
+            self.context.update(
+                {
+                    "render_markup": False,
+                    "rendered_code": highlight_blocks(
+                        iter_unicode(self.context["blob_or_tree"].iter_data()),
+                        self.context["filename"],
+                        blob_sha=self.context["blob_or_tree"].id,
+                        language=self.get_language(),
+                        time_limit=STREAMED_HIGHLIGHT_TIME_LIMIT,
+                    ),
+                }
+            )
+        elif self.context["line_range"] is not None and self.context["can_render"]:
+            self.context["render_markup"] = False
+            self.render_lines()
+        elif self.context["can_render"]:
             render_markup = "markup" not in request.args
             self.context.update(
                 {
@@ -501,6 +912,32 @@ class FileView(BaseFileView):
                 }
             )
 
+    def get_response(self):
+        if self.context["streamed"]:
+            return Response(
+                stream_template(self.template_name, **self.context),
+                mimetype="text/html",
+            )
+        return super().get_response()
+
+
+class FileLinesView(FileView):
+    """Render a window of lines of a file (given by the `lines` query
+    argument), for loading neighbouring windows on demand.
+
+    The "direction" query parameter tells which of the links to further
+    lines should be rendered: "previous", "next" or both (the default).
+    """
+
+    template_name = "file_lines.inc.html"
+    depends_on_refs = False
+
+    def make_template_context(self, *args):
+        super().make_template_context(*args)
+        if self.context["line_range"] is None or not self.context["can_render"]:
+            raise NotFound("No lines to show")
+        self.context["direction"] = request.args.get("direction")
+
 
 class BlameView(BaseFileView):
     template_name = "blame_blob.html"
@@ -511,57 +948,151 @@ class BlameView(BaseFileView):
             line_commits = self.context["repo"].blame(
                 self.context["commit"], self.context["path"]
             )
+            if self.context["line_range"] is not None:
+                self.render_lines()
+                start, stop = self.context["line_range"]
+                line_commits = line_commits[start - 1 : stop]
+            else:
+                self.context["rendered_code"] = self.render_code(render_markup=False)
             replace_dupes(line_commits, None)
-            self.context.update(
-                {
-                    "rendered_code": self.render_code(render_markup=False),
-                    "line_commits": line_commits,
-                }
-            )
+            self.context["line_commits"] = line_commits
 
 
-class RawView(BaseBlobView):
+class RawView(BaseRepoView):
     """Show a single file in raw for (as if it were a normal filesystem file
     served through a static file server).
+
+    Supports HEAD and single byte range requests.  Large files are streamed
+    rather than read into memory.
     """
 
+    depends_on_refs = False
+
+    def make_template_context(self, repo, namespace, rev, path):
+        # Only look up the file's size here; the file may be huge.
+        repo, rev, path, commit = self.resolve(repo, namespace, rev, path)
+        try:
+            sha = repo.lookup_path(commit.tree, path)[1]
+            type_name, size = repo.get_object_info(sha)
+        except KeyError:
+            raise NotFound("File not found")
+        if type_name != b"blob":
+            raise NotFound("Not a blob")
+        self.context = {"repo": repo, "sha": sha, "size": size}
+
     def get_response(self):
+        size = self.context["size"]
+        start, stop = 0, size
         # Explicitly set an empty mimetype. This should work well for most
         # browsers as they do file type recognition anyway.
         # The correct way would be to implement proper file type recognition here.
-        return Response(self.context["blob_or_tree"].chunked, mimetype="")
+        response = Response(mimetype="")
+        response.accept_ranges = "bytes"
+        if self._is_range_request():
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                response.status_code = 416
+                response.content_range = ContentRange("bytes", None, None, size)
+                return response
+            start, stop = byte_range
+            response.status_code = 206
+            response.content_range = ContentRange("bytes", start, stop, size)
+        if request.method != "HEAD":
+            response.response = self._get_contents(start, stop)
+        response.content_length = stop - start
+        return response
+
+    def _is_range_request(self):
+        # Multiple ranges are allowed to be answered with the whole file.
+        if request.range is None or len(request.range.ranges) != 1:
+            return False
+        if_range = request.if_range
+        if if_range.date is not None:
+            # We don't send Last-Modified, so this can't be current.
+            return False
+        return if_range.etag is None or if_range.etag == self.get_etag(*self._resolved)
+
+    def _get_contents(self, start, stop):
+        repo, sha = self.context["repo"], self.context["sha"]
+        if self.context["size"] > RAW_STREAM_THRESHOLD:
+            return repo.iter_blob(sha, start, stop)
+        return [repo.get_objects([sha])[0].data[start:stop]]
 
 
 class DownloadView(BaseRepoView):
-    """Download a repo as a tar.gz file."""
+    """Download a repo as an archive (a tar.gz file by default).
+
+    If the application has an `archive_cache`, archives are generated only
+    once and then served from disk.  The first request streams the archive
+    while it's being written; concurrent requests follow along.
+    """
+
+    depends_on_refs = False
+
+    def __init__(self, view_name, archive_format="tar.gz"):
+        super().__init__(view_name)
+        self.archive_format = archive_format
 
     def get_response(self):
+        if self.archive_format not in archive.get_available_formats():
+            raise NotFound("Archive format not supported")
         basename = "{}@{}".format(
             self.context["repo"].name,
             sanitize_branch_name(self.context["rev"]),
         )
-        tarname = basename + ".tar.gz"
-        headers = {
-            "Content-Disposition": "attachment; filename=%s" % tarname,
-            "Cache-Control": "no-store",  # Disables browser caching
-        }
+        filename = "%s.%s" % (basename, self.archive_format)
+        mimetype = archive.MIMETYPES[self.archive_format]
+        headers = {"Content-Disposition": "attachment; filename=%s" % filename}
+
+        def make_archive_stream():
+            return archive.archive_stream(
+                self.context["repo"],
+                self.context["blob_or_tree"],
+                self.context["commit"].commit_time,
+                encode_for_git(basename),
+                self.archive_format,
+            )
 
-        tar_stream = dulwich.archive.tar_stream(
-            self.context["repo"],
-            self.context["blob_or_tree"],
+        cache = current_app.archive_cache
+        if cache is None:
+            return Response(make_archive_stream(), mimetype=mimetype, headers=headers)
+        key = (
+            "archive",
+            self.context["blob_or_tree"].id,
             self.context["commit"].commit_time,
-            format="gz",
-            prefix=encode_for_git(basename),
+            basename,
+            self.archive_format,
+        )
+        f = cache.open(key)
+        if f is None:
+            return Response(
+                cache.write_through(key, make_archive_stream),
+                mimetype=mimetype,
+                headers=headers,
+            )
+        headers["Content-Length"] = str(os.fstat(f.fileno()).st_size)
+        return Response(
+            wrap_file(request.environ, f),
+            mimetype=mimetype,
+            headers=headers,
+            direct_passthrough=True,
         )
-        return Response(tar_stream, mimetype="application/x-tgz", headers=headers)
 
 
 history = HistoryView.as_view("history", "history")
 index = IndexView.as_view("index", "index")
 commit = CommitView.as_view("commit", "commit")
 patch = PatchView.as_view("patch", "patch")
+file_diff = FileDiffView.as_view("file_diff", "file_diff")
 blame = BlameView.as_view("blame", "blame")
 blob = FileView.as_view("blob", "blob")
+file_lines = FileLinesView.as_view("file_lines", "file_lines")
 raw = RawView.as_view("raw", "raw")
 download = DownloadView.as_view("download", "download")
+download_zip = DownloadView.as_view("download_zip", "download_zip", "zip")
+download_tar_xz = DownloadView.as_view("download_tar_xz", "download_tar_xz", "tar.xz")
+download_tar_zst = DownloadView.as_view(
+    "download_tar_zst", "download_tar_zst", "tar.zst"
+)
 submodule = SubmoduleView.as_view("submodule", "submodule")
+tree_entries = TreeEntriesView.as_view("tree_entries", "tree_entries")
@@ -0,0 +1,40 @@
+import gzip
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from klaus.archive import archive_stream, get_available_formats, parallel_gzip
+from klaus.repo import FancyRepo
+
+from .utils import TEST_REPO
+
+
+def test_parallel_gzip():
+    data = os.urandom(100000) + b"klaus " * 100000
+    chunks = [data[i : i + 1000] for i in range(0, len(data), 1000)]
+    compressed = b"".join(parallel_gzip(chunks, mtime=1234, block_size=10000))
+    assert gzip.decompress(compressed) == data
+    assert len(compressed) < len(data) / 2
+    # Same output regardless of the number of threads and chunk sizes
+    assert compressed == b"".join(
+        parallel_gzip([data], mtime=1234, threads=1, block_size=10000)
+    )
+    assert gzip.decompress(b"".join(parallel_gzip([]))) == b""
+
+
+@pytest.mark.parametrize("format", get_available_formats())
+def test_archive_stream(format):
+    repo = FancyRepo(TEST_REPO, None)
+    commit = repo.get_commit("master")
+    data = b"".join(
+        archive_stream(repo, repo[commit.tree], commit.commit_time, b"prefix", format)
+    )
+    if format == "zip":
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        assert archive.read("prefix/folder/test.txt") == b"\n"
+    else:
+        archive = tarfile.open(fileobj=io.BytesIO(data))
+        assert archive.extractfile("prefix/folder/test.txt").read() == b"\n"
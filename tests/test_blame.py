@@ -1,5 +1,9 @@
+from unittest import mock
+
 import requests
 
+from klaus.repo import FancyRepo
+
 from .utils import *
 
 
@@ -32,3 +36,20 @@ def test_dont_render_blame():
                 UNAUTH_TEST_REPO_DONT_RENDER_URL + "blame/HEAD/" + file
             ).text
             assert "Can't show blame" in response
+
+
+def test_blame_cache(tmpdir):
+    repo = FancyRepo(TEST_REPO, None, cache_dir=str(tmpdir))
+    master = repo.get_commit("master")
+    tag1 = repo.get_commit("tag1")
+    expected = repo.blame(tag1, "test.c")
+    assert len(expected) == 1
+
+    with mock.patch.object(repo, "_run_blame") as run_blame:
+        # Cached result for tag1, reused for its (unchanged) child master
+        assert repo.blame(tag1, "test.c") == expected
+        assert repo.blame(master, "test.c") == expected
+        # Persisted on disk
+        other_repo = FancyRepo(TEST_REPO, None, cache_dir=str(tmpdir))
+        assert other_repo.blame(master, "test.c") == expected
+    assert not run_blame.called
@@ -0,0 +1,175 @@
+import os
+import threading
+import time
+from unittest import mock
+
+from klaus.cache import DiskCache, LRUCache, ResultCache
+
+
+def test_lru_cache_max_entries():
+    evicted = []
+    cache = LRUCache(max_entries=2, on_evict=lambda k, v: evicted.append(k))
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert evicted == ["b"]
+    assert "b" not in cache
+    assert cache["a"] == 1 and cache["c"] == 3
+    assert cache.get("b", "default") == "default"
+    assert cache.stats == {"hits": 3, "misses": 1, "evictions": 1, "expirations": 0}
+
+
+def test_lru_cache_max_bytes():
+    evicted = []
+    cache = LRUCache(
+        max_bytes=10, compute_size=len, on_evict=lambda k, v: evicted.append(k)
+    )
+    cache.set("a", "x" * 4)
+    cache.set("b", "x" * 4)
+    cache.set("c", "x" * 4)
+    assert evicted == ["a"]
+    cache.set("huge", "x" * 11)
+    assert evicted == ["a", "huge"]
+    assert len(cache) == 2
+    assert cache.pop("b") == "x" * 4
+    cache.clear()
+    assert evicted == ["a", "huge", "c"]
+    assert len(cache) == 0
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(ttl=10)
+    with mock.patch("time.monotonic", return_value=100):
+        cache.set("a", 1)
+    with mock.patch("time.monotonic", return_value=109):
+        assert cache.get("a") == 1
+    with mock.patch("time.monotonic", return_value=111):
+        assert cache.get("a") is None
+    assert cache.stats["expirations"] == 1
+
+
+def test_lru_cache_get_or_compute():
+    cache = LRUCache()
+    producer = mock.Mock(return_value=None)
+    assert cache.get_or_compute("a", producer) is None
+    assert cache.get_or_compute("a", producer) is None
+    assert producer.call_count == 1
+
+
+def test_disk_cache(tmpdir):
+    cache = DiskCache(str(tmpdir), max_bytes=100)
+    assert cache.get("a") is None
+    cache.set("a", b"x" * 30)
+    cache.set(("b", 1), b"y" * 30)
+    assert cache.get("a") == b"x" * 30
+    assert cache.get(("b", 1)) == b"y" * 30
+    assert DiskCache(str(tmpdir)).get("a") == b"x" * 30
+
+
+def test_disk_cache_eviction(tmpdir):
+    cache = DiskCache(str(tmpdir), max_bytes=100)
+    cache.set("old", b"x" * 40)
+    cache.set("new", b"y" * 40)
+    past = time.time() - 100
+    os.utime(cache._filename("old"), (past, past))
+    cache.set("newest", b"z" * 40)
+    assert cache.get("old") is None
+    assert cache.get("new") is not None
+    assert cache.get("newest") is not None
+
+
+def test_result_cache(tmpdir):
+    def make_cache():
+        return ResultCache(
+            100,
+            compute_size=len,
+            disk_cache=DiskCache(str(tmpdir)),
+            dumps=lambda value: value.encode(),
+            loads=lambda data: data.decode(),
+        )
+
+    cache = make_cache()
+    assert cache.get("key") is None
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+    assert make_cache().get("key") == "value"
+    assert make_cache().get_or_compute("key", lambda: 1 / 0) == "value"
+    assert cache.get_or_compute("other", lambda: "computed") == "computed"
+    assert make_cache().get("other") == "computed"
+
+
+def wait_for_writers(cache):
+    for _ in range(500):
+        if not cache._writers:
+            return
+        time.sleep(0.01)
+    raise AssertionError("writer threads still running")
+
+
+def test_disk_cache_write_through(tmpdir):
+    cache = DiskCache(str(tmpdir), max_bytes=100)
+    calls = []
+    first_chunk_sent = threading.Event()
+
+    def producer():
+        calls.append(1)
+        yield b"x" * 10
+        assert first_chunk_sent.wait(5)
+        time.sleep(0.1)
+        yield b"y" * 10
+
+    stream = cache.write_through("a", producer)
+    # Streamed before the entry is complete
+    assert next(stream) == b"x" * 10
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(b"".join(cache.write_through("a", producer)))
+        )
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    first_chunk_sent.set()
+    assert list(stream) == [b"y" * 10]
+    for thread in threads:
+        thread.join()
+    assert results == [b"x" * 10 + b"y" * 10] * 3
+    assert len(calls) == 1
+    wait_for_writers(cache)
+    assert cache.get("a") == b"x" * 10 + b"y" * 10
+
+    # Entries larger than the cache are still streamed.
+    assert b"".join(cache.write_through("b", lambda: [b"z" * 200])) == b"z" * 200
+    wait_for_writers(cache)
+    assert cache.get("b") is None
+
+
+def test_disk_cache_write_through_failure(tmpdir):
+    cache = DiskCache(str(tmpdir))
+    calls = []
+    release = threading.Event()
+
+    def producer():
+        calls.append(1)
+        yield b"x" * 10
+        release.wait(5)
+        yield b"y" * 10
+
+    with mock.patch("os.replace", side_effect=OSError):
+        stream = cache.write_through("a", producer)
+        assert next(stream) == b"x" * 10
+        release.set()
+        assert b"".join(stream) == b"y" * 10
+        wait_for_writers(cache)
+    assert len(calls) == 1
+    assert cache.get("a") is None
+    # The temporary file was removed.
+    assert not [name for _, _, names in os.walk(str(tmpdir)) for name in names]
+
+    # Failing to write before anything was read: `producer` is called again.
+    with mock.patch("tempfile.mkstemp", side_effect=OSError):
+        assert b"".join(cache.write_through("b", producer)) == b"x" * 10 + b"y" * 10
+        wait_for_writers(cache)
+    assert len(calls) == 3
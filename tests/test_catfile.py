@@ -0,0 +1,110 @@
+import threading
+import time
+from unittest import mock
+
+import dulwich.repo
+import pytest
+
+from klaus.catfile import BATCH, CatFileError, CatFilePool, CatFileProcess
+
+from .utils import TEST_REPO
+
+
+@pytest.fixture
+def pool():
+    pool = CatFilePool(TEST_REPO, max_processes=2, idle_timeout=60)
+    yield pool
+    pool.close()
+
+
+def test_read_objects(pool):
+    repo = dulwich.repo.Repo(TEST_REPO)
+    head = repo[repo.head()]
+    tree = repo[head.tree]
+    blob_sha = tree[b"test.c"][1]
+
+    assert pool.read_object(blob_sha) == (b"blob", b"int a;\n")
+    assert pool.object_info(blob_sha) == (b"blob", 7)
+    assert pool.object_info(head.tree) == (b"tree", len(tree.as_raw_string()))
+    [(sha, type_name, data)] = pool.read_objects([b"HEAD"])
+    assert (sha, type_name, data) == (head.id, b"commit", head.as_raw_string())
+
+
+def test_missing(pool):
+    with pytest.raises(KeyError):
+        pool.read_object(b"0" * 40)
+    with pytest.raises(KeyError):
+        pool.object_info(b"0" * 40)
+    # The process is still usable afterwards
+    assert pool.object_info(b"HEAD")[0] == b"commit"
+
+
+def test_iter_blob(pool):
+    repo = dulwich.repo.Repo(TEST_REPO)
+    blob_sha = repo[repo[repo.head()].tree][b"test.c"][1]
+    assert list(pool.iter_blob(blob_sha, chunk_size=3)) == [b"int", b" a;", b"\n"]
+    assert b"".join(pool.iter_blob(blob_sha, 2, 5, chunk_size=2)) == b"t a"
+    with pytest.raises(CatFileError):
+        list(pool.iter_blob(blob_sha, 0, 100))
+    with pytest.raises(CatFileError):
+        list(pool.iter_blob(b"0" * 40, 0, 1))
+
+
+def test_crash_recovery(pool):
+    pool.read_object(b"HEAD")
+    [proc] = pool._idle[BATCH]
+    proc._proc.kill()
+    proc._proc.wait()
+    assert pool.read_object(b"HEAD")[0] == b"commit"
+    assert pool._num_processes[BATCH] == 1
+
+
+def test_bounded(pool):
+    barrier = threading.Barrier(8, timeout=10)
+    errors = []
+
+    def reader():
+        try:
+            barrier.wait()
+            for _ in range(20):
+                pool.read_object(b"HEAD")
+                assert pool._num_processes[BATCH] <= 2
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=reader) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len(pool._idle[BATCH]) <= 2
+
+
+def test_idle_reaping():
+    pool = CatFilePool(TEST_REPO, idle_timeout=0.2)
+    pool.read_object(b"HEAD")
+    assert pool._num_processes[BATCH] == 1
+    time.sleep(1)
+    assert pool._num_processes[BATCH] == 0
+    assert not pool._idle[BATCH]
+
+
+def test_close_outside_lock(pool):
+    closed_with_lock = []
+    close = CatFileProcess.close
+
+    def checked_close(proc):
+        closed_with_lock.append(pool._cond._is_owned())
+        close(proc)
+
+    with mock.patch.object(CatFileProcess, "close", checked_close):
+        pool.read_object(b"HEAD")
+        [proc] = pool._idle[BATCH]
+        proc._proc.kill()
+        proc._proc.wait()
+        pool.read_object(b"HEAD")  # Closes the dead process
+        pool.idle_timeout = 0
+        pool.object_info(b"HEAD")  # Reaps the idle BATCH process
+        pool.close()
+    assert closed_with_lock == [False] * 3
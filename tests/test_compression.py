@@ -0,0 +1,54 @@
+import gzip
+import os
+
+import klaus
+from klaus.compression import CompressionMiddleware
+
+from .utils import *
+
+
+def make_client():
+    return klaus.make_app([TEST_REPO], TEST_SITE_NAME, compress=True).test_client()
+
+
+def test_compress_pages():
+    client = make_client()
+    url = "/test_repo/blob/master/test.c"
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"].startswith("W/")
+    uncompressed = client.get(url)
+    assert "Content-Encoding" not in uncompressed.headers
+    assert uncompressed.data == gzip.decompress(response.data)
+
+    etag = response.headers["ETag"]
+    response = client.get(
+        url, headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+
+def test_dont_compress_binary():
+    client = make_client()
+    headers = {"Accept-Encoding": "gzip"}
+    response = client.get("/test_repo/raw/master/test.c", headers=headers)
+    assert "Content-Encoding" not in response.headers
+    assert response.data == b"int a;\n"
+    response = client.get("/test_repo/tarball/master/", headers=headers)
+    assert "Content-Encoding" not in response.headers
+
+
+def test_precompressed_static_files():
+    static_folder = os.path.join(os.path.dirname(klaus.__file__), "static")
+    middleware = CompressionMiddleware(None, static_folder)
+    path, _, variants = middleware.static_files["/static/klaus.css"]
+    with open(path, "rb") as f:
+        assert gzip.decompress(variants["gzip"]) == f.read()
+    assert "/static/favicon.png" not in middleware.static_files
+
+    client = make_client()
+    response = client.get("/static/klaus.css", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.data == variants["gzip"]
+    assert response.headers["Content-Length"] == str(len(variants["gzip"]))
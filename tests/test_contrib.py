@@ -35,6 +35,9 @@ def test_minimum_env(monkeypatch):
             disable_push=False,
             unauthenticated_push=False,
             ctags_policy="none",
+            cache_dir=None,
+            compress=False,
+            inline_css=False,
         ),
     )
 
@@ -52,6 +55,9 @@ def test_complete_env(monkeypatch):
             "KLAUS_DISABLE_PUSH": "false",
             "KLAUS_UNAUTHENTICATED_PUSH": "0",
             "KLAUS_CTAGS_POLICY": "ALL",
+            "KLAUS_CACHE_DIR": "/tmp/klaus-cache",
+            "KLAUS_COMPRESS": "yes",
+            "KLAUS_INLINE_CSS": "1",
         },
         ([TEST_REPO_NO_NAMESPACE], TEST_SITE_NAME),
         dict(
@@ -61,6 +67,9 @@ def test_complete_env(monkeypatch):
             disable_push=False,
             unauthenticated_push=False,
             ctags_policy="ALL",
+            cache_dir="/tmp/klaus-cache",
+            compress=True,
+            inline_css=True,
         ),
     )
 
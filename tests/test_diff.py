@@ -0,0 +1,76 @@
+from unittest import mock
+
+import pytest
+import requests
+
+from klaus.diff import compact_file_change, dump_compact_diff, load_diff, render_diff
+from klaus.repo import FancyRepo
+
+from .utils import *
+
+
+def test_dump_load_roundtrip():
+    for path in [TEST_REPO_NO_NEWLINE, TEST_REPO_DONT_RENDER, TEST_REPO]:
+        repo = FancyRepo(path, None)
+        summary, file_changes = diff = repo.commit_diff(repo.get_commit("HEAD"))
+        compact_file_changes = list(map(compact_file_change, file_changes))
+        assert load_diff(dump_compact_diff(summary, compact_file_changes)) == diff
+
+
+def test_commit_diff_cache(tmpdir):
+    repo = FancyRepo(TEST_REPO_NO_NEWLINE, None, cache_dir=str(tmpdir))
+    commit = repo.get_commit("HEAD")
+    expected = repo.commit_diff(commit)
+    with mock.patch.object(FancyRepo, "_iter_diff") as iter_diff:
+        assert repo.commit_diff(commit) == expected
+        other_repo = FancyRepo(TEST_REPO_NO_NEWLINE, None, cache_dir=str(tmpdir))
+        assert other_repo.commit_diff(commit) == expected
+    assert not iter_diff.called
+
+
+def test_iter_commit_diff(tmpdir):
+    repo = FancyRepo(TEST_REPO, None, cache_dir=str(tmpdir))
+    root_commit = repo.history(repo.get_commit("HEAD"))[-1]
+    with mock.patch("klaus.repo.render_diff", wraps=render_diff) as render:
+        summary, file_changes = repo.iter_commit_diff(root_commit)
+        next(file_changes)
+        assert render.call_count == 1
+        assert repo.get_cached_commit_diff(root_commit) is None
+        rest = list(file_changes)
+    assert summary == {"nfiles": 4, "nadditions": 3, "ndeletions": 0, "ndeferred": 0}
+    assert len(rest) == 3
+    assert repo.get_cached_commit_diff(root_commit)[0] == summary
+
+
+def test_streamed_commit_view():
+    with serve():
+        response = requests.get(UNAUTH_TEST_REPO_NO_NEWLINE_URL + "commit/HEAD/")
+        assert "getElementById('summary-nfiles').textContent = 1;" in response.text
+
+
+def test_diff_budget(tmpdir):
+    repo = FancyRepo(TEST_REPO, None, cache_dir=str(tmpdir))
+    root_commit = repo.history(repo.get_commit("HEAD"))[-1]
+    with mock.patch.object(
+        repo, "get_object_info", wraps=repo.get_object_info
+    ) as get_object_info:
+        summary, file_changes = repo.iter_commit_diff(root_commit, {"files": 1})
+        file_changes = list(file_changes)
+    # Sizes aren't looked up once the budget is used up.
+    assert get_object_info.call_count <= 2
+    assert summary["ndeferred"] == 3
+    assert [change["is_deferred"] for change in file_changes[1:]] == [True] * 3
+    assert repo.get_cached_commit_diff(root_commit) is None
+    assert repo.get_cached_commit_diff(root_commit, {"files": 2}) is None
+    cached_summary, cached_file_changes = repo.get_cached_commit_diff(
+        root_commit, {"files": 1}
+    )
+    assert cached_summary == summary
+    assert cached_file_changes[0]["chunks"] == file_changes[0]["chunks"]
+    assert cached_file_changes[1:] == file_changes[1:]
+
+    change = repo.file_diff(root_commit, "test.c")
+    assert change["new_filename"] == b"test.c"
+    assert (change["additions"], change["deletions"]) == (1, 0)
+    with pytest.raises(KeyError):
+        repo.file_diff(repo.get_commit("HEAD"), "test.c")
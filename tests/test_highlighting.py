@@ -0,0 +1,84 @@
+import re
+from unittest import mock
+
+from pygments.lexers import guess_lexer
+
+from klaus.cache import LRUCache
+from klaus.highlighting import (
+    LEXER_GUESS_SAMPLE_SIZE,
+    get_lexer,
+    highlight_blocks,
+    highlight_or_render,
+)
+
+
+def test_highlight_cache():
+    cache = LRUCache()
+    html = highlight_or_render("int a;\n", "test.c", cache=cache, blob_sha=b"1")
+    assert "<span class=line>" in html
+    with mock.patch("klaus.highlighting.highlight") as highlight:
+        assert (
+            highlight_or_render("int a;\n", "other.c", cache=cache, blob_sha=b"1")
+            == html
+        )
+        assert not highlight.called
+        # Different lexer.
+        highlight_or_render("int a;\n", "test.js", cache=cache, blob_sha=b"1")
+        assert highlight.called
+    assert len(cache) == 2
+
+    # Without a SHA, nothing is cached.
+    highlight_or_render("int a;\n", "test.c", cache=cache)
+    assert len(cache) == 2
+
+
+def test_get_lexer():
+    assert get_lexer("", "test.py").name == "Python"
+    assert get_lexer("#!/usr/bin/env python3.11\n", "script").name == "Python"
+    assert get_lexer("#!/bin/sh -e\n", "script").name == "Bash"
+    assert get_lexer("x = 1\n\n# vim: set ft=ruby:\n", "script").name == "Ruby"
+    assert get_lexer("# -*- mode: perl -*-\n", "script").name == "Perl"
+    assert get_lexer("int a;\n", "script", language="C++").name == "C++"
+    assert get_lexer("int a;\n", "test.c", language="Unknown").name == "C"
+
+
+def test_get_lexer_sample_and_cache():
+    code = "x\n" * 100000
+    with mock.patch("klaus.highlighting.guess_lexer", wraps=guess_lexer) as guess:
+        lexer = get_lexer(code, "README", blob_sha=b"2")
+        assert len(guess.call_args[0][0]) == LEXER_GUESS_SAMPLE_SIZE
+        assert get_lexer(code, "README", blob_sha=b"2").name == lexer.name
+        assert guess.call_count == 1
+
+
+def test_highlight_blocks():
+    code = 'x = 1\n"""\ndocstring\n"""\n' * 3
+    pieces = list(highlight_blocks([code], "test.py", block_lines=3))
+    assert len(pieces) == 2 + 4
+    html = "".join(pieces)
+    assert html.count("<table") == html.count("</table>") == 1
+    assert re.findall(r'<a id="L-(\d+)"', html) == [str(i) for i in range(1, 13)]
+
+    # Same highlighting as in one piece, even for the string spanning pieces.
+    def token_classes(html):
+        return re.findall(r'<span class="(\w+)">[^<]', html)
+
+    assert token_classes(html) == token_classes(highlight_or_render(code, "test.py"))
+
+    html = "".join(highlight_blocks([code], "test.py", time_limit=0))
+    assert 'class="n"' not in html
+    assert re.findall(r'<a id="L-(\d+)"', html) == [str(i) for i in range(1, 13)]
+
+
+def test_highlight_blocks_lexed_in_pieces():
+    code = 'x = 1\r\n"""\r\ndocstring\r\n\r\n"""\r\n' * 3
+    # Split in the middle of lines and of "\r\n"
+    chunks = [code[i : i + 7] for i in range(0, len(code), 7)]
+    html = "".join(highlight_blocks(chunks, "test.py", piece_size=20))
+    assert re.findall(r'<a id="L-(\d+)"', html) == [str(i) for i in range(1, 16)]
+    assert "\r" not in html
+    # Pieces end at the blank lines within the docstrings, so the code
+    # following them is lexed as part of a string.
+    assert html.count('<span class="n">x</span>') < 3
+    one_piece = "".join(highlight_blocks(chunks, "test.py"))
+    assert one_piece.count('<span class="n">x</span>') == 3
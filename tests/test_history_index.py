@@ -0,0 +1,154 @@
+import os
+import subprocess
+from unittest import mock
+
+import dulwich.repo
+import pytest
+
+from klaus.historyindex import MAGIC, HistoryIndex
+
+from .utils import make_git_repo
+
+PATHS = [b"a.txt", b"dir", b"dir/b.txt", b"dir/sub/c.txt", b"gone", b"never"]
+
+
+@pytest.fixture
+def repo_dir(tmp_path):
+    tmp = str(tmp_path)
+    git = make_git_repo(tmp)
+
+    def commit(msg, **files):
+        for name, content in files.items():
+            path = os.path.join(tmp, name.replace("__", "/"))
+            if content is None:
+                git("rm", "-rq", path)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(content)
+            git("add", path)
+        git("commit", "-qm", msg, "--allow-empty")
+
+    commit("1", a__txt="1", gone="x")
+    commit("2", dir__b__txt="1")
+    commit("3", dir__sub__c__txt="1")
+    git("checkout", "-qb", "side")
+    commit("4", a__txt="2")
+    commit("5", dir__b__txt="2")
+    git("checkout", "-q", "master")
+    commit("6", dir__sub__c__txt="2", gone=None)
+    git("merge", "-q", "--no-edit", "side")
+    commit("8", a__txt="3")
+    git("checkout", "-qb", "side2", "HEAD~3")
+    commit("9", dir__b__txt="3")
+    git("checkout", "-q", "master")
+    git("merge", "-q", "--no-edit", "-s", "ours", "side2")
+    commit("11")
+
+    return tmp, git, commit
+
+
+def git_log(repo_dir, path, max_commits=None, skip=0):
+    cmd = ["git", "log", "--format=%H", "--skip=%d" % skip]
+    if max_commits:
+        cmd.append("--max-count=%d" % max_commits)
+    cmd.extend(["master", "--", path.decode()])
+    return subprocess.check_output(cmd, cwd=repo_dir).split()
+
+
+def index_log(index, repo, path, max_commits=None, skip=0):
+    return index.history(repo.head(), path, max_commits, skip)
+
+
+def test_matches_git_log(repo_dir):
+    repo_dir, _, _ = repo_dir
+    repo = dulwich.repo.Repo(repo_dir)
+    index = HistoryIndex(repo)
+    assert index_log(index, repo, b"a.txt") is None
+    index.update(repo.head())
+    for path in PATHS:
+        assert index_log(index, repo, path) == git_log(repo_dir, path), path
+        assert index_log(index, repo, path, 2, 1) == git_log(repo_dir, path, 2, 1)
+
+
+def test_persistence_and_incremental_update(repo_dir):
+    repo_dir, git, commit = repo_dir
+    filename = os.path.join(repo_dir, "index-dir", "history-index")
+    repo = dulwich.repo.Repo(repo_dir)
+    index = HistoryIndex(repo, filename)
+    index.update(repo.head())
+    assert len(HistoryIndex(repo, filename)) == len(index) == 11
+
+    commit("12", dir__b__txt="4")
+    repo = dulwich.repo.Repo(repo_dir)
+    index = HistoryIndex(repo, filename)
+    assert index_log(index, repo, b"dir") is None
+    index.update(repo.head())
+    assert len(index) == 12
+
+    reloaded = HistoryIndex(repo, filename)
+    assert len(reloaded) == 12
+    for path in PATHS:
+        assert index_log(reloaded, repo, path) == git_log(repo_dir, path), path
+
+
+def test_truncated_file(repo_dir):
+    repo_dir, _, _ = repo_dir
+    filename = os.path.join(repo_dir, "history-index")
+    repo = dulwich.repo.Repo(repo_dir)
+    HistoryIndex(repo, filename).update(repo.head())
+    with open(filename, "r+b") as f:
+        f.truncate(os.path.getsize(filename) - 3)
+    index = HistoryIndex(repo, filename)
+    assert len(index) == 10
+    index.update(repo.head())
+    assert len(HistoryIndex(repo, filename)) == 11
+
+
+def test_duplicate_record(repo_dir):
+    repo_dir, _, _ = repo_dir
+    filename = os.path.join(repo_dir, "history-index")
+    repo = dulwich.repo.Repo(repo_dir)
+    HistoryIndex(repo, filename).update(repo.head())
+    with open(filename, "r+b") as f:
+        data = f.read()
+        f.write(data[len(MAGIC) :])
+    with pytest.warns(UserWarning, match="Duplicate"):
+        index = HistoryIndex(repo, filename)
+    assert len(index) == 0
+    with pytest.warns(UserWarning, match="Duplicate"):
+        index.update(repo.head())
+    assert os.path.getsize(filename) == len(data)
+    reloaded = HistoryIndex(repo, filename)
+    assert len(reloaded) == 11
+    for path in PATHS:
+        assert index_log(reloaded, repo, path) == git_log(repo_dir, path), path
+
+
+def test_paging_resumes_walk(repo_dir):
+    repo_dir, _, _ = repo_dir
+    repo = dulwich.repo.Repo(repo_dir)
+    index = HistoryIndex(repo)
+    index.update(repo.head())
+    assert index_log(index, repo, b"dir", 2) == git_log(repo_dir, b"dir", 2)
+    (walk,) = index._walks._entries.values()
+    with mock.patch.object(walk[0], "_simplify", wraps=walk[0]._simplify) as simplify:
+        assert index_log(index, repo, b"dir", 2) == git_log(repo_dir, b"dir", 2)
+        assert not simplify.called
+        assert index_log(index, repo, b"dir", 2, 2) == git_log(repo_dir, b"dir", 2, 2)
+    assert simplify.called
+
+
+def test_shallow_clone(repo_dir, tmp_path_factory):
+    clone_dir = str(tmp_path_factory.mktemp("clone"))
+    subprocess.check_call(
+        ["git", "clone", "-q", "--depth", "2", "file://" + repo_dir[0], clone_dir]
+    )
+    repo = dulwich.repo.Repo(clone_dir)
+    index = HistoryIndex(repo)
+    with pytest.warns(UserWarning, match="missing"):
+        index._update_and_reset(repo.head())
+    assert index.disabled
+    with mock.patch.object(index, "update_in_background") as update_in_background:
+        assert index_log(index, repo, b"a.txt") is None
+    assert not update_in_background.called
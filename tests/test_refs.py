@@ -0,0 +1,105 @@
+import os
+from unittest import mock
+
+import pytest
+
+from klaus.repo import FancyRepo, _commit_time_cache, _ref_target_cache
+
+from .utils import make_git_repo
+
+
+@pytest.fixture
+def repo_dir(tmp_path):
+    tmp = str(tmp_path)
+    git = make_git_repo(tmp)
+    git("commit", "-q", "--allow-empty", "-m", "1", date=100)
+    git("tag", "-a", "-m", "annotated", "annotated", date=300)
+    git("checkout", "-qb", "newer")
+    git("commit", "-q", "--allow-empty", "-m", "2", date=200)
+    git("tag", "lightweight")
+    git("checkout", "-q", "master")
+    return tmp, git
+
+
+def test_ref_names(repo_dir):
+    repo = FancyRepo(repo_dir[0], None)
+    assert repo.get_branch_names() == ["newer", "master"]
+    assert repo.get_branch_names(exclude="newer") == ["master"]
+    assert repo.get_tag_names() == ["annotated", "lightweight"]
+    snapshot = repo.get_ref_snapshot()
+    master = snapshot.refs[b"refs/heads/master"]
+    assert snapshot.peeled[b"refs/tags/annotated"] == master
+    assert snapshot.refs[b"refs/tags/annotated"] != master
+    assert repo.get_tag_and_branch_shas() == {
+        master,
+        snapshot.refs[b"refs/heads/newer"],
+        snapshot.refs[b"refs/tags/annotated"],
+    }
+
+
+def test_ref_snapshot_invalidation(repo_dir):
+    repo_dir, git = repo_dir
+    repo = FancyRepo(repo_dir, None)
+    snapshot = repo.get_ref_snapshot()
+    with mock.patch.object(repo.dulwich_repo.refs, "as_dict") as as_dict:
+        assert repo.get_ref_snapshot() is snapshot
+        assert not as_dict.called
+
+    git("commit", "-q", "--allow-empty", "-m", "3", date=400)
+    assert repo.get_branch_names() == ["master", "newer"]
+    git("checkout", "-qb", "nested/branch")
+    assert repo.get_branch_names() == ["master", "nested/branch", "newer"]
+    git("pack-refs", "--all")
+    git("branch", "-qD", "newer")
+    assert repo.get_branch_names() == ["master", "nested/branch"]
+    assert repo.get_ref_snapshot().token != snapshot.token
+
+
+def test_split_rev_and_path(repo_dir):
+    repo_dir, git = repo_dir
+    git("branch", "feature/x")
+    git("tag", "feature")
+    repo = FancyRepo(repo_dir, None)
+    master = repo.get_commit("master")
+
+    assert repo.split_rev_and_path("master") == ("master", "", master)
+    assert repo.split_rev_and_path("master/a/b.py")[:2] == ("master", "a/b.py")
+    assert repo.split_rev_and_path("feature/x/a")[:2] == ("feature/x", "a")
+    assert repo.split_rev_and_path("feature/y/a")[:2] == ("feature", "y/a")
+    assert repo.split_rev_and_path("refs/tags/annotated/a") == (
+        "refs/tags/annotated",
+        "a",
+        master,
+    )
+    sha = master.id.decode()
+    assert repo.split_rev_and_path(sha + "/a") == (sha, "a", master)
+    with pytest.raises(KeyError):
+        repo.split_rev_and_path("nonexisting/a")
+    with open(os.path.join(repo_dir, ".git", "FETCH_HEAD"), "w") as f:
+        f.write("%s\t\tbranch 'x' of y\n" % master.id.decode())
+    assert repo.split_rev_and_path("FETCH_HEAD/a") == ("FETCH_HEAD", "a", master)
+    with pytest.raises(KeyError):
+        repo.split_rev_and_path("0" * 40 + "/a")
+
+    with mock.patch.object(repo, "get_commit", side_effect=KeyError):
+        with pytest.raises(KeyError):
+            repo.split_rev_and_path("a/b/c/d/e/f/g/h")
+        assert repo.get_commit.call_count == 1
+
+
+def test_missing_ref_target_not_cached(repo_dir):
+    repo = FancyRepo(repo_dir[0], None)
+    sha = b"1" * 40
+    assert repo._get_ref_target(sha) == (sha, 0)
+    # Another repository may have the object.
+    assert _ref_target_cache.get(sha) is None
+
+
+def test_missing_commit_time_not_cached(repo_dir):
+    repo_dir = repo_dir[0]
+    sha = b"1" * 40
+    with open(os.path.join(repo_dir, ".git", "refs", "heads", "broken"), "wb") as f:
+        f.write(sha + b"\n")
+    repo = FancyRepo(repo_dir, None)
+    assert repo.get_last_updated_at() == 1500000200
+    assert _commit_time_cache.get(sha, "missing") == "missing"
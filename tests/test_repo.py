@@ -0,0 +1,109 @@
+import stat
+import threading
+from unittest import mock
+
+import dulwich.objects
+import pytest
+
+from klaus.repo import FancyRepo
+
+from .utils import TEST_REPO, make_git_repo
+
+
+def test_lookup_path():
+    repo = FancyRepo(TEST_REPO, None)
+    tree = repo.get_commit("HEAD").tree
+    folder_mode, folder_sha = repo.lookup_path(tree, "folder")
+    assert stat.S_ISDIR(folder_mode)
+    assert repo.lookup_path(tree, b"folder/") == (folder_mode, folder_sha)
+    assert repo.lookup_path(tree, "") == (stat.S_IFDIR, tree)
+    mode, sha = repo.lookup_path(tree, "folder/test.txt")
+    assert stat.S_ISREG(mode)
+    assert repo[sha].data == b"\n"
+    for path in ["nonexisting", "folder/nonexisting", "test.c/test.c"]:
+        with pytest.raises(KeyError):
+            repo.lookup_path(tree, path)
+
+    assert isinstance(
+        repo.get_blob_or_tree(repo.get_commit("HEAD"), "folder"), dulwich.objects.Tree
+    )
+    assert repo.get_blob_or_tree(repo.get_commit("HEAD"), "test.c").data == b"int a;\n"
+
+
+def test_lookup_path_cached():
+    repo = FancyRepo(TEST_REPO, None)
+    tree = repo.get_commit("HEAD").tree
+    expected = repo.lookup_path(tree, "folder/test.txt")
+    with mock.patch.object(FancyRepo, "__getitem__") as getitem:
+        assert repo.lookup_path(tree, "folder/test.txt") == expected
+        assert repo.get_tree(repo.lookup_path(tree, "folder")[1])
+        assert not getitem.called
+
+
+def test_listdir():
+    repo = FancyRepo(TEST_REPO, None)
+    commit = repo.get_commit("HEAD")
+    listing = repo.listdir(commit, "")
+    assert listing["dirs"] == [("folder", "folder")]
+    assert [name for name, _ in listing["files"]] == ["empty.txt", "test.c", "test.js"]
+    assert (listing["total"], listing["next_offset"]) == (4, None)
+    assert repo.listdir(commit, "folder")["dirs"] == [("..", "")]
+
+    window = repo.listdir(commit, "", limit=2)
+    assert window["dirs"] == [("folder", "folder")]
+    assert window["files"] == [("empty.txt", "empty.txt")]
+    assert (window["offset"], window["next_offset"]) == (0, 2)
+
+    window = repo.listdir(commit, "", limit=2, around="test.js")
+    assert window["dirs"] == []
+    assert window["files"] == [("test.c", "test.c"), ("test.js", "test.js")]
+    assert (window["offset"], window["next_offset"]) == (2, None)
+
+
+def test_get_attributes(tmp_path):
+    files = {
+        ".gitattributes": "*.h linguist-language=C++ text\n"
+        "/docs/** -text\n"
+        "[attr]binary -diff -merge -text\n",
+        "sub/.gitattributes": "*.h linguist-language=C\n"
+        "gen/*.h !text\n"
+        "**/x?.[ch] generated\n",
+    }
+    for path in ["a.h", "docs/a.h", "sub/a.h", "sub/gen/a.h", "sub/q/xy.c", "b.c"]:
+        files[path] = ""
+    for path, content in files.items():
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(content)
+    git = make_git_repo(tmp_path)
+    git("add", ".")
+    git("commit", "-qm", "1")
+
+    repo = FancyRepo(str(tmp_path), None)
+    commit = repo.get_commit("HEAD")
+    for path in files:
+        expected = {}
+        output = git("check-attr", "-a", "--", path).decode()
+        for line in output.splitlines():
+            _, name, value = line.split(": ")
+            expected[name] = {"set": True, "unset": False}.get(value, value)
+        assert repo.get_attributes(commit, path) == expected, path
+
+
+def test_concurrent_object_reads():
+    repo = FancyRepo(TEST_REPO, None)
+    commit = repo.get_commit("HEAD")
+    inside = threading.Barrier(2, timeout=5)
+    lent = []
+
+    def reader():
+        with repo._dulwich_repo() as dulwich_repo:
+            lent.append(dulwich_repo)
+            inside.wait()  # Would time out if readers were serialized
+            assert dulwich_repo[commit.id] == commit
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    reader()
+    thread.join()
+    assert lent[0] is not lent[1]
+    assert sorted(map(id, repo._dulwich_repos)) == sorted(map(id, lent))
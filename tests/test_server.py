@@ -0,0 +1,131 @@
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from klaus.server import PooledWSGIServer
+
+
+def pid_app(environ, start_response):
+    body = ("%d %s" % (os.getpid(), environ["REMOTE_PORT"])).encode()
+    start_response("200 OK", [("Content-Length", str(len(body)))])
+    return [body]
+
+
+def start(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def get(port, connection=None):
+    connection = connection or http.client.HTTPConnection("localhost", port)
+    connection.request("GET", "/")
+    response = connection.getresponse()
+    return response.status, response.read().decode()
+
+
+def test_keepalive():
+    server = PooledWSGIServer("localhost", 0, pid_app, threads=2)
+    start(server)
+    try:
+        connection = http.client.HTTPConnection("localhost", server.server_port)
+        assert get(server.server_port, connection) == get(
+            server.server_port, connection
+        )
+    finally:
+        server.stop()
+
+
+def test_idle_keepalive_connections():
+    server = PooledWSGIServer("localhost", 0, pid_app, threads=2)
+    start(server)
+    try:
+        idle = []
+        for _ in range(4):
+            connection = http.client.HTTPConnection("localhost", server.server_port)
+            get(server.server_port, connection)
+            idle.append(connection)
+        # Idle connections don't block any threads.
+        started = time.monotonic()
+        assert get(server.server_port)[0] == 200
+        assert time.monotonic() - started < 1
+        # They can still be used.
+        assert get(server.server_port, idle[0])[0] == 200
+    finally:
+        server.stop()
+
+
+def test_queue_limit():
+    entered = threading.Event()
+    release = threading.Event()
+
+    def blocking_app(environ, start_response):
+        entered.set()
+        release.wait()
+        return pid_app(environ, start_response)
+
+    server = PooledWSGIServer("localhost", 0, blocking_app, threads=1, queue_size=1)
+    start(server)
+    try:
+        busy = socket.create_connection(("localhost", server.server_port))
+        busy.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        assert entered.wait(5)
+        queued = socket.create_connection(("localhost", server.server_port))
+        queued.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        time.sleep(0.2)
+        assert get(server.server_port)[0] == 503
+        release.set()
+        assert b"200 OK" in busy.recv(1000)
+        assert b"200 OK" in queued.recv(1000)
+    finally:
+        release.set()
+        server.stop()
+
+
+def test_max_requests():
+    server = PooledWSGIServer("localhost", 0, pid_app, max_requests=2)
+    thread = start(server)
+    get(server.server_port)
+    get(server.server_port)
+    thread.join(5)
+    assert not thread.is_alive()
+    server.server_close()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_worker_processes():
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    code = (
+        "from klaus.server import serve; from tests.test_server import pid_app; "
+        "serve(pid_app, 'localhost', %d, processes=2, max_requests=3)" % port
+    )
+    proc = subprocess.Popen([sys.executable, "-c", code], stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(300):
+            try:
+                socket.create_connection(("localhost", port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        pids = set()
+        for _ in range(10):
+            status, body = get(port)
+            assert status == 200
+            pids.add(body.split()[0])
+        # Each worker is replaced after 3 requests.
+        assert len(pids) >= 4
+        assert str(proc.pid) not in pids
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(10) == 0
@@ -35,3 +35,17 @@ class TarballBasenameTests(unittest.TestCase):
         ]
         for rev, basename in examples:
             self.assertEqual(utils.tarball_basename("klaus", rev), basename)
+
+
+class IterUnicodeTests(unittest.TestCase):
+    def test_split_characters(self):
+        data = "f\xce\n".encode("utf8") * 3
+        chunks = [data[i : i + 1] for i in range(len(data))]
+        self.assertEqual("".join(utils.iter_unicode(chunks, 2)), "f\xce\n" * 3)
+
+    def test_same_as_force_unicode(self):
+        data = "f\xce\n".encode("latin1") * 3
+        self.assertEqual(
+            "".join(utils.iter_unicode([data, data], 1)),
+            utils.force_unicode(data + data),
+        )
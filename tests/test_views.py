@@ -1,9 +1,16 @@
 import contextlib
+import re
 import tarfile
+import time
+import zipfile
 from io import BytesIO
+from unittest import mock
 
+import dulwich.archive
 import requests
 
+from klaus.repo import FancyRepo
+
 from .utils import *
 
 
@@ -68,13 +75,35 @@ def test_render_image():
 
 
 def test_dont_render_large_file():
-    with serve():
+    with serve(), mock.patch("klaus.views.MAX_STREAMED_HIGHLIGHT_SIZE", 100 * 1024):
         response = requests.get(
             UNAUTH_TEST_REPO_DONT_RENDER_URL + "blob/HEAD/toolarge"
         ).text
         assert "Large file not shown" in response
 
 
+def test_render_large_file_streamed():
+    url = UNAUTH_TEST_REPO_DONT_RENDER_URL + "blob/HEAD/toolarge"
+    with serve():
+        response = requests.get(url)
+        assert "Content-Length" not in response.headers
+        assert "Large file not shown" not in response.text
+        assert response.text.count("<table") == 1
+        assert 'id="L-102400"' in response.text
+        with mock.patch("klaus.views.STREAMED_HIGHLIGHT_TIME_LIMIT", 0):
+            assert 'id="L-102400"' in requests.get(url).text
+
+
+def test_large_file_not_read_into_memory():
+    app = klaus.make_app([TEST_REPO_DONT_RENDER], TEST_SITE_NAME)
+    with mock.patch.object(
+        FancyRepo, "get_blob_or_tree", side_effect=AssertionError
+    ) as get_blob_or_tree:
+        response = app.test_client().get("/dont-render/blob/HEAD/toolarge")
+        assert 'id="L-102400"' in response.get_data(as_text=True)
+    assert not get_blob_or_tree.called
+
+
 def test_regression_gh233_treeview_paths():
     with serve():
         response = requests.get(UNAUTH_TEST_REPO_URL + "tree/HEAD/folder").text
@@ -87,3 +116,201 @@ def test_display_invalid_repos():
         response = requests.get(UNAUTH_TEST_SERVER).text
         assert '<ul class="repolist invalid">' in response
         assert "<div class=name>invalid_repo</div>" in response
+
+
+def test_tree_entries():
+    with serve():
+        response = requests.get(
+            UNAUTH_TEST_REPO_URL + "tree-entries/HEAD/?offset=1&limit=2&direction=next"
+        ).text
+        assert "blob/HEAD/empty.txt" in response
+        assert "blob/HEAD/test.c" in response
+        assert "blob/HEAD/test.js" not in response
+        assert "folder" not in response
+        assert "Show 1 more entries" in response
+        assert "previous entries" not in response
+
+
+def test_file_lines():
+    with serve():
+        url = UNAUTH_TEST_REPO_DONT_RENDER_URL + "blob/HEAD/toolarge?lines=101-110"
+        response = requests.get(url).text
+        assert re.findall(r'<a id="L-(\d+)"', response) == [
+            str(i) for i in range(101, 111)
+        ]
+        assert "Show lines 91&ndash;100" in response
+        assert "Show lines 111&ndash;120" in response
+
+        response = requests.get(
+            UNAUTH_TEST_REPO_DONT_RENDER_URL
+            + "file-lines/HEAD/toolarge?lines=102391-102500&direction=next"
+        ).text
+        assert re.findall(r'<a id="L-(\d+)"', response)[-1] == "102400"
+        assert "Show lines" not in response
+
+        response = requests.get(UNAUTH_TEST_REPO_URL + "file-lines/HEAD/test.c")
+        assert response.status_code == 404
+
+        response = requests.get(UNAUTH_TEST_REPO_URL + "blame/HEAD/test.c?lines=1")
+        assert re.findall(r'<a id="L-(\d+)"', response.text) == ["1"]
+        assert "int" in response.text
+
+
+def test_etag():
+    with serve():
+        url = UNAUTH_TEST_REPO_URL + "blob/master/test.c"
+        response = requests.get(url)
+        assert response.headers["Cache-Control"] == "no-cache"
+        etag = response.headers["ETag"]
+        response = requests.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        response = requests.get(url + "?markup", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+
+
+def test_sha_pinned_cache_control():
+    with serve():
+        sha = FancyRepo(TEST_REPO, None).get_commit("master").id.decode()
+        response = requests.get(UNAUTH_TEST_REPO_URL + "raw/%s/test.c" % sha)
+        assert "immutable" in response.headers["Cache-Control"]
+        response = requests.get(UNAUTH_TEST_REPO_URL + "blob/%s/test.c" % sha)
+        assert "max-age" in response.headers["Cache-Control"]
+
+
+def test_page_cache(tmpdir):
+    def get(url, **kwargs):
+        app = klaus.make_app([TEST_REPO], TEST_SITE_NAME, cache_dir=str(tmpdir))
+        with mock.patch("klaus.views.highlight_or_render", return_value="x") as render:
+            response = app.test_client().get(url, **kwargs)
+        return response, render.call_count
+
+    response, render_count = get("/test_repo/blob/master/test.c")
+    assert (response.status_code, render_count) == (200, 1)
+    cached_response, render_count = get("/test_repo/blob/master/test.c")
+    assert (cached_response.status_code, render_count) == (200, 0)
+    assert cached_response.data == response.data
+    assert cached_response.headers["ETag"] == response.headers["ETag"]
+    assert get("/test_repo/blob/master/test.c?markup")[1] == 1
+    assert get("/test_repo/blob/master/nonexisting")[0].status_code == 404
+
+    # Links contain the URL prefix.
+    prefixed_response, render_count = get(
+        "/test_repo/blob/master/test.c", environ_overrides={"SCRIPT_NAME": "/git"}
+    )
+    assert render_count == 1
+    assert 'href="/git/test_repo/' in prefixed_response.text
+    assert prefixed_response.headers["ETag"] != response.headers["ETag"]
+
+
+def test_file_diff():
+    with serve():
+        repo = FancyRepo(TEST_REPO, None)
+        sha = repo.history(repo.get_commit("HEAD"))[-1].id.decode()
+        response = requests.get(UNAUTH_TEST_REPO_URL + "file-diff/%s/test.c" % sha)
+        assert response.status_code == 200
+        assert "int a;" in response.text
+        response = requests.get(UNAUTH_TEST_REPO_URL + "file-diff/HEAD/test.c")
+        assert response.status_code == 404
+
+
+def test_raw_range():
+    with serve():
+        url = UNAUTH_TEST_REPO_URL + "raw/master/test.c"
+        response = requests.get(url, headers={"Range": "bytes=1-3"})
+        assert response.status_code == 206
+        assert response.content == b"nt "
+        assert response.headers["Content-Range"] == "bytes 1-3/7"
+        response = requests.get(url, headers={"Range": "bytes=7-"})
+        assert response.status_code == 416
+        response = requests.head(url)
+        assert response.headers["Content-Length"] == "7"
+        assert response.headers["Accept-Ranges"] == "bytes"
+
+
+def test_raw_streamed():
+    app = klaus.make_app([TEST_REPO_DONT_RENDER], TEST_SITE_NAME)
+    with mock.patch("klaus.views.RAW_STREAM_THRESHOLD", 0):
+        response = app.test_client().get(
+            "/dont-render/raw/HEAD/toolarge", headers={"Range": "bytes=1-4"}
+        )
+        assert response.is_streamed
+        assert response.data == b"\ny\ny"
+
+
+def test_archive_cache(tmpdir):
+    app = klaus.make_app([TEST_REPO], TEST_SITE_NAME, cache_dir=str(tmpdir))
+    client = app.test_client()
+    with mock.patch(
+        "dulwich.archive.tar_stream", wraps=dulwich.archive.tar_stream
+    ) as tar_stream:
+        response = client.get("/test_repo/tarball/master/")
+        response.get_data()
+        while app.archive_cache._writers:
+            time.sleep(0.01)
+        cached_response = client.get("/test_repo/tarball/master/")
+    assert tar_stream.call_count == 1
+    assert cached_response.data == response.data
+    assert cached_response.headers["Content-Length"] == str(len(response.data))
+    tarball = tarfile.TarFile.gzopen("test.tar.gz", fileobj=BytesIO(response.data))
+    with contextlib.closing(tarball):
+        assert tarball.extractfile("test_repo@master/test.c").read() == b"int a;\n"
+
+
+def test_download_zip():
+    with serve():
+        response = requests.get(UNAUTH_TEST_REPO_URL + "archive/master.zip")
+        assert response.headers["Content-Type"] == "application/zip"
+        archive = zipfile.ZipFile(BytesIO(response.content))
+        assert archive.read("test_repo@master/test.c") == b"int a;\n"
+
+
+def test_static_fingerprints():
+    client = klaus.make_app([TEST_REPO], TEST_SITE_NAME).test_client()
+    page = client.get("/test_repo/").data.decode()
+    url = re.search(r'href="(/static/klaus.css\?v=\w+)"', page).group(1)
+    assert "immutable" in client.get(url).headers["Cache-Control"]
+    assert client.get("/static/klaus.css").headers["Cache-Control"] == "no-cache"
+    assert client.get("/static/klaus.css?v=old").headers["Cache-Control"] == "no-cache"
+
+
+def test_inline_css():
+    app = klaus.make_app([TEST_REPO], TEST_SITE_NAME, inline_css=True)
+    page = app.test_client().get("/test_repo/").data.decode()
+    assert page.count("<style>") == 2
+    assert "klaus.css" not in page
+
+
+def test_readme(tmp_path):
+    git = make_git_repo(tmp_path)
+    (tmp_path / "README.md").mkdir()
+    (tmp_path / "README.md" / "x").write_text("")
+    (tmp_path / "Readme.markdown").write_text("# Hello\n")
+    git("add", ".")
+    # A submodule
+    git("update-index", "--add", "--cacheinfo", "160000,%s,README" % ("1" * 40))
+    git("commit", "-qm", "1")
+    client = klaus.make_app([str(tmp_path)], TEST_SITE_NAME).test_client()
+    url = "/%s/" % tmp_path.name
+    readme_sha = git("rev-parse", "HEAD:Readme.markdown").strip()
+    with mock.patch("klaus.markup.render", wraps=klaus.markup.render) as render:
+        response = client.get(url)
+        with mock.patch.object(
+            FancyRepo, "get_objects", autospec=True, side_effect=FancyRepo.get_objects
+        ) as get_objects:
+            history_response = client.get(url + "tree/HEAD/")
+    assert ">Hello</h1>" in response.text
+    assert ">Hello</h1>" in history_response.text
+    # Rendered only once, cached by blob SHA, and not even read when cached.
+    assert render.call_count == 1
+    assert mock.call(mock.ANY, [readme_sha]) not in get_objects.call_args_list
+
+
+def test_relative_times_updated_by_client():
+    client = klaus.make_app([TEST_REPO], TEST_SITE_NAME).test_client()
+    commit = FancyRepo(TEST_REPO, None).get_commit("master")
+    # Cached pages would show outdated relative times, so klaus.js updates
+    # them from the timestamp.
+    for url in ["/test_repo/", "/test_repo/commit/master/"]:
+        response = client.get(url)
+        assert 'data-timestamp="%d"' % commit.commit_time in response.text
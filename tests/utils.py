@@ -1,5 +1,6 @@
 import contextlib
 import os
+import subprocess
 import threading
 import time
 
@@ -61,3 +62,33 @@ def serve_app(app):
         if os.getenv("CI"):
             # This fixes some "Address already in use" cases on CI.
             time.sleep(1)
+
+
+def make_git_repo(path):
+    """Create an empty Git repository (on branch "master") in `path`.
+
+    Return a function `git(*args, date=None)` that runs `git` in it and returns
+    its output.  Commits are made at `date` seconds after 1500000000, or, by
+    default, one minute after the previous `git` call.
+    """
+    env = dict(
+        os.environ,
+        HOME=os.path.abspath("tests/git-config"),
+        GIT_AUTHOR_NAME="a",
+        GIT_AUTHOR_EMAIL="a@example.com",
+        GIT_COMMITTER_NAME="a",
+        GIT_COMMITTER_EMAIL="a@example.com",
+    )
+    counter = [0]
+
+    def git(*args, date=None):
+        counter[0] += 1
+        if date is None:
+            date = counter[0] * 60
+        env["GIT_COMMITTER_DATE"] = env["GIT_AUTHOR_DATE"] = "%d +0000" % (
+            1500000000 + date
+        )
+        return subprocess.check_output(("git",) + args, cwd=path, env=env)
+
+    git("init", "-q", "-b", "master")
+    return git
@@ -0,0 +1,82 @@
+"""Measure how FancyRepo throughput scales with the number of threads.
+
+Usage: python tools/bench_locking.py [--seconds N] REPO [REPO ...]
+
+Each worker thread repeatedly picks one of the given repositories and runs the
+operations behind the most common pages (ref listing, history, blame, tree
+listing, raw diff) against its default branch.  Besides the operations that
+spawn `git`, the object reads done by Dulwich in-process (walking commits,
+diffing trees) run concurrently too, so on a multi-core machine requests/second
+should grow with the number of threads, even with a single repository.
+"""
+import argparse
+import itertools
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from klaus.repo import FancyRepo  # noqa: E402
+
+
+def one_request(repo):
+    rev = repo.get_default_branch() or "HEAD"
+    commit = repo.get_commit(rev)
+    repo.get_branch_names(exclude=rev)
+    repo.get_tag_names()
+    repo.history(commit, None, 30)
+    listing = repo.listdir(commit, "")
+    if listing["files"]:
+        repo.blame(commit, listing["files"][0][1])
+    # Not cached by FancyRepo, so these always read objects with Dulwich.
+    repo.raw_commit_diff(commit)
+    for _ in range(20):
+        if not commit.parents:
+            break
+        commit = repo[commit.parents[0]]
+
+
+def run(repos, nthreads, seconds):
+    deadline = time.time() + seconds
+    counts = [0] * nthreads
+    repo_cycle = itertools.cycle(repos)
+    cycle_lock = threading.Lock()
+
+    def worker(i):
+        while time.time() < deadline:
+            with cycle_lock:
+                repo = next(repo_cycle)
+            one_request(repo)
+            counts[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(nthreads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--threads", default="1,2,4,8,16,32")
+    parser.add_argument("repos", nargs="+")
+    args = parser.parse_args()
+
+    repos = [FancyRepo(os.path.abspath(path), None) for path in args.repos]
+    # Warm up dulwich's caches.
+    for repo in repos:
+        one_request(repo)
+
+    baseline = None
+    for nthreads in map(int, args.threads.split(",")):
+        rate = run(repos, nthreads, args.seconds)
+        baseline = baseline or rate
+        print(f"{nthreads:3d} threads: {rate:8.1f} req/s ({rate / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()